@@ -0,0 +1,253 @@
+##########################################################
+### audio_store.py -- keeps rendered audio in memory   ###
+### (bounded, with LRU and time-to-live eviction) and  ###
+### streams it back in chunks, with an optional tier   ###
+### on disk for renders too large to keep in memory.   ###
+##########################################################
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class AudioStore(object):
+    """
+    A thread-safe store of rendered audio files keyed by audio id.
+    Renders are held in memory up to max_bytes in total; renders of
+    spill_threshold bytes or more are written to spill_dir instead
+    (if one is given), up to max_spill_bytes. In either tier, the
+    least recently used renders are evicted first, and every render
+    is evicted ttl seconds after it was stored.
+    """
+
+    def __init__(self, max_bytes = 64 * 2 ** 20, ttl = 300,
+                 spill_dir = None, spill_threshold = 4 * 2 ** 20,
+                 max_spill_bytes = 1024 * 2 ** 20):
+        """
+        Inputs:
+        max_bytes is the memory budget for renders, in bytes
+        ttl is the number of seconds a render is kept for
+        spill_dir is a directory for large renders, or None to keep
+        every render in memory
+        spill_threshold is the size (in bytes) of a large render
+        max_spill_bytes is the disk budget for renders, in bytes
+
+        Outputs: AudioStore object
+        """
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_spill_bytes = max_spill_bytes
+        self.entries = OrderedDict()
+        self.used = {'memory': 0, 'disk': 0}
+        self.lock = threading.Lock()
+        self.set_spill_dir(spill_dir, spill_threshold)
+
+    def set_spill_dir(self, spill_dir, spill_threshold):
+        """
+        Sets where large renders go, clearing out anything left in
+        spill_dir by an earlier run. Call before storing anything.
+
+        With spill_threshold 0, every render goes to spill_dir, and
+        separate stores (e.g. in pre-forked workers) sharing the
+        directory can serve each other's renders (see stream).
+
+        Inputs:
+        spill_dir is a directory, or None to keep renders in memory
+        spill_threshold is the size (in bytes) of a large render
+        """
+
+        self.spill_dir = spill_dir
+        self.spill_threshold = spill_threshold
+
+        if spill_dir is not None:
+            if not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            for f in os.listdir(spill_dir):
+                if f.endswith('.wav'):
+                    os.remove(os.path.join(spill_dir, f))
+
+    def put(self, audio_id, data):
+        """
+        Stores one render, evicting older ones to stay in budget.
+
+        Inputs:
+        audio_id is a string
+        data is the complete file contents, as bytes
+        """
+
+        size = len(data)
+
+        if self.spill_dir is not None and size >= self.spill_threshold:
+            tier = 'disk'
+            payload = os.path.join(self.spill_dir, audio_id + '.wav')
+            with open(payload, 'wb') as f:
+                f.write(data)
+            self.sweep()
+        else:
+            tier = 'memory'
+            payload = data
+
+        budget = self.max_bytes if tier == 'memory' else self.max_spill_bytes
+
+        with self.lock:
+            if audio_id in self.entries:
+                self.evict(audio_id)
+            self.entries[audio_id] = (tier, payload, size, time.time())
+            self.used[tier] += size
+            for key in [key for key, entry in self.entries.items()
+                        if entry[0] == tier]:
+                if self.used[tier] <= budget or key == audio_id:
+                    break
+                self.evict(key)
+
+    def __contains__(self, audio_id):
+        with self.lock:
+            self.expire()
+            return audio_id in self.entries
+
+    def discard(self, audio_id):
+        """
+        Evicts one render, if it's still stored.
+        """
+
+        with self.lock:
+            if audio_id in self.entries:
+                self.evict(audio_id)
+
+    def stream(self, audio_id, chunk_size = 64 * 2 ** 10):
+        """
+        Looks up one render and returns its size and a generator
+        over its contents in chunks. The generator keeps its own
+        reference to the data (or its own open file), so evicting
+        the render mid-stream doesn't cut the client off.
+
+        Inputs:
+        audio_id is a string
+        chunk_size is the number of bytes per chunk
+
+        Outputs: 2-tuple of (size in bytes, generator of bytes), or
+        None if the render isn't stored
+        """
+
+        with self.lock:
+            self.expire()
+            if audio_id not in self.entries:
+                return self.stream_shared(audio_id, chunk_size)
+            tier, payload, size, created = self.entries.pop(audio_id)
+            self.entries[audio_id] = (tier, payload, size, created)
+
+            if tier == 'memory':
+                chunks = memory_chunks(payload, chunk_size)
+            else:
+                chunks = file_chunks(open(payload, 'rb'), chunk_size)
+
+        return size, chunks
+
+    def stream_shared(self, audio_id, chunk_size):
+        """
+        Streams a render that another store wrote to spill_dir, if
+        it's there and younger than the time to live.
+
+        Outputs: as for stream
+        """
+
+        if self.spill_dir is None:
+            return None
+
+        # ids are only ever hex, so this can't name another file
+        if not audio_id.isalnum():
+            return None
+
+        path = os.path.join(self.spill_dir, audio_id + '.wav')
+
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        info = os.fstat(f.fileno())
+        if info.st_mtime < time.time() - self.ttl:
+            f.close()
+            return None
+
+        return info.st_size, file_chunks(f, chunk_size)
+
+    def sweep(self):
+        """
+        Deletes renders in spill_dir older than the time to live,
+        including any left by other stores sharing the directory.
+        """
+
+        cutoff = time.time() - self.ttl
+
+        for f in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, f)
+            try:
+                if f.endswith('.wav') and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def expire(self):
+        """
+        Evicts every render older than the time to live. Call with
+        the lock held.
+        """
+
+        cutoff = time.time() - self.ttl
+        for key in [key for key, entry in self.entries.items()
+                    if entry[3] < cutoff]:
+            self.evict(key)
+
+    def evict(self, audio_id):
+        """
+        Removes one render (deleting it from disk if it was spilled).
+        Call with the lock held.
+        """
+
+        tier, payload, size, created = self.entries.pop(audio_id)
+        self.used[tier] -= size
+
+        if tier == 'disk':
+            try:
+                os.remove(payload)
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        Returns a dictionary of the number of renders and bytes used
+        in each tier.
+        """
+
+        with self.lock:
+            return {'renders': len(self.entries),
+                    'memory_bytes': self.used['memory'],
+                    'disk_bytes': self.used['disk']}
+
+
+def memory_chunks(data, chunk_size):
+    """
+    Yields successive chunks of a bytes object without copying it
+    all at once.
+    """
+
+    view = memoryview(data)
+    for start in range(0, len(data), chunk_size):
+        yield view[start:start + chunk_size].tobytes()
+
+
+def file_chunks(f, chunk_size):
+    """
+    Yields successive chunks of an open file, closing it at the end.
+    """
+
+    try:
+        chunk = f.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+    finally:
+        f.close()
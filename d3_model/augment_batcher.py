@@ -0,0 +1,151 @@
+#########################################################
+### augment_batcher.py -- gathers concurrent /augment ###
+### requests for a few milliseconds and resolves them ###
+### together, so that they share the model lookups    ###
+### (see note_interpolater.augment_stacks).           ###
+#########################################################
+
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class Job(object):
+    """
+    One submitted job, waiting for its result.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Collects jobs from many request threads and hands them to a
+    resolve function in batches. A batch is resolved as soon as it
+    holds max_batch jobs, or max_wait seconds after its first job
+    arrived, whichever comes first; under light load, a job waits
+    at most max_wait longer than it would have on its own.
+
+    The batching thread is started on first use in each process, so
+    a batcher made before forking (see prefork.py) works in every
+    worker.
+    """
+
+    def __init__(self, resolve, max_batch = 32, max_wait = .005):
+        """
+        Inputs:
+        resolve is a function taking a list of job arguments and
+        returning the list of their results, in the same order
+        max_batch is the largest number of jobs to resolve at once
+        max_wait is the longest a job waits for others, in seconds
+
+        Outputs: MicroBatcher object
+        """
+
+        self.resolve = resolve
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.batches = 0
+        self.resolved = 0
+
+    def start(self):
+        """
+        Starts the batching thread, unless it's already running in
+        this process.
+        """
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.jobs = queue.Queue()
+            thread = threading.Thread(target = self.run)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, args):
+        """
+        Queues one job and blocks until its batch is resolved.
+
+        Inputs: args is this job's entry in the list given to resolve
+
+        Outputs: this job's result
+        """
+
+        self.start()
+
+        job = Job(args)
+        self.jobs.put(job)
+        job.done.wait()
+
+        if job.error is not None:
+            raise job.error
+
+        return job.result
+
+    def collect(self):
+        """
+        Blocks for the next job, then gathers more until the batch
+        is full or its time is up.
+
+        Outputs: list of Job objects
+        """
+
+        batch = [self.jobs.get()]
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.jobs.get(timeout = remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        """
+        Batching thread loop.
+        """
+
+        while True:
+            batch = self.collect()
+
+            try:
+                results = self.resolve([job.args for job in batch])
+                for job, result in zip(batch, results):
+                    job.result = result
+            except Exception as e:
+                for job in batch:
+                    job.error = e
+
+            self.batches += 1
+            self.resolved += len(batch)
+
+            for job in batch:
+                job.done.set()
+
+    def stats(self):
+        """
+        Returns a dictionary of the number of batches and jobs
+        resolved, and the mean batch size.
+        """
+
+        return {'batches': self.batches,
+                'batched_jobs': self.resolved,
+                'mean_batch': (self.resolved / float(self.batches)
+                               if self.batches else 0.0)}
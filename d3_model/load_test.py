@@ -0,0 +1,344 @@
+#######################################################
+### load_test.py -- starts the webapp with the fake ###
+### synth and a small set of fixture models, sends  ###
+### it grids from many client threads at once, and  ###
+### reports latency percentiles, errors and request ###
+### rates for /play and /augment.                   ###
+#######################################################
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import threading
+import subprocess
+import numpy as np
+from collections import defaultdict
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(app_dir), 'src')
+
+# the grid loaded by the Populate button in piano.html
+populate_sample = ('0,15,0,11,0,8,2,15,2,11,2,8,4,15,4,10,4,6,6,15,6,10,'
+                   '6,6,8,15,8,8,8,5,10,15,10,8,10,5,12,15,12,10,12,6,'
+                   '13,15,13,8,13,5')
+
+
+def make_grid(kind, rng):
+    """
+    Makes one grid in the note string format of make_note_stack.
+
+    Inputs:
+    kind is 'sparse' (a few single notes), 'dense' (a chord of three
+    or four notes on nearly every step) or 'populate' (the Populate
+    sample)
+    rng is a random.Random object
+
+    Outputs: string
+    """
+
+    if kind == 'populate':
+        return populate_sample
+
+    pairs = []
+
+    if kind == 'sparse':
+        for step in rng.sample(range(16), rng.randint(2, 5)):
+            pairs.append((step, rng.randint(0, 24)))
+    else:
+        for step in rng.sample(range(16), rng.randint(12, 16)):
+            root = rng.randint(10, 24)
+            for interval in rng.sample([0, 3, 4, 7, 10], rng.randint(3, 4)):
+                pairs.append((step, root - interval))
+
+    return ','.join([str(step) + ',' + str(row) for step, row in pairs])
+
+
+def parse_mix(mix):
+    """
+    Reads a mix like 'sparse=.5,dense=.2,populate=.3' into a list
+    of (kind, weight) pairs.
+    """
+
+    return [(kind, float(weight)) for kind, weight in
+            [part.split('=') for part in mix.split(',')]]
+
+
+def make_fixture_models(work_dir, files = 20, seed = 0):
+    """
+    Trains a small set of chains on a synthetic corpus (see
+    src/synth_corpus.py), so that load tests don't depend on the
+    real, much larger models.
+
+    Inputs:
+    work_dir is a scratch directory
+    files is the size of the corpus
+    seed is an integer; the same seed always gives the same models
+
+    Outputs: the directory of pickled chains
+    """
+
+    sys.path.insert(0, src_dir)
+    import synth_corpus as synth
+    import markov_funcs as markf
+
+    midi_dir = os.path.join(work_dir, 'midi')
+    pickle_dir = os.path.join(work_dir, 'pickles/')
+    os.makedirs(pickle_dir)
+
+    synth.make_corpus(midi_dir, files = files, seed = seed)
+    markf.make_all_chains(midi_dir, pickle_dir)
+
+    return pickle_dir
+
+
+def start_app(models_dir, port, workers, threads, work_dir, env = None):
+    """
+    Starts play_notes.py with the fake synth, and waits for it to
+    answer.
+
+    Inputs:
+    models_dir is the directory of pickled chains
+    port is the port to serve on
+    workers and threads are as for play_notes.py
+    work_dir is a scratch directory (for the pid file, the stand-in
+    synth's sample bank and renders), so that nothing in the app
+    directory is touched
+    env is a dictionary of any more environment variables, or None
+
+    Outputs: subprocess.Popen object
+    """
+
+    app_env = dict(os.environ)
+    app_env.update(env or {})
+    app_env.update({'LEVELUP_FAKE_SYNTH': '1',
+                    'LEVELUP_MODELS_DIR': models_dir,
+                    'LEVELUP_APP_DIR': app_dir + '/',
+                    'LEVELUP_BANK': os.path.join(work_dir,
+                                                 'sample_bank.npz'),
+                    'LEVELUP_RENDER_DIR': os.path.join(work_dir,
+                                                       'renders/'),
+                    'PYTHONPATH': os.pathsep.join(
+                        [src_dir, app_env.get('PYTHONPATH', '')])})
+
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(app_dir, 'play_notes.py'),
+                             '--port', str(port),
+                             '--workers', str(workers),
+                             '--threads', str(threads),
+                             '--pidfile', os.path.join(work_dir, 'app.pid')],
+                            env = app_env)
+
+    url = 'http://127.0.0.1:' + str(port)
+    deadline = time.time() + 120
+
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("play_notes.py exited with status " +
+                               str(proc.returncode))
+        try:
+            urlopen(url + '/stats', timeout = 1).read()
+            return proc
+        except Exception:
+            time.sleep(.5)
+
+    proc.terminate()
+    raise RuntimeError("play_notes.py didn't start within two minutes")
+
+
+def post(url, payload, timeout):
+    """
+    POSTs a JSON payload and returns the decoded JSON reply.
+    """
+
+    request = Request(url, json.dumps(payload).encode('utf-8'),
+                      {'Content-Type': 'application/json'})
+
+    return json.loads(urlopen(request, timeout = timeout).read().decode(
+        'utf-8'))
+
+
+def send(url, route, grid, timeout, fetch_audio):
+    """
+    Sends one request (and, for /play, optionally fetches the audio
+    too, timed as part of it).
+
+    Inputs:
+    url is the app's base URL
+    route is 'play' or 'augment'
+    grid is a note string
+    timeout is in seconds
+    fetch_audio is True to also GET /audio/<id> after /play
+    """
+
+    if route == 'augment':
+        post(url + '/augment', {'notes': grid}, timeout)
+        return
+
+    reply = post(url + '/play', {'notes': grid}, timeout)
+    if fetch_audio:
+        urlopen(url + '/audio/' + reply['id'], timeout = timeout).read()
+
+
+def run_clients(url, routes, mix, concurrency, duration, seed = 0,
+                timeout = 30, fetch_audio = True):
+    """
+    Sends requests from concurrency threads for duration seconds,
+    each thread picking a route and grid kind at random for every
+    request.
+
+    Inputs:
+    url is the app's base URL
+    routes is a list of 'play' and/or 'augment'
+    mix is a list of (grid kind, weight) pairs (see make_grid)
+    concurrency is the number of client threads
+    duration is in seconds
+    seed is an integer, for repeatable request sequences
+    timeout is the per-request timeout in seconds
+    fetch_audio is as in send
+
+    Outputs: 2-tuple of a dictionary of route -> list of
+    (seconds, succeeded) pairs, and the wall time taken
+    """
+
+    results = defaultdict(list)
+    lock = threading.Lock()
+    kinds = [kind for kind, weight in mix]
+    weights = np.array([weight for kind, weight in mix], dtype = float)
+    cumulative = np.cumsum(weights / weights.sum())
+
+    def client(j):
+        rng = random.Random(seed * 1009 + j)
+        stop = start + duration
+        while time.time() < stop:
+            route = rng.choice(routes)
+            kind = kinds[min(np.searchsorted(cumulative, rng.random()),
+                             len(kinds) - 1)]
+            grid = make_grid(kind, rng)
+            begin = time.time()
+            try:
+                send(url, route, grid, timeout, fetch_audio)
+                ok = True
+            except (HTTPError, IOError, ValueError, KeyError):
+                ok = False
+            with lock:
+                results[route].append((time.time() - begin, ok))
+
+    start = time.time()
+    threads = [threading.Thread(target = client, args = (j,))
+               for j in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.time() - start
+
+
+def summarize(results, wall):
+    """
+    Computes each route's request count, error rate, requests per
+    second and latency percentiles (of successful requests).
+
+    Outputs: dictionary of route -> dictionary of figures
+    """
+
+    summary = {}
+
+    for route, samples in sorted(results.items()):
+        latencies = np.array([s for s, ok in samples if ok])
+        errors = len([ok for s, ok in samples if not ok])
+        figures = {'requests': len(samples),
+                   'errors': errors,
+                   'error_rate': errors / float(len(samples)),
+                   'rps': len(samples) / wall}
+        for p in [50, 95, 99]:
+            figures['p' + str(p) + '_ms'] = (
+                float(np.percentile(latencies, p)) * 1000
+                if len(latencies) > 0 else None)
+        summary[route] = figures
+
+    return summary
+
+
+def print_summary(summary):
+    print ("\n%-8s %9s %8s %8s %9s %9s %9s" %
+           ('route', 'requests', 'errors', 'rps', 'p50 ms', 'p95 ms',
+            'p99 ms'))
+
+    for route, f in sorted(summary.items()):
+        latencies = tuple(['%.1f' % f[k] if f[k] is not None else '-'
+                           for k in ['p50_ms', 'p95_ms', 'p99_ms']])
+        print ("%-8s %9d %7.2f%% %8.1f %9s %9s %9s" %
+               ((route, f['requests'], 100 * f['error_rate'], f['rps']) +
+                latencies))
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Load-tests /play and /augment with the fake synth.')
+    parser.add_argument('--url', default = None,
+                        help = 'test an app that is already running '
+                        'instead of starting one')
+    parser.add_argument('--models', default = None,
+                        help = 'directory of pickled chains to serve '
+                        '(default: train a small fixture set)')
+    parser.add_argument('--port', type = int, default = 5055)
+    parser.add_argument('--workers', type = int, default = 2)
+    parser.add_argument('--threads', type = int, default = 8)
+    parser.add_argument('--routes', default = 'play,augment')
+    parser.add_argument('--mix', default = 'sparse=.4,dense=.3,populate=.3')
+    parser.add_argument('--concurrency', type = int, default = 16)
+    parser.add_argument('--duration', type = float, default = 20)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-audio', action = 'store_true',
+                        help = "don't fetch /audio after each /play")
+    parser.add_argument('--batch', action = 'store_true',
+                        help = 'turn on /augment micro-batching')
+    parser.add_argument('--save', default = None,
+                        help = 'write the summary here as JSON')
+    opts = parser.parse_args(args[1:])
+
+    work_dir = tempfile.mkdtemp(prefix = 'levelup_load_')
+    proc = None
+
+    try:
+        url = opts.url
+        if url is None:
+            models = opts.models or make_fixture_models(work_dir)
+            env = {'LEVELUP_BATCH_AUGMENT': '1'} if opts.batch else {}
+            proc = start_app(models, opts.port, opts.workers, opts.threads,
+                             work_dir, env)
+            url = 'http://127.0.0.1:' + str(opts.port)
+
+        results, wall = run_clients(url, opts.routes.split(','),
+                                    parse_mix(opts.mix), opts.concurrency,
+                                    opts.duration, opts.seed,
+                                    fetch_audio = not opts.no_audio)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(work_dir)
+
+    summary = summarize(results, wall)
+    print_summary(summary)
+
+    if opts.save is not None:
+        with open(opts.save, 'w') as f:
+            json.dump({'settings': vars(opts), 'routes': summary}, f,
+                      indent = 2)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
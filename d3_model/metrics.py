@@ -0,0 +1,198 @@
+#######################################################
+### metrics.py -- counters and latency histograms   ###
+### for the webapp, written out in the Prometheus   ###
+### text format. When disabled, every call returns  ###
+### at once without recording anything.             ###
+#######################################################
+
+import threading
+import time
+
+# upper bounds (in seconds) of the default histogram buckets
+default_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class NullTimer(object):
+    """
+    Stands in for Timer when metrics are off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+null_timer = NullTimer()
+
+
+class Timer(object):
+    """
+    Context manager that observes its own duration in a histogram.
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start,
+                             **self.labels)
+        return False
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of counters and histograms, each with
+    any number of label sets.
+    """
+
+    def __init__(self, enabled = True):
+        """
+        Inputs: enabled is False to record nothing at all
+
+        Outputs: Metrics object
+        """
+
+        self.enabled = enabled
+        self.kinds = {}
+        self.helps = {}
+        self.buckets = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help):
+        """
+        Declares a counter (by convention, name ends in _total).
+        """
+
+        self.kinds[name] = 'counter'
+        self.helps[name] = help
+        self.values[name] = {}
+
+    def histogram(self, name, help, buckets = default_buckets):
+        """
+        Declares a histogram with the given bucket upper bounds.
+        """
+
+        self.kinds[name] = 'histogram'
+        self.helps[name] = help
+        self.buckets[name] = tuple(buckets)
+        self.values[name] = {}
+
+    def inc(self, name, value = 1, **labels):
+        """
+        Adds value to a counter.
+        """
+
+        if not self.enabled:
+            return
+
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Records one value in a histogram.
+        """
+
+        if not self.enabled:
+            return
+
+        key = tuple(sorted(labels.items()))
+        buckets = self.buckets[name]
+
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = [[0] * len(buckets), 0.0, 0]
+            counts, total, n = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[key][1] = total + value
+            series[key][2] = n + 1
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager timing its body into a histogram,
+        e.g. with metrics.timer('stage_seconds', stage = 'synth'):
+        """
+
+        if not self.enabled:
+            return null_timer
+
+        return Timer(self, name, labels)
+
+    def render(self, **labels):
+        """
+        Writes out every metric in the Prometheus text format.
+
+        Inputs: any labels to add to every series, e.g. worker = pid
+
+        Outputs: string
+        """
+
+        extra = tuple(sorted(labels.items()))
+        lines = []
+
+        with self.lock:
+            for name in sorted(self.kinds):
+                lines.append('# HELP ' + name + ' ' + self.helps[name])
+                lines.append('# TYPE ' + name + ' ' + self.kinds[name])
+
+                for key, value in sorted(self.values[name].items()):
+                    key = tuple(sorted(key + extra))
+                    if self.kinds[name] == 'counter':
+                        lines.append(name + format_labels(key) + ' ' +
+                                     format_value(value))
+                        continue
+
+                    counts, total, n = value
+                    for bound, count in zip(self.buckets[name], counts):
+                        lines.append(name + '_bucket' +
+                                     format_labels(key + (('le', bound),)) +
+                                     ' ' + str(count))
+                    lines.append(name + '_bucket' +
+                                 format_labels(key + (('le', '+Inf'),)) +
+                                 ' ' + str(n))
+                    lines.append(name + '_sum' + format_labels(key) + ' ' +
+                                 format_value(total))
+                    lines.append(name + '_count' + format_labels(key) + ' ' +
+                                 str(n))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    """
+    Writes a number the way Prometheus reads it.
+    """
+
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+def format_labels(key):
+    """
+    Writes a sorted tuple of (label, value) pairs as {a="1",b="2"}.
+    """
+
+    if len(key) == 0:
+        return ''
+
+    return '{' + ','.join([
+        label + '="' + str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n') + '"'
+        for label, value in key]) + '}'
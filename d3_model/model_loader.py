@@ -0,0 +1,260 @@
+#########################################################
+### model_loader.py -- loads versioned bundles of the ###
+### Markov chains, with everything derived from them, ###
+### and swaps in new bundles while the app is running ###
+### without touching requests already in progress.    ###
+#########################################################
+
+import os
+import json
+import hashlib
+import threading
+import time
+import markov_funcs as markf
+import rhythm_interpolater as rhyi
+import context_index as ci
+import export_models as expm
+
+
+class ModelSet(object):
+    """
+    One loaded model bundle: the melody and rhythm chains, their
+    weights, and the tables, indexes and browser export built from
+    them. Never modified once built, so a request can hold on to
+    one for its whole duration while a newer one is swapped in.
+    """
+
+    def __init__(self, version, melody_marks, rhythm_marks,
+                 melody_weights, rhythm_weights, max_len = 2):
+        """
+        Inputs:
+        version is a string naming the bundle
+        melody_marks, rhythm_marks, melody_weights and rhythm_weights
+        are as returned by markov_funcs.load_chains
+        max_len is the maximum order length of the chains
+
+        Outputs: ModelSet object
+        """
+
+        self.version = version
+        self.melody_marks = melody_marks
+        self.rhythm_marks = rhythm_marks
+        self.melody_weights = melody_weights
+        self.rhythm_weights = rhythm_weights
+        self.max_len = max_len
+
+        # candidate-onset tables for the rhythm chains, so that
+        # rhythmic augmentation adds no per-request lookup cost
+        self.rhythm_tables = rhyi.build_rhythm_tables(rhythm_marks)
+
+        # neighbour indexes to fall back on when a grid's exact
+        # melodic context has never been seen by a model
+        self.melody_indexes = ci.build_indexes(melody_marks)
+
+        # compact copy of the melody models for in-browser augmentation
+        self.model_json = expm.dumps(expm.export_melody_models(
+            melody_marks, melody_weights, max_len))
+        self.model_etag = hashlib.sha1(
+            self.model_json.encode('utf-8')).hexdigest()
+
+
+def validate(melody_marks, rhythm_marks, melody_weights, rhythm_weights,
+             max_len, samples = 100):
+    """
+    Checks that a set of chains is complete and sane before it's
+    put into service: there are melody and rhythm chains of every
+    order up to max_len (and none longer), every chain has a
+    weight, and a sample of each chain's distributions are
+    non-empty and sum to one (up to rounding).
+
+    Inputs: as for ModelSet, and samples is the number of contexts
+    to check per chain
+
+    Outputs: None, raises ValueError describing the first problem
+    """
+
+    if len(melody_marks) == 0 or len(rhythm_marks) == 0:
+        raise ValueError("bundle needs both melody and rhythm chains")
+
+    orders = [(before, after) for before in range(max_len + 1)
+              for after in range(max_len + 1)
+              if 0 < before + after <= max_len]
+
+    for kind, marks, weights in [('melody', melody_marks, melody_weights),
+                                 ('rhythm', rhythm_marks, rhythm_weights)]:
+        for order in orders:
+            if order not in marks:
+                raise ValueError(kind + " chain " + str(order) + " is missing")
+        for (before, after), mark in marks.items():
+            name = kind + ' chain ' + str((before, after))
+            if (before, after) not in weights:
+                raise ValueError(name + " has no weight")
+            if before + after > max_len:
+                raise ValueError(name + " is longer than max_len " +
+                                 str(max_len))
+            if len(mark.state_dict) == 0:
+                raise ValueError(name + " is empty")
+            for key in list(mark.state_dict)[:samples]:
+                dist = mark.state_dict[key]
+                # Markov.normalize rounds each probability to 4 places
+                slack = 5e-5 * len(dist) + 1e-6
+                if len(dist) == 0 or abs(sum(dist.values()) - 1.0) > slack:
+                    raise ValueError(name + " has a bad distribution at " +
+                                     str(key))
+
+
+def load_model_set(pickle_dir, version, max_len = 2):
+    """
+    Loads and validates one directory of pickled chains.
+
+    Inputs:
+    pickle_dir is a string path name
+    version is a string naming the bundle
+    max_len is the maximum order length, unless the bundle's
+    bundle.json gives its own
+
+    Outputs: ModelSet object, raises ValueError if invalid
+    """
+
+    if pickle_dir[-1] != '/':
+        pickle_dir += '/'
+
+    if os.path.exists(pickle_dir + 'bundle.json'):
+        with open(pickle_dir + 'bundle.json', 'r') as f:
+            max_len = json.load(f).get('max_len', max_len)
+
+    chains = markf.load_chains(pickle_dir)
+    validate(*chains, max_len = max_len)
+
+    return ModelSet(version, *chains, max_len = max_len)
+
+
+def find_bundles(models_dir):
+    """
+    Lists the complete bundles in a models directory. A bundle is a
+    subdirectory of pickled chains, and counts as complete once its
+    bundle.json exists, so write that file last when deploying. The
+    bundle's name is its version; names are compared as strings, so
+    use e.g. zero-padded numbers or timestamps.
+
+    Inputs: models_dir is a string path name
+
+    Outputs: sorted list of bundle names
+    """
+
+    return sorted([d for d in os.listdir(models_dir)
+                   if os.path.exists(os.path.join(models_dir, d,
+                                                  'bundle.json'))])
+
+
+class ModelLoader(object):
+    """
+    Holds the active ModelSet and replaces it when a newer bundle
+    appears in models_dir. Loading and validation happen on the
+    calling thread (see start for a background one), and the swap
+    itself is a single assignment, so requests that read current
+    once and keep it see one consistent set of models throughout.
+
+    If models_dir has no bundles that load, the chains directly
+    inside it are loaded as version 'base', as before there were
+    bundles.
+    """
+
+    def __init__(self, models_dir, max_len = 2, on_swap = None):
+        """
+        Inputs:
+        models_dir is a string path name
+        max_len is the default maximum order length of the chains
+        on_swap is a function of the new ModelSet, called after each
+        swap (e.g. to invalidate caches), or None
+
+        Outputs: ModelLoader object, with the newest bundle loaded
+        """
+
+        self.models_dir = models_dir
+        self.max_len = max_len
+        self.on_swap = on_swap
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.bundle = None
+        self.current = None
+
+        # start from the newest bundle that loads, so that one bad
+        # deployment doesn't keep the app from starting at all
+        for version in reversed(find_bundles(models_dir)):
+            try:
+                self.current = load_model_set(
+                    os.path.join(models_dir, version), version, max_len)
+                self.bundle = version
+                break
+            except Exception as e:
+                print ("Model bundle " + version + " rejected: " + str(e))
+                self.failed.add(version)
+
+        if self.current is None:
+            self.current = load_model_set(models_dir, 'base', max_len)
+
+    def check(self, notify = True):
+        """
+        Loads the newest bundle if it isn't the active one. A bundle
+        that fails to load or validate is reported and skipped until
+        a newer one appears.
+
+        Inputs: notify is False not to call on_swap after a swap
+        (e.g. when the caller is about to act on it anyway)
+
+        Outputs: True if a new bundle was swapped in
+        """
+
+        with self.lock:
+            bundles = [b for b in find_bundles(self.models_dir)
+                       if b not in self.failed]
+            if len(bundles) == 0:
+                return False
+            version = bundles[-1]
+            if self.bundle is not None and version <= self.bundle:
+                return False
+
+            try:
+                model_set = load_model_set(
+                    os.path.join(self.models_dir, version), version,
+                    self.max_len)
+            except Exception as e:
+                print ("Model bundle " + version + " rejected: " + str(e))
+                self.failed.add(version)
+                return False
+
+            self.bundle = version
+            self.current = model_set
+
+        print ("Model bundle " + version + " is now active.")
+
+        if notify and self.on_swap is not None:
+            self.on_swap(model_set)
+
+        return True
+
+    def watch(self, interval):
+        """
+        Background thread loop: checks for new bundles forever.
+        """
+
+        while True:
+            time.sleep(interval)
+            try:
+                self.check()
+            except OSError as e:
+                print ("Couldn't check for model bundles: " + str(e))
+
+    def start(self, interval = 10):
+        """
+        Starts checking for new bundles every interval seconds on a
+        background thread.
+        """
+
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.watch,
+                                           args = (interval,))
+            self.thread.daemon = True
+            self.thread.start()
@@ -0,0 +1,352 @@
+########################################################
+### note_renderer.py -- renders note stacks to audio ###
+### by mixing pre-rendered per-pitch samples, so the ###
+### soundfont only has to be loaded once at startup. ###
+########################################################
+
+import os
+import io
+import wave
+import midi
+import numpy as np
+
+
+# audio settings shared by the web app
+sample_rate = 44100
+step_seconds = .2
+step_frames = int(sample_rate * step_seconds)
+release_frames = int(sample_rate * .8)
+
+
+class FakeSynth(object):
+    """
+    A stand-in for fluidsynth.Synth with the same small interface
+    used by the web app. It plays decaying sine tones instead of a
+    soundfont, so rendering can be tested without FluidSynth.
+    """
+
+    def __init__(self, gain = 0.2, samplerate = sample_rate):
+        """
+        Inputs:
+        gain is the peak amplitude of one note, in [0, 1]
+        samplerate is the number of frames per second
+
+        Outputs: FakeSynth object
+        """
+
+        self.gain = gain
+        self.samplerate = float(samplerate)
+        self.frame = 0
+        self.notes = {}
+
+    def sfload(self, filename):
+        return 1
+
+    def program_select(self, chan, sfid, bank, preset):
+        pass
+
+    def noteon(self, chan, key, vel):
+        self.notes[key] = (vel / 127.0, self.frame, None)
+
+    def noteoff(self, chan, key):
+        if key in self.notes:
+            vel, start, stop = self.notes[key]
+            self.notes[key] = (vel, start, self.frame)
+
+    def get_samples(self, length = 1024):
+        """
+        Renders the next length frames as interleaved stereo int16
+        samples, like fluidsynth.Synth.get_samples.
+        """
+
+        frames = np.arange(self.frame, self.frame + length)
+        mono = np.zeros(length)
+
+        for key, (vel, start, stop) in list(self.notes.items()):
+            t = (frames - start) / self.samplerate
+            env = np.exp(-3.0 * t)
+            if stop is not None:
+                env *= np.exp(-20.0 * np.maximum(frames - stop, 0) /
+                              self.samplerate)
+                if env[-1] < 1e-4:
+                    del self.notes[key]
+            freq = 440.0 * 2 ** ((key - 69) / 12.0)
+            mono += vel * env * np.sin(2 * np.pi * freq * t)
+
+        self.frame += length
+        mono = np.clip(mono * self.gain * 32767, -32768, 32767)
+
+        return np.repeat(mono.astype(np.int16), 2)
+
+    def delete(self):
+        self.notes = {}
+
+
+class SampleBank(object):
+    """
+    One stereo buffer per pitch, each holding a single note played
+    for one grid step followed by its release tail. A grid is then
+    rendered by adding these buffers into one preallocated array,
+    without touching the synthesizer at all.
+    """
+
+    def __init__(self, buffers, step_frames = step_frames):
+        """
+        Inputs:
+        buffers is a dictionary of pitch -> int16 array of shape
+        (frames, 2)
+        step_frames is the number of frames per grid step
+
+        Outputs: SampleBank object
+        """
+
+        self.buffers = buffers
+        self.step_frames = step_frames
+
+    @classmethod
+    def render(cls, synth, pitches = range(128), velocity = 100,
+               step_frames = step_frames, release_frames = release_frames):
+        """
+        Renders every pitch once with a synthesizer that already has
+        its soundfont and program selected.
+
+        Inputs:
+        synth is a fluidsynth.Synth (or FakeSynth) object
+        pitches is the list of MIDI pitches to render
+        velocity is the MIDI velocity of every note
+        step_frames is the number of frames per grid step
+        release_frames is the number of frames kept after note off
+
+        Outputs: SampleBank object
+        """
+
+        buffers = {}
+
+        for pitch in pitches:
+            synth.noteon(0, pitch, velocity)
+            held = synth.get_samples(step_frames)
+            synth.noteoff(0, pitch)
+            tail = synth.get_samples(release_frames)
+            buffers[pitch] = np.concatenate([held, tail]).reshape(-1, 2)
+
+        return cls(buffers, step_frames)
+
+    def save(self, filename, meta = ''):
+        """
+        Saves the bank to a .npz file, along with a string that
+        describes how it was rendered (see load_or_render).
+        """
+
+        arrays = dict([('pitch_' + str(pitch), buf)
+                       for pitch, buf in self.buffers.items()])
+        np.savez(filename, meta = np.array(meta),
+                 step_frames = np.array(self.step_frames), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a bank saved by save.
+
+        Outputs: 2-tuple of the SampleBank object and its meta string
+        """
+
+        data = np.load(filename)
+        buffers = dict([(int(name[len('pitch_'):]), data[name])
+                        for name in data.files if name.startswith('pitch_')])
+
+        return (cls(buffers, int(data['step_frames'])),
+                str(data['meta']))
+
+    def mix(self, note_data):
+        """
+        Renders a note stack by adding each note's buffer into one
+        preallocated array at the offset of its step. Release tails
+        run over into the following steps, as they would on a synth,
+        and the last one is cut off at the end of the grid.
+
+        Inputs: note_data is a stacked sequence of notes (output
+        from note_interpolater.make_note_stack)
+
+        Outputs: int16 array of shape (frames, 2)
+        """
+
+        total = len(note_data) * self.step_frames
+        tail = max([len(buf) for buf in self.buffers.values()] + [0])
+        mixed = np.zeros((total + tail, 2), dtype = np.int32)
+
+        for k, (tick, notes) in enumerate(note_data):
+            if notes == ['x']:
+                continue
+            start = k * self.step_frames
+            for val in notes:
+                buf = self.buffers.get(int(val))
+                if buf is not None:
+                    mixed[start:start + len(buf)] += buf
+
+        return np.clip(mixed[:total], -32768, 32767).astype(np.int16)
+
+
+def render_live(synth, note_data, velocity = 100,
+                step_frames = step_frames):
+    """
+    Renders a note stack step by step with a live synthesizer. The
+    total number of frames is known up front, so every step is
+    written straight into its slice of one preallocated array.
+
+    Inputs:
+    synth is a fluidsynth.Synth (or FakeSynth) object with its
+    soundfont and program selected
+    note_data is a stacked sequence of notes
+    velocity is the MIDI velocity of every note
+    step_frames is the number of frames per grid step
+
+    Outputs: int16 array of shape (frames, 2)
+    """
+
+    rendered = np.empty((len(note_data) * step_frames, 2), dtype = np.int16)
+
+    for k, (tick, notes) in enumerate(note_data):
+        if notes == ['x']:
+            notes = []
+        for val in notes:
+            synth.noteon(0, int(val), velocity)
+        rendered[k * step_frames:(k + 1) * step_frames] = \
+            synth.get_samples(step_frames).reshape(-1, 2)
+        for val in notes:
+            synth.noteoff(0, int(val))
+
+    return rendered
+
+
+def write_wav(f, samples, samplerate = sample_rate):
+    """
+    Writes rendered samples as a 16-bit stereo WAV file. The array's
+    own buffer is handed to the writer, so no copy of the audio is
+    made on the way out.
+
+    Inputs:
+    f is a file name or a writable file object
+    samples is an int16 array of shape (frames, 2)
+    samplerate is the number of frames per second
+
+    Outputs: None
+    """
+
+    samples = np.ascontiguousarray(samples, dtype = np.int16)
+
+    wf = wave.open(f, 'wb')
+    wf.setnchannels(2)
+    wf.setframerate(samplerate)
+    wf.setsampwidth(2)
+    wf.writeframes(samples.data)
+    wf.close()
+
+
+def load_or_render(filename, synth_factory, soundfont, program = 0,
+                   pitches = range(128)):
+    """
+    Loads the sample bank cached at filename, or renders it with a
+    fresh synthesizer (and caches it) if the cache is missing or was
+    rendered from a different soundfont, program or pitch range.
+
+    Inputs:
+    filename is the path of the .npz cache file
+    synth_factory is fluidsynth.Synth or FakeSynth
+    soundfont is the path of the .sf2 file
+    program is the General MIDI program number to render
+    pitches is the list of MIDI pitches to render
+
+    Outputs: SampleBank object
+    """
+
+    mtime = os.path.getmtime(soundfont) if os.path.exists(soundfont) else 0
+    meta = '|'.join(map(str, [synth_factory.__name__, soundfont, mtime,
+                              program, min(pitches), max(pitches),
+                              step_frames, release_frames]))
+
+    if os.path.exists(filename):
+        try:
+            bank, cached_meta = SampleBank.load(filename)
+            if cached_meta == meta:
+                return bank
+        except (IOError, ValueError, KeyError):
+            pass
+
+    fs = synth_factory()
+    sfid = fs.sfload(soundfont)
+    fs.program_select(0, sfid, 0, program)
+    bank = SampleBank.render(fs, pitches)
+    fs.delete()
+
+    bank.save(filename, meta)
+
+    return bank
+
+
+def stack_to_events(note_data, velocity = 100, step_seconds = step_seconds):
+    """
+    Converts a note stack into a compact list of note events for
+    the browser to play itself.
+
+    Inputs:
+    note_data is a stacked sequence of notes
+    velocity is the MIDI velocity of every note
+    step_seconds is the length of one grid step
+
+    Outputs: dictionary with the step length, the total length and
+    a list of [start (in steps), pitch, velocity] events
+    """
+
+    events = [[k, int(val), velocity]
+              for k, (tick, notes) in enumerate(note_data)
+              if notes != ['x'] for val in notes]
+
+    return {'step': step_seconds, 'steps': len(note_data), 
+            'events': events}
+
+
+def stack_to_midi(note_data, program = 0, velocity = 100,
+                  step_seconds = step_seconds, resolution = 220):
+    """
+    Converts a note stack into a Standard MIDI File held in memory,
+    with one beat per grid step and the tempo set so that each beat
+    lasts step_seconds.
+
+    Inputs:
+    note_data is a stacked sequence of notes
+    program is the General MIDI program number
+    velocity is the MIDI velocity of every note
+    step_seconds is the length of one grid step
+    resolution is the number of ticks per beat
+
+    Outputs: the .mid file contents, as bytes
+    """
+
+    events = [midi.SetTempoEvent(tick = 0, bpm = 60.0 / step_seconds),
+              midi.ProgramChangeEvent(tick = 0, channel = 0,
+                                      data = [program])]
+
+    for k, (tick, notes) in enumerate(note_data):
+        if notes == ['x']:
+            continue
+        for val in notes:
+            events.append(midi.NoteOnEvent(tick = k * resolution,
+                                           channel = 0,
+                                           data = [int(val), velocity]))
+            events.append(midi.NoteOffEvent(tick = (k + 1) * resolution,
+                                            channel = 0,
+                                            data = [int(val), 0]))
+
+    events = sorted(events, key = lambda x: x.tick)
+    events.append(midi.EndOfTrackEvent(tick = len(note_data) * resolution))
+
+    track = midi.containers.Track(events = events, tick_relative = False)
+    pattern = midi.containers.Pattern(tracks = [track],
+                                      resolution = resolution,
+                                      format = 0, tick_relative = False)
+    pattern.make_ticks_rel()
+
+    f = io.BytesIO()
+    midi.write_midifile(f, pattern)
+
+    return f.getvalue()
@@ -1,12 +1,9 @@
-# only allow one instance to run simultaneously
-from tendo import singleton
-me = singleton.SingleInstance()
-
-import fluidsynth
 import flask
+import sys
+import argparse
+import signal
 import time
-import numpy as np
-import wave
+import io
 import os
 import uuid
 import pickle
@@ -14,43 +11,262 @@ import random
 import markov_sequences as marks
 import markov_funcs as markf
 import note_interpolater as notei
+import rhythm_interpolater as rhyi
+import note_renderer as noter
+import render_cache as rcache
+import audio_store as astore
+import prefork
+import model_loader as loader
+import augment_batcher as batcher
+import metrics as met
 from collections import defaultdict
 
 
-# containers for Markov objects and their weights
-melody_marks = {}
-rhythm_marks = {}
-melody_weights = {}
-rhythm_weights = {}
-
-
-# unpickle the objects created from /src scripts
-# and initialize all weights to 1
-### CHANGE THESE DIRECTORIES TO MATCH YOUR SYSTEM
-for f in os.listdir('path/to/repo/pickles/'):
-    with open('path/to/repo/pickles/' + f, 'r') as g:
-        try:
-            mark = pickle.load(g)
-            key = tuple([mark.before, mark.after])
-            if f.startswith('markov_melody'):
-                melody_marks[key] = mark
-                melody_weights[key] = 1.0
-            elif f.startswith('markov_rhythm'):
-                rhythm_marks[key] = mark
-                rhythm_weights[key] = 1.0
-        except KeyError:
-            print ("There may have been a problem opening the " + 
-                   "pickled file " + f + ".") 
+# unpickle the objects created from /src scripts (from the newest
+# bundle subdirectory, if there are any; see model_loader.py) and 
+# build everything derived from them: rhythm tables, neighbour
+# indexes and the in-browser export served from /model.json
+### CHANGE THIS DIRECTORY TO MATCH YOUR SYSTEM
+### (or set LEVELUP_MODELS_DIR, e.g. to test against other models)
+models_dir = os.environ.get('LEVELUP_MODELS_DIR', 'path/to/repo/pickles/')
 
 # note, this depends on what you defined your max_order variables
-# to be in the markov_funcs module
+# to be in the markov_funcs module (a bundle.json can override it)
 max_length = 2
 
+# requests read model_loader.current once and use that ModelSet
+# throughout, so swapping in a new bundle never mixes two versions
+model_loader = loader.ModelLoader(models_dir, max_length)
+
+### CHANGE THIS TO CHECK FOR NEW MODEL BUNDLES MORE OR LESS OFTEN
+### (IN SECONDS)
+reload_interval = 10
+
+# the piano's grid is 16 steps, with row 0 at pitch 72; requests
+# may ask for other grids with 'steps' and 'pitch_offset'
+### CHANGE THIS TO ALLOW LONGER (OR ONLY SHORTER) GRIDS TO BE AUGMENTED
+max_steps = 4096
+
+# /play renders audio for every step of the grid, so it takes far
+# shorter grids (and none whose audio won't fit in audio_store)
+### CHANGE THIS TO ALLOW LONGER (OR ONLY SHORTER) GRIDS TO BE PLAYED
+max_play_steps = 256
+
 # initialize flask
 app = flask.Flask(__name__)
 
+### SET LEVELUP_METRICS=1 TO RECORD REQUEST LATENCIES, PER-STAGE TIMINGS
+### and model lookup counts, served in the Prometheus text format from
+### /metrics (when unset, nothing is recorded and /metrics is a 404)
+metrics = met.Metrics(os.environ.get('LEVELUP_METRICS') == '1')
+metrics.histogram('levelup_request_seconds', 
+                  'Time to handle a request, by route.')
+metrics.counter('levelup_requests_total', 
+                'Requests handled, by route and status code.')
+metrics.histogram('levelup_stage_seconds',
+                  'Time spent in each stage of /play and /augment.')
+metrics.counter('levelup_unstacked_sequences_total',
+                'Single-note melodies unstacked from chords for /augment.')
+metrics.counter('levelup_model_lookups_total',
+                'Melody model lookups, by order and whether the context '
+                'had been seen.')
+
 ### CHANGE THIS TO MATCH YOUR CORRECT SYSTEM PATH
-absolute_path = '/path/to/repo/d3_model/'
+### (or set LEVELUP_APP_DIR)
+absolute_path = os.environ.get('LEVELUP_APP_DIR', '/path/to/repo/d3_model/')
+
+### SET LEVELUP_FAKE_SYNTH=1 TO RENDER WITH A STAND-IN SYNTH
+### (no FluidSynth or soundfont needed, e.g. for testing)
+if os.environ.get('LEVELUP_FAKE_SYNTH') == '1':
+    synth_factory = noter.FakeSynth
+else:
+    import fluidsynth
+    synth_factory = fluidsynth.Synth
+
+### SET LEVELUP_BANK AND LEVELUP_RENDER_DIR TO KEEP THE SAMPLE BANK AND
+### the pre-fork workers' shared renders somewhere other than the app
+### directory (e.g. a scratch directory, when testing)
+bank_file = os.environ.get('LEVELUP_BANK', absolute_path + 'sample_bank.npz')
+render_dir = os.environ.get('LEVELUP_RENDER_DIR', absolute_path + 'renders/')
+
+### SET LEVELUP_RENDER=live TO RUN THE SYNTH FOR EVERY /play REQUEST
+### instead of mixing pre-rendered samples
+render_mode = os.environ.get('LEVELUP_RENDER', 'bank')
+
+# render every pitch once (or load the cached renders), so that
+# /play never has to load the soundfont or run the synth
+if render_mode == 'bank':
+    sample_bank = noter.load_or_render(bank_file,
+                                       synth_factory,
+                                       absolute_path + 'FluidR3_GM.sf2')
+
+# everything besides the notes that changes what /play renders
+render_settings = (render_mode, synth_factory.__name__, 
+                   absolute_path + 'FluidR3_GM.sf2', 0, 100,
+                   noter.step_frames, noter.sample_rate)
+
+
+# rendered audio is kept in memory and streamed from /audio, so
+# /play never writes to disk unless spill_dir is set, in which case
+# renders of spill_threshold bytes or more are kept there instead
+### CHANGE THESE TO TUNE THE STORE'S BUDGETS (IN BYTES) AND LIFETIME
+audio_store = astore.AudioStore(max_bytes = 64 * 2 ** 20, ttl = 300,
+                                spill_dir = None,
+                                spill_threshold = 4 * 2 ** 20)
+
+# remember the audio id of every recent render, so that playing the
+# same grid again returns the existing audio; renders evicted here
+# are dropped from the store too
+### CHANGE THESE TO TUNE THE CACHE SIZE AND LIFETIME (IN SECONDS); a
+### render is only reused while it has more than margin seconds left
+render_cache = rcache.RenderCache(max_entries = 256, ttl = 300,
+                                  on_evict = audio_store.discard,
+                                  margin = 30)
+
+
+def resolve_augments(jobs):
+    """
+    Fills in a batch of grids with one call to augment_stacks per
+    model version among them (normally just one).
+
+    Inputs: list of (ModelSet, note stack, steps to fill, 
+    RandomState) tuples
+
+    Outputs: list of the (step, pitch) tuples added to each grid
+    """
+
+    added = [None] * len(jobs)
+    groups = defaultdict(list)
+    stats = {} if metrics.enabled else None
+
+    for j, job in enumerate(jobs):
+        groups[id(job[0])].append(j)
+
+    for group in groups.values():
+        models = jobs[group[0]][0]
+        results = notei.augment_stacks(models.melody_marks,
+                                       [jobs[j][1] for j in group],
+                                       [jobs[j][2] for j in group],
+                                       models.melody_weights, 
+                                       models.max_len,
+                                       [jobs[j][3] for j in group],
+                                       models.melody_indexes, stats)
+        for j, result in zip(group, results):
+            added[j] = result
+
+    if stats is not None:
+        for key, count in stats.items():
+            if key == 'unstacked':
+                metrics.inc('levelup_unstacked_sequences_total', count)
+            else:
+                (before, after) = key[1]
+                metrics.inc('levelup_model_lookups_total', count,
+                            before = before, after = after, result = key[0])
+
+    return added
+
+### SET LEVELUP_BATCH_AUGMENT=1 TO RESOLVE CONCURRENT /augment REQUESTS
+### together; each waits at most max_wait seconds for others to join
+### its batch (CHANGE max_batch AND max_wait BELOW TO TUNE THIS)
+if os.environ.get('LEVELUP_BATCH_AUGMENT') == '1':
+    augment_batcher = batcher.MicroBatcher(resolve_augments, 
+                                           max_batch = 32, max_wait = .005)
+else:
+    augment_batcher = None
+
+
+@app.before_request
+def start_request():
+    if metrics.enabled:
+        flask.g.start = time.time()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records the latency and status of every request, by route.
+    """
+
+    if metrics.enabled:
+        rule = flask.request.url_rule
+        route = rule.rule if rule is not None else 'unmatched'
+        metrics.observe('levelup_request_seconds', 
+                        time.time() - flask.g.start, route = route)
+        metrics.inc('levelup_requests_total', route = route,
+                    status = response.status_code)
+
+    return response
+
+
+def get_grid(data, limit = max_steps):
+    """
+    Reads the grid layout a request asks for, aborting with 400 if
+    it asks for more than limit steps.
+
+    Inputs:
+    data is the request's JSON
+    limit is the most steps allowed
+
+    Outputs: 2-tuple of the number of steps and the pitch of row 0
+    (16 and 72 by default, the piano's grid)
+    """
+
+    try:
+        steps = int(data.get('steps', 16))
+        pitch_offset = int(data.get('pitch_offset', 72))
+    except (TypeError, ValueError, OverflowError):
+        flask.abort(400)
+
+    if not 1 <= steps <= limit:
+        flask.abort(400)
+
+    return steps, pitch_offset
+
+
+def get_seed(data):
+    """
+    Reads the seed a request asks for (or draws a fresh one),
+    aborting with 400 if it isn't an integer in range(2 ** 32).
+
+    Inputs: data is the request's JSON
+
+    Outputs: integer seed, for note_interpolater.make_rng
+    """
+
+    if data.get('seed') is None:
+        return notei.make_seed()
+
+    try:
+        seed = int(data['seed'])
+    except (TypeError, ValueError, OverflowError):
+        flask.abort(400)
+
+    if not 0 <= seed < 2 ** 32:
+        flask.abort(400)
+
+    return seed
+
+
+def parse_grid(data, steps, pitch_offset):
+    """
+    Turns a request's note string into a note stack (see
+    note_interpolater.make_note_stack), aborting with 400 if it
+    holds anything but numbers.
+    """
+
+    try:
+        return notei.make_note_stack(data['notes'], steps, pitch_offset)
+    except (AttributeError, ValueError):
+        flask.abort(400)
+
+
+def render_bytes(steps):
+    """
+    Returns the size of the WAV audio /play renders for a grid of
+    steps steps, release tail included.
+    """
+
+    return (steps * noter.step_frames + noter.release_frames) * 4
 
 
 # load homepage
@@ -69,12 +285,18 @@ def home_page():
 def play_notes():
     """
     Pulls in note positions from javascript, creates a random
-    filename, and writes .wav file representing those notes.
+    audio id, and stores the .wav audio representing those notes
+    (see get_audio). If the same grid was rendered recently, its
+    audio is reused. If the JSON asks for 'format' 'midi' or 
+    'events', the notes are sent back for the browser to play 
+    instead, without running the synth at all.
 
     Inputs: No direct arguments, but ...
-    Pulls in JSON of note positions via flask
+    Pulls in JSON of note positions (and optional format and grid
+    layout, see get_grid) via flask
     
-    Outputs: filename prefix (sends to javascript)
+    Outputs: audio id, a .mid file or JSON of note events 
+    (sends to javascript)
     """
     
     data = flask.request.json
@@ -82,83 +304,248 @@ def play_notes():
     if data['notes'] == '':
         return flask.jsonify(data)
 
+    steps, pitch_offset = get_grid(data, max_play_steps)
+
+    if render_bytes(steps) > audio_store.max_bytes:
+        flask.abort(400)
+
+    with metrics.timer('levelup_stage_seconds', route = 'play', 
+                       stage = 'parse'):
+        note_data, _ = parse_grid(data, steps, pitch_offset)
+
+    if data.get('format') == 'midi':
+        return flask.Response(noter.stack_to_midi(note_data),
+                              mimetype = 'audio/midi')
+
+    if data.get('format') == 'events':
+        return flask.jsonify(noter.stack_to_events(note_data))
+
+    with metrics.timer('levelup_stage_seconds', route = 'play',
+                       stage = 'cache_lookup'):
+        key = rcache.make_key(note_data, render_settings)
+        audio_id = render_cache.get(key)
+        found = audio_id is not None and audio_id in audio_store
+
+    if found:
+        return flask.jsonify({'id': audio_id})
+    if audio_id is not None:
+        render_cache.discard(key)
+
     rand_id = str(uuid.uuid4().hex)[:6]
 
-    note_data, _ = notei.make_note_stack(data['notes'])
+    if render_mode == 'bank':
+        with metrics.timer('levelup_stage_seconds', route = 'play',
+                           stage = 'synth_bank'):
+            s = sample_bank.mix(note_data)
+    else:
+        with metrics.timer('levelup_stage_seconds', route = 'play',
+                           stage = 'soundfont_load'):
+            fs = synth_factory()
+            sfid = fs.sfload(absolute_path + "FluidR3_GM.sf2")
+            fs.program_select(0, sfid, 0, 0)
+        with metrics.timer('levelup_stage_seconds', route = 'play',
+                           stage = 'synth_live'):
+            s = noter.render_live(fs, note_data)
+            fs.delete()
+
+    with metrics.timer('levelup_stage_seconds', route = 'play',
+                       stage = 'wav_write'):
+        wav = io.BytesIO()
+        noter.write_wav(wav, s)
+        audio_store.put(rand_id, wav.getvalue())
+
+    # a concurrent request for the same grid may have got there first
+    audio_id = render_cache.put(key, rand_id)
+    if audio_id != rand_id:
+        audio_store.discard(rand_id)
+
+    return flask.jsonify({'id': audio_id})
+
+
+# load audio
+@app.route('/audio/<audio_id>')
+def get_audio(audio_id):
+    """
+    Streams a stored render back to the browser in chunks.
 
-    s = []
+    Inputs: audio_id as returned by play_notes
 
-    fs = fluidsynth.Synth()
-    sfid = fs.sfload(absolute_path + "FluidR3_GM.sf2")
-    fs.program_select(0, sfid, 0, 0)
+    Outputs: .wav audio, or 404 if it has been evicted
+    """
+
+    found = audio_store.stream(audio_id)
+
+    if found is None:
+        flask.abort(404)
+
+    size, chunks = found
+
+    return flask.Response(chunks, mimetype = 'audio/wav',
+                          headers = {'Content-Length': str(size),
+                                     'Cache-Control': 'no-cache'})
 
-    for tick, notes in note_data:
-        if notes != ['x']:
-            for val in notes: 
-                fs.noteon(0, int(val), 100)
-            s = np.append(s, fs.get_samples(int(44100 * .2))) 
-            for val in notes:
-                fs.noteoff(0, int(val))
-        else:
-            s = np.append(s, fs.get_samples(int(44100 * .2)))
 
-    fs.delete()
+# load exported melody models
+@app.route('/model.json')
+def get_model():
+    """
+    Serves the exported melody models for in-browser augmentation,
+    letting the browser cache them and revalidate with an ETag.
+
+    Outputs: JSON of the exported models, or 304 if unchanged.
+    """
 
-    samps = fluidsynth.raw_audio_string(s)
+    models = model_loader.current
 
-    wf = wave.open(absolute_path + 'static/' + rand_id + '.wav', 'wb')
-    wf.setnchannels(2)
-    wf.setframerate(44100)
-    wf.setsampwidth(2)
-    wf.writeframes(b''.join(samps))
-    wf.close()
+    if flask.request.headers.get('If-None-Match') == models.model_etag:
+        return flask.Response(status = 304)
+
+    return flask.Response(models.model_json, mimetype = 'application/json',
+                          headers = {'ETag': models.model_etag,
+                                     'Cache-Control': 'public, max-age=3600'})
+
+
+# load render cache statistics
+@app.route('/stats')
+def stats():
+    """
+    Reports the render cache's size, hit and miss counts, evictions
+    and hit rate, the audio store's usage and the active model
+    version.
+
+    Outputs: JSON of cache (and augment batch) statistics.
+    """
+
+    stats = dict(render_cache.stats(), **audio_store.stats())
+    stats['model_version'] = model_loader.current.version
+
+    if augment_batcher is not None:
+        stats.update(augment_batcher.stats())
+
+    return flask.jsonify(stats)
+
+# load metrics
+@app.route('/metrics')
+def get_metrics():
+    """
+    Reports request latencies, per-stage timings and model lookup
+    counts (see metrics above). With pre-forked workers, each
+    worker keeps its own, and reports them under its pid.
+
+    Outputs: Prometheus text, or 404 if metrics are off.
+    """
+
+    if not metrics.enabled:
+        flask.abort(404)
+
+    return flask.Response(metrics.render(worker = os.getpid()),
+                          mimetype = 'text/plain; version=0.0.4')
 
-    return flask.jsonify({'id': rand_id})
 
 # load augment page
 @app.route('/augment', methods = ['POST'])
 def augment():
     """
     Pulls in note events from javascript, and interpolates
-    the missing notes via note_interpolater methods.
+    the missing notes via note_interpolater methods. An optional
+    'seed' in the JSON replays an earlier augmentation exactly
+    (with the same model version); the seed used and the model
+    version are always sent back with the notes. If 'rhythm'
+    is set, the rhythm chains first choose which empty steps get 
+    a note, instead of filling every one of them. With batching
+    on, the grid is filled together with any other grids submitted
+    at the same time, with the same result for a given seed.
 
     Inputs: No direct arguments, but ...
-    Pulls in JSON note positions via flask
+    Pulls in JSON note positions (and optional seed, rhythm flag
+    and grid layout, see get_grid) via flask
 
-    Outputs: New JSON of notes.
+    Outputs: New JSON of notes, with the seed and model version used.
     """
     
     data = flask.request.json
+    models = model_loader.current
 
-    new_notes = ''
+    data['seed'] = get_seed(data)
+    rng = notei.make_rng(data['seed'])
 
-    note_stack, to_fill = notei.make_note_stack(data['notes'])
+    steps, pitch_offset = get_grid(data)
 
-    for i in to_fill:
-        if i < max_length:
-            new_note = notei.get_note_to_append(melody_marks, 
-                                                note_stack
-                                                [0: 
-                                                 i + max_length + 1],
-                                                melody_weights, 
-                                                max_length)
-        else:
-            new_note = notei.get_note_to_append(melody_marks, 
-                                                note_stack
-                                                [i - max_length : 
-                                                 i + max_length + 1],
-                                                melody_weights, 
-                                                max_length)
+    with metrics.timer('levelup_stage_seconds', route = 'augment',
+                       stage = 'parse'):
+        note_stack, to_fill = parse_grid(data, steps, pitch_offset)
+
+    if data.get('rhythm'):
+        with metrics.timer('levelup_stage_seconds', route = 'augment',
+                           stage = 'rhythm'):
+            steps = [i for i, notes in note_stack if notes != ['x']]
+            to_fill = rhyi.choose_grid_steps(models.rhythm_tables, steps,
+                                             models.rhythm_weights,
+                                             models.max_len, rng)
 
-        new_notes += (',' + str(i) + ',' + str(72 - new_note))
-        
-        note_stack = (note_stack[:i] + 
-                      [(i, [new_note])] + 
-                      note_stack[i + 1:])
+    job = (models, note_stack, to_fill, rng)
 
-    data['notes'] += new_notes
+    # with batching on, this includes the wait for the batch
+    with metrics.timer('levelup_stage_seconds', route = 'augment',
+                       stage = 'interpolate'):
+        if augment_batcher is not None:
+            added = augment_batcher.submit(job)
+        else:
+            added = resolve_augments([job])[0]
+
+    data['notes'] += ''.join([',' + str(i) + ',' + 
+                              str(pitch_offset - new_note)
+                              for i, new_note in added])
+    data['model_version'] = models.version
 
     return flask.jsonify(data)
 
 
-app.run(host='0.0.0.0', port=5000)
+def main(*args):
+    """
+    Serves the app. By default this is Flask's own single-process
+    server; with --workers N, the models loaded above are shared by
+    N pre-forked worker processes (see prefork.py), each handling
+    up to --threads requests at once. Either way, a lock on the pid
+    file keeps a second copy from starting, so this can safely be
+    re-run from cron. Send the pre-fork master SIGHUP to restart
+    its workers gracefully, or SIGTERM to shut down. New model
+    bundles are picked up while running (see model_loader.py).
+    """
+
+    parser = argparse.ArgumentParser(description = 'Serves the piano roll.')
+    parser.add_argument('--host', default = '0.0.0.0')
+    parser.add_argument('--port', type = int, default = 5000)
+    parser.add_argument('--workers', type = int, default = 0,
+                        help = 'pre-forked worker processes (0 to use '
+                        'the Flask development server)')
+    parser.add_argument('--threads', type = int, default = 8,
+                        help = 'request threads per worker')
+    parser.add_argument('--pidfile',
+                        default = absolute_path + 'play_notes.pid')
+    opts = parser.parse_args(args[1:])
+
+    if opts.workers > 0:
+        # each worker keeps its own store, so every render goes to a
+        # directory they share, letting any worker serve /audio
+        if audio_store.spill_dir is None:
+            audio_store.set_spill_dir(render_dir, 0)
+        # the master watches for new model bundles and, once one is
+        # loaded, restarts the workers gracefully so that they share
+        # the new models as they shared the old; a SIGHUP from an
+        # operator picks up any waiting bundle too, but without
+        # signalling a second restart
+        model_loader.on_swap = lambda models: os.kill(os.getpid(),
+                                                      signal.SIGHUP)
+        model_loader.start(reload_interval)
+        prefork.serve(app, opts.host, opts.port, opts.workers, opts.threads,
+                      opts.pidfile,
+                      on_restart = lambda: model_loader.check(notify = False))
+    else:
+        lock = prefork.acquire_pidfile(opts.pidfile)
+        model_loader.start(reload_interval)
+        app.run(host = opts.host, port = opts.port)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
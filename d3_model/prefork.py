@@ -0,0 +1,320 @@
+##########################################################
+### prefork.py -- serves a WSGI app from N pre-forked  ###
+### worker processes, each with a fixed pool of thread ###
+### workers. Anything loaded before serve is called    ###
+### (e.g. the Markov models) is shared copy-on-write.  ###
+##########################################################
+
+import os
+import sys
+import gc
+import time
+import errno
+import fcntl
+import signal
+import socket
+import threading
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def acquire_pidfile(path):
+    """
+    Takes an exclusive lock on a pid file and writes our pid to it,
+    so that a second copy of the server exits instead of starting.
+    The lock is released by the operating system when we exit.
+
+    Inputs: path is the pid file name
+
+    Outputs: the open (locked) file object, which must be kept
+    """
+
+    f = open(path, 'a+')
+
+    # nothing the server starts with exec should hold the lock either
+    flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.seek(0)
+        print ("Already running (pid " + f.read().strip() + "), exiting.")
+        sys.exit(1)
+
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()) + '\n')
+    f.flush()
+
+    return f
+
+
+def bind_socket(host, port, backlog = 128):
+    """
+    Opens the listening socket shared by every worker. Binding fails
+    if anything else already holds the port.
+
+    Inputs:
+    host is the interface to listen on
+    port is the port number
+
+    Outputs: socket object
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+
+    return sock
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    A WSGI server on an already-listening socket, handing requests
+    to a fixed number of threads through a queue.
+    """
+
+    def __init__(self, sock, app, threads):
+        """
+        Inputs:
+        sock is a listening socket object
+        app is a WSGI application
+        threads is the number of request threads
+
+        Outputs: PooledWSGIServer object
+        """
+
+        WSGIServer.__init__(self, sock.getsockname(), WSGIRequestHandler,
+                            bind_and_activate = False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(sock.getsockname()[0])
+        self.server_port = sock.getsockname()[1]
+        self.setup_environ()
+        self.set_app(app)
+
+        self.requests = queue.Queue()
+        self.threads = [threading.Thread(target = self.handle_requests)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def handle_requests(self):
+        """
+        Thread loop: handles queued requests until given None.
+        """
+
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def drain(self):
+        """
+        Lets the threads finish every queued request, then stops them.
+        """
+
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def run_worker(app, sock, threads):
+    """
+    Body of one worker process: serves until sent SIGTERM, then
+    finishes the requests it already accepted and exits.
+    """
+
+    server = PooledWSGIServer(sock, app, threads)
+
+    def stop(signum, frame):
+        threading.Thread(target = server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    server.serve_forever()
+    server.drain()
+
+
+class Master(object):
+    """
+    Keeps N worker processes running on one shared socket.
+
+    SIGHUP restarts gracefully: a new set of workers is forked (after
+    calling on_restart, if given) and the old ones are told to finish
+    their in-flight requests and exit. SIGTERM or SIGINT does the
+    same without starting new workers, then exits. Workers that die
+    unexpectedly are replaced.
+    """
+
+    def __init__(self, app, sock, workers, threads, on_restart = None,
+                 lock = None):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.on_restart = on_restart
+        self.lock = lock
+        self.pids = set()
+        self.retiring = set()
+        self.signals = []
+
+    def spawn(self):
+        """
+        Forks one worker.
+        """
+
+        # keep everything loaded so far out of the garbage collector's
+        # way, so that collections in the workers don't touch (and so
+        # copy) the shared pages
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        pid = os.fork()
+
+        if pid == 0:
+            # the pid file lock is shared across fork, so workers let
+            # go of it; otherwise orphaned workers would keep a new
+            # master from starting after this one dies
+            if self.lock is not None:
+                self.lock.close()
+            status = 0
+            try:
+                run_worker(self.app, self.sock, self.threads)
+            except Exception:
+                status = 1
+            finally:
+                os._exit(status)
+
+        self.pids.add(pid)
+
+    def stop_workers(self, pids):
+        """
+        Sends SIGTERM to workers, which then exit once idle.
+        """
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def reap(self):
+        """
+        Collects exited workers.
+
+        Outputs: set of pids of current workers that exited
+        """
+
+        died = set()
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            if pid in self.pids:
+                self.pids.discard(pid)
+                died.add(pid)
+            self.retiring.discard(pid)
+
+        return died
+
+    def run(self):
+        """
+        Forks the workers and supervises them until told to stop.
+        """
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame:
+                          self.signals.append(signum))
+
+        for i in range(self.workers):
+            self.spawn()
+
+        print ("Serving on " + str(self.sock.getsockname()) + " with " +
+               str(self.workers) + " workers of " + str(self.threads) +
+               " threads each.")
+
+        while True:
+            time.sleep(0.2)
+
+            for pid in self.reap():
+                print ("Worker " + str(pid) + " exited, replacing it.")
+                self.spawn()
+
+            while len(self.signals) > 0:
+                signum = self.signals.pop(0)
+
+                if signum == signal.SIGHUP:
+                    print ("Restarting workers.")
+                    if self.on_restart is not None:
+                        self.on_restart()
+                    old = self.pids
+                    self.pids = set()
+                    self.retiring |= old
+                    for i in range(self.workers):
+                        self.spawn()
+                    self.stop_workers(old)
+                else:
+                    print ("Stopping workers.")
+                    self.retiring |= self.pids
+                    self.stop_workers(self.pids)
+                    self.pids = set()
+                    while len(self.retiring) > 0:
+                        time.sleep(0.2)
+                        self.reap()
+                    return
+
+
+def serve(app, host = '0.0.0.0', port = 5000, workers = 4, threads = 8,
+          pidfile = None, on_restart = None):
+    """
+    Serves app from pre-forked workers until SIGTERM or SIGINT.
+
+    Inputs:
+    app is a WSGI application, fully loaded
+    host and port are where to listen
+    workers is the number of worker processes
+    threads is the number of request threads per worker
+    pidfile is a pid file to lock (see acquire_pidfile), or None
+    on_restart is a function to call in the master before forking
+    new workers on SIGHUP, or None
+
+    Outputs: None
+    """
+
+    lock = acquire_pidfile(pidfile) if pidfile is not None else None
+
+    sock = bind_socket(host, port)
+
+    try:
+        Master(app, sock, workers, threads, on_restart, lock).run()
+    finally:
+        sock.close()
+        if lock is not None:
+            lock.close()
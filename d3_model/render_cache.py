@@ -0,0 +1,162 @@
+########################################################
+### render_cache.py -- remembers which audio id was  ###
+### rendered for each distinct grid, so that playing ###
+### the same grid again skips synthesis altogether.  ###
+########################################################
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(note_data, settings):
+    """
+    Builds a canonical hash for a note stack and the settings it is
+    rendered with. Steps are compared by position and their chords
+    as sorted integer pitches, so the order the notes were clicked
+    in (or float vs int pitches) doesn't matter.
+
+    Inputs:
+    note_data is a stacked sequence of notes (output from
+    note_interpolater.make_note_stack)
+    settings is a tuple of anything else that changes the audio,
+    e.g. the soundfont, program and sample rate
+
+    Outputs: hex digest string
+    """
+
+    canonical = [(int(tick), sorted([int(val) for val in notes]))
+                 for tick, notes in note_data if notes != ['x']]
+    canonical.append(len(note_data))
+
+    return hashlib.sha1(repr((canonical, tuple(settings))).encode(
+        'utf-8')).hexdigest()
+
+
+class RenderCache(object):
+    """
+    A thread-safe map from render keys to audio ids, with a cap on
+    the number of entries (least recently used go first) and a time
+    to live counted from when each entry was rendered. Evicted ids
+    are handed to on_evict so that their audio can be deleted.
+
+    An entry within margin seconds of its time to live is no longer
+    handed out, since its audio (kept for the same time) may be
+    gone before the client fetches it; the next render of its grid
+    replaces it.
+    """
+
+    def __init__(self, max_entries = 256, ttl = 300, on_evict = None,
+                 margin = 30):
+        """
+        Inputs:
+        max_entries is the largest number of renders to keep
+        ttl is the number of seconds a render is kept for
+        on_evict is a function of one audio id, or None
+        margin is the number of seconds before the time to live
+        that an entry stops being returned
+
+        Outputs: RenderCache object
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.margin = margin
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the audio id rendered for key, or None on a miss
+        (including an entry too close to its time to live).
+        """
+
+        with self.lock:
+            self.expire()
+            if key not in self.entries or not self.fresh(key):
+                self.misses += 1
+                return None
+            audio_id, created = self.entries.pop(key)
+            self.entries[key] = (audio_id, created)
+            self.hits += 1
+            return audio_id
+
+    def put(self, key, audio_id):
+        """
+        Records the audio id rendered for key, evicting the least
+        recently used entries if the cache is full. If another render
+        of the same grid was recorded meanwhile (e.g. by a concurrent
+        request), that one is kept, since its id may already have
+        been handed out; an entry too old to be returned is replaced
+        without evicting its audio, for the same reason.
+
+        Outputs: the audio id now recorded for key, which the caller
+        should return instead of its own if they differ
+        """
+
+        with self.lock:
+            if key in self.entries:
+                if self.fresh(key):
+                    return self.entries[key][0]
+                del self.entries[key]
+            self.entries[key] = (audio_id, time.time())
+            while len(self.entries) > self.max_entries:
+                self.evict(next(iter(self.entries)))
+            return audio_id
+
+    def fresh(self, key):
+        """
+        Tells whether an entry has more than margin seconds left to
+        live. Call with the lock held.
+        """
+
+        return self.entries[key][1] > time.time() - self.ttl + self.margin
+
+    def discard(self, key):
+        """
+        Drops key without counting an eviction, e.g. when its audio
+        has gone missing.
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def expire(self):
+        """
+        Evicts every entry older than the time to live. Call with 
+        the lock held.
+        """
+
+        cutoff = time.time() - self.ttl
+        for key in [key for key, (audio_id, created) in self.entries.items()
+                    if created < cutoff]:
+            self.evict(key)
+
+    def evict(self, key):
+        """
+        Removes one entry and hands its audio id to on_evict. Call
+        with the lock held.
+        """
+
+        audio_id, created = self.entries.pop(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(audio_id)
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache's counters and hit rate.
+        """
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.0}
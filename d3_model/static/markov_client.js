@@ -0,0 +1,173 @@
+// markov_client.js -- in-browser counterpart to note_interpolater.py.
+// Loads the melody models written by src/export_models.py and fills
+// in missing grid steps without a round-trip to /augment. The lookup
+// follows note_interpolater.get_mel_probs, and the sampling follows
+// note_interpolater.get_notes_to_append.
+
+
+// turn the exported lists into typed arrays and a lookup table
+// from each context (joined with commas) to its index
+function load_model(data) {
+    var models = {};
+
+    for (var m = 0; m < data.models.length; m++) {
+	var src = data.models[m];
+	var width = src.before + src.after;
+	var model = {
+	    before: src.before,
+	    after: src.after,
+	    weight: src.weight,
+	    recentered: src.recentered,
+	    offsets: new Uint32Array(src.offsets),
+	    pitches: new Int16Array(src.pitches),
+	    probs: new Uint16Array(src.probs),
+	    index: {}
+	};
+
+	for (var i = 0; i + 1 < src.offsets.length; i++) {
+	    model.index[src.keys.slice(i * width, (i + 1) * width).join(',')] = i;
+	}
+
+	models[src.before + ',' + src.after] = model;
+    }
+
+    return {max_len: data.max_len, models: models};
+}
+
+
+// weighted distribution over the 128 pitches for a note sequence
+// with exactly one 'x' in it (see note_interpolater.get_contexts)
+function get_mel_probs(model, notes) {
+    var mel_probs = new Float64Array(128);
+    var max_len = model.max_len;
+    var to_fill = notes.indexOf('x');
+
+    for (var before = 0; before <= max_len; before++) {
+	for (var after = 0; after <= max_len; after++) {
+	    if (before + after == 0 || before + after > max_len) continue;
+	    if (before > to_fill || after >= notes.length - to_fill) continue;
+
+	    var m = model.models[before + ',' + after];
+	    if (m === undefined) continue;
+
+	    var to_subtract = 0;
+	    if (m.recentered) {
+		to_subtract = before ? notes[to_fill - before] : notes[to_fill + 1];
+	    }
+
+	    var key = [];
+	    for (var k = to_fill - before; k < to_fill; k++) {
+		key.push(notes[k] - to_subtract);
+	    }
+	    for (var k = to_fill + 1; k <= to_fill + after; k++) {
+		key.push(notes[k] - to_subtract);
+	    }
+
+	    var i = m.index[key.join(',')];
+	    if (i === undefined) continue;
+
+	    for (var j = m.offsets[i]; j < m.offsets[i + 1]; j++) {
+		var pitch = m.pitches[j] + to_subtract;
+		if (pitch >= 0 && pitch < 128) {
+		    mel_probs[pitch] += m.probs[j] / 65535 * m.weight;
+		}
+	    }
+	}
+    }
+
+    return mel_probs;
+}
+
+
+// every single-note melody through a stack of chords, keeping only
+// the first 'x' (see note_interpolater.unstack_sequences)
+function unstack_sequences(stack) {
+    var seqs = [[]];
+    var seen_x = false;
+
+    for (var s = 0; s < stack.length; s++) {
+	var chord = stack[s];
+	if (chord.length == 1 && chord[0] == 'x') {
+	    if (seen_x) continue;
+	    seen_x = true;
+	}
+	var next = [];
+	for (var i = 0; i < seqs.length; i++) {
+	    for (var j = 0; j < chord.length; j++) {
+		next.push(seqs[i].concat([chord[j]]));
+	    }
+	}
+	seqs = next;
+    }
+
+    return seqs;
+}
+
+
+// pick a pitch for the 'x' in a window of chords: for each unstacked
+// melody, take 20 draws and keep one of the pitches hit, then choose
+// one of those at random; if no model knows any context, repeat one
+// of the window's own pitches
+function get_note_to_append(model, stack, random) {
+    random = random || Math.random;
+
+    var seqs = unstack_sequences(stack);
+    var candidates = [];
+
+    for (var s = 0; s < seqs.length; s++) {
+	var probs = get_mel_probs(model, seqs[s]);
+	var total = 0;
+	for (var p = 0; p < 128; p++) total += probs[p];
+	if (total == 0) continue;
+
+	var hits = [];
+	for (var d = 0; d < 20; d++) {
+	    var u = random() * total, acc = 0, pick = 127;
+	    for (var p = 0; p < 128; p++) {
+		acc += probs[p];
+		if (acc > u) { pick = p; break; }
+	    }
+	    if (hits.indexOf(pick) < 0) hits.push(pick);
+	}
+	candidates.push(hits[Math.floor(random() * hits.length)]);
+    }
+
+    if (candidates.length == 0) {
+	for (var s = 0; s < stack.length; s++) {
+	    for (var j = 0; j < stack[s].length; j++) {
+		if (stack[s][j] != 'x') candidates.push(stack[s][j]);
+	    }
+	}
+    }
+
+    if (candidates.length == 0) return null;
+
+    return candidates[Math.floor(random() * candidates.length)];
+}
+
+
+// fill every step listed in to_fill, left to right, looking max_len
+// steps to either side and skipping other empty steps (see
+// note_interpolater.augment_stacks); stack is a list of chords, one
+// per step, with ['x'] for empty steps; returns [step, pitch] pairs
+function augment(model, stack, to_fill, random) {
+    var max_len = model.max_len;
+    var added = [];
+
+    stack = stack.slice();
+
+    for (var f = 0; f < to_fill.length; f++) {
+	var i = to_fill[f];
+	var window = [];
+	for (var k = Math.max(0, i - max_len); k <= i + max_len && k < stack.length; k++) {
+	    var empty = stack[k].length == 1 && stack[k][0] == 'x';
+	    if (!empty || k == i) window.push(stack[k]);
+	}
+	var pitch = get_note_to_append(model, window, random);
+	if (pitch === null) continue;
+	stack[i] = [pitch];
+	added.push([i, pitch]);
+    }
+
+    return added;
+}
@@ -0,0 +1,269 @@
+######################################################
+### benchmark.py -- times every stage of training  ###
+### the Markov chains, from parsing MIDI files to  ###
+### pickling the models, on a synthetic corpus     ###
+### (see synth_corpus.py), and compares the times  ###
+### against a stored baseline to catch slowdowns.  ###
+######################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import argparse
+import midi_funcs as midf
+import markov_funcs as markf
+import synth_corpus as synth
+from collections import OrderedDict
+
+
+def peak_rss_mb():
+    """
+    Returns this process's peak resident set size so far, in MB.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / 2.0 ** 20
+
+    return peak / 2.0 ** 10
+
+
+class StageTimer(object):
+    """
+    Adds up the time spent in each named stage, and notes the peak
+    memory use at the end of each.
+    """
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self.rss = OrderedDict()
+
+    def time(self, stage, func, *args):
+        """
+        Calls func(*args), adding its run time to stage.
+
+        Outputs: whatever func returns
+        """
+
+        start = time.time()
+        result = func(*args)
+        self.seconds[stage] = (self.seconds.get(stage, 0.0) +
+                               time.time() - start)
+        self.rss[stage] = peak_rss_mb()
+
+        return result
+
+
+def run_pipeline(midi_dir, pickle_dir, max_order = 2, level = 1,
+                 buffer_limit = None, separate = None, max_voices = 4,
+                 relative = False):
+    """
+    Runs the training pipeline of markov_funcs.make_all_chains one
+    stage at a time, timing each: parse, flatten, channel mapping,
+    extraction, quantize, training of each chain (by kind and
+    order) and serialization.
+
+    Inputs:
+    midi_dir is the directory of MIDI files to train on
+    pickle_dir is where to write the pickles
+    max_order is the largest combined order of chain to train
+    level is the rhythm quantization level (see markov_funcs.myround)
+    buffer_limit is as in markov_funcs.train_chain, to time counting
+    on disk (the runs are spilled next to the pickles)
+    separate and max_voices are as in midi_funcs.get_sequences
+    relative is as in markov_funcs.train_chain (melody chains only)
+
+    Outputs: dictionary of the number of files and events, and the
+    seconds and peak RSS (in MB) at the end of each stage
+    """
+
+    timer = StageTimer()
+    files = midf.get_midi_list(midi_dir)
+
+    patterns = [timer.time('parse', midf.get_midi_file, f) for f in files]
+    events = sum([len(track) for pattern in patterns for track in pattern])
+
+    melodies, rhythms = [], []
+
+    for pattern in patterns:
+        flat = timer.time('flatten', midf.make_one_track, pattern)
+        mapping = timer.time('channel_mapping', midf.get_channel_mapping,
+                             flat)
+        mels, rhys = timer.time('extract', midf.get_sequences, flat, mapping,
+                                separate, max_voices)
+        melodies += mels
+        rhythms += rhys
+
+    rhythms = timer.time('quantize', markf.quantize, rhythms, level)
+
+    for kind, seqs, iterate in [('melody', melodies, markf.iterate_melody),
+                                ('rhythm', rhythms, markf.iterate_rhythm)]:
+        for before, after, mode in markf.get_orders(max_order):
+            stage = 'train_' + kind + '_' + str(before) + str(after)
+            mark = timer.time(stage, markf.train_chain, seqs, before,
+                              after, mode, iterate, buffer_limit, pickle_dir,
+                              relative and kind == 'melody')
+            timer.time('serialize', markf.save_chain, mark, kind, pickle_dir)
+
+    return {'files': len(files),
+            'events': events,
+            'seconds': timer.seconds,
+            'rss_mb': timer.rss}
+
+
+def best_of(results):
+    """
+    Combines repeated runs, keeping each stage's fastest time (the
+    one least disturbed by anything else running).
+
+    Inputs: list of outputs of run_pipeline
+
+    Outputs: one output of run_pipeline, with totals and rates added
+    """
+
+    report = dict(results[0])
+    report['seconds'] = OrderedDict(
+        [(stage, min([r['seconds'][stage] for r in results]))
+         for stage in results[0]['seconds']])
+    report['rss_mb'] = results[-1]['rss_mb']
+
+    total = sum(report['seconds'].values())
+    report['total_seconds'] = total
+    report['files_per_sec'] = report['files'] / total if total else 0.0
+    report['events_per_sec'] = report['events'] / total if total else 0.0
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    return report
+
+
+def compare(report, baseline, tolerance = .2, floor = .01):
+    """
+    Finds the stages that got slower than in a baseline report.
+
+    Inputs:
+    report and baseline are outputs of best_of
+    tolerance is the fraction slower a stage may get, e.g. .2
+    floor is a difference in seconds too small to count
+
+    Outputs: list of (stage, baseline seconds, new seconds) for
+    every stage slower by more than both tolerance and floor
+    """
+
+    slower = []
+
+    for stage, seconds in report['seconds'].items():
+        if stage not in baseline['seconds']:
+            continue
+        old = baseline['seconds'][stage]
+        if seconds > old * (1 + tolerance) and seconds - old > floor:
+            slower.append((stage, old, seconds))
+
+    return slower
+
+
+def print_report(report, baseline = None):
+    """
+    Prints every stage's time and memory, with the change from the
+    baseline if one is given.
+    """
+
+    print ("\n%-20s %10s %10s %10s" % ('stage', 'seconds', 'rss (MB)',
+                                       'vs base'))
+
+    for stage, seconds in report['seconds'].items():
+        change = ''
+        if baseline is not None and stage in baseline['seconds']:
+            old = baseline['seconds'][stage]
+            change = '%+.0f%%' % (100 * (seconds - old) / old) if old else ''
+        print ("%-20s %10.4f %10.1f %10s" % (stage, seconds,
+                                             report['rss_mb'][stage], change))
+
+    print ("\n" + str(report['files']) + " files, " + str(report['events']) +
+           " events in %.3f seconds" % report['total_seconds'])
+    print ("%.1f files/sec, %.0f events/sec, peak RSS %.1f MB" %
+           (report['files_per_sec'], report['events_per_sec'],
+            report['peak_rss_mb']))
+
+    if baseline is not None:
+        print ("baseline: %.1f files/sec, %.0f events/sec, peak RSS %.1f MB" %
+               (baseline['files_per_sec'], baseline['events_per_sec'],
+                baseline['peak_rss_mb']))
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Times the training pipeline on a synthetic corpus.')
+    parser.add_argument('--midi-dir', default = None,
+                        help = 'train on these files instead of a '
+                        'synthetic corpus')
+    synth.add_corpus_args(parser)
+    parser.add_argument('--max-order', type = int, default = 2)
+    parser.add_argument('--level', type = int, default = 1)
+    parser.add_argument('--buffer-limit', type = int, default = None,
+                        help = 'count on disk, spilling every this many '
+                        'distinct windows')
+    parser.add_argument('--separate', default = None,
+                        choices = midf.separations,
+                        help = 'split melodies into monophonic voices')
+    parser.add_argument('--max-voices', type = int, default = 4)
+    parser.add_argument('--relative', action = 'store_true',
+                        help = 'train every melody order on intervals')
+    parser.add_argument('--repeat', type = int, default = 1,
+                        help = 'runs to take the fastest of')
+    parser.add_argument('--baseline', default = None,
+                        help = 'JSON report to compare against')
+    parser.add_argument('--save', default = None,
+                        help = 'write the report here, e.g. as a new '
+                        'baseline')
+    parser.add_argument('--tolerance', type = float, default = .2)
+    opts = parser.parse_args(args[1:])
+
+    work_dir = tempfile.mkdtemp(prefix = 'levelup_bench_')
+
+    try:
+        midi_dir = opts.midi_dir
+        if midi_dir is None:
+            midi_dir = os.path.join(work_dir, 'midi')
+            synth.make_corpus(midi_dir, **synth.corpus_kwargs(opts))
+
+        pickle_dir = os.path.join(work_dir, 'pickles/')
+        os.makedirs(pickle_dir)
+
+        report = best_of([run_pipeline(midi_dir, pickle_dir, opts.max_order,
+                                       opts.level, opts.buffer_limit,
+                                       opts.separate, opts.max_voices,
+                                       opts.relative)
+                          for i in range(opts.repeat)])
+    finally:
+        shutil.rmtree(work_dir)
+
+    report['settings'] = vars(opts)
+
+    baseline = None
+    if opts.baseline is not None:
+        with open(opts.baseline, 'r') as f:
+            baseline = json.load(f, object_pairs_hook = OrderedDict)
+
+    print_report(report, baseline)
+
+    if opts.save is not None:
+        with open(opts.save, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print ("\nReport written to " + opts.save + ".")
+
+    if baseline is not None:
+        slower = compare(report, baseline, opts.tolerance)
+        for stage, old, new in slower:
+            print ("SLOWER: %s took %.4f s, was %.4f s" % (stage, new, old))
+        if len(slower) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,134 @@
+#######################################################
+### context_index.py -- neighbour indexes over the  ###
+### contexts stored in melodic Markov chains, so an ###
+### unseen context can fall back on the most similar ###
+### stored contexts instead of contributing nothing. ###
+#######################################################
+
+from collections import defaultdict
+import markov_sequences as marks
+
+
+def flatten_key(key, mode):
+    """
+    Turns a state_dict key into one flat tuple of pitches.
+
+    Inputs:
+    key is a state_dict key of a Markov object
+    mode is the mode of that Markov object
+
+    Outputs: tuple of pitches
+    """
+
+    if mode == 2:
+        return tuple(key[0]) + tuple(key[1])
+
+    return tuple(key)
+
+
+def unflatten_key(flat, before, mode):
+    """
+    Inverse of flatten_key.
+
+    Inputs:
+    flat is a tuple of pitches
+    before is the number of pitches before the note to fill
+    mode is the mode of the Markov object
+
+    Outputs: state_dict key
+    """
+
+    if mode == 2:
+        return (tuple(flat[:before]), tuple(flat[before:]))
+
+    return tuple(flat)
+
+
+class ContextIndex(object):
+    """
+    A neighbour index over the contexts of one Markov object. Every
+    stored context of two or more pitches is bucketed under each of
+    its one-wildcard patterns, so that all stored contexts one
+    substitution away from a query can be found with one bucket
+    lookup per position, rather than by scanning the state_dict.
+    """
+
+    def __init__(self, mark):
+        """
+        Builds the buckets for a Markov object.
+
+        Inputs: mark is a markov_sequences.Markov object
+
+        Outputs: ContextIndex object
+        """
+
+        self.mark = mark
+        self.before = mark.before
+        self.mode = mark.mode
+        self.recentered = marks.is_recentered(mark)
+        self.buckets = defaultdict(list)
+
+        for key in mark.state_dict:
+            flat = flatten_key(key, self.mode)
+            if len(flat) < 2:
+                continue
+            for pos in range(len(flat)):
+                self.buckets[flat[:pos] + (None,) + flat[pos + 1:]].append(key)
+
+    def neighbours(self, key):
+        """
+        Finds the stored contexts nearest to a (usually unseen) key.
+        For contexts of absolute pitches, the key transposed by one
+        semitone either way is tried first. Failing that, the stored
+        contexts one substitution away are found, and those whose
+        substituted pitch is closest to the query's are kept.
+
+        Inputs: key is a state_dict key
+
+        Outputs: list of 2-tuples of (stored key, pitch shift), where
+        pitch shift is to be added onto the stored key's results
+        """
+
+        flat = flatten_key(key, self.mode)
+        d = self.mark.state_dict
+
+        if not self.recentered:
+            found = []
+            for shift in (-1, 1):
+                shifted = unflatten_key(tuple([x + shift for x in flat]),
+                                        self.before, self.mode)
+                if shifted in d:
+                    found.append((shifted, -shift))
+            if len(found) > 0:
+                return found
+
+        if len(flat) < 2:
+            return []
+
+        best, found = None, []
+
+        for pos in range(len(flat)):
+            pattern = flat[:pos] + (None,) + flat[pos + 1:]
+            for stored in self.buckets.get(pattern, []):
+                dist = abs(flatten_key(stored, self.mode)[pos] - flat[pos])
+                if dist == 0:
+                    continue
+                if best is None or dist < best:
+                    best, found = dist, [(stored, 0)]
+                elif dist == best:
+                    found.append((stored, 0))
+
+        return found
+
+
+def build_indexes(marks):
+    """
+    Builds a ContextIndex for every Markov object in a dictionary.
+
+    Inputs: marks is a dictionary of (before, after) -> Markov objects
+
+    Outputs: dictionary of (before, after) -> ContextIndex objects
+    """
+
+    return dict([(order, ContextIndex(mark))
+                 for order, mark in marks.items()])
@@ -0,0 +1,106 @@
+######################################################
+### export_models.py -- writes the melodic Markov  ###
+### chains as one compact JSON file that a browser ###
+### can load into typed arrays and interpolate     ###
+### from (see d3_model/static/markov_client.js).   ###
+######################################################
+
+import sys
+import json
+import markov_funcs as markf
+import markov_sequences as marks
+import context_index as ci
+
+
+def export_melody_models(melody_marks, weights, max_len = 2,
+                         pitch_min = 48, pitch_max = 72):
+    """
+    Flattens every melodic Markov chain into parallel integer lists,
+    pruned to the pitches the web app's grid can show. For each
+    chain, the contexts' pitches are laid end to end in 'keys'; the
+    results of context i are pitches[offsets[i]:offsets[i + 1]],
+    with probabilities in probs (scaled to integers out of 65535).
+
+    Contexts of absolute pitches are kept only if all of their
+    pitches lie in [pitch_min, pitch_max]; recentered contexts (of
+    combined order 3 or more, or of any order in a chain built
+    relative) only if all of their intervals fit within that span.
+    Results are pruned the same way. Chains with weight 0 are left
+    out altogether.
+
+    Inputs:
+    melody_marks is a dictionary of Markov objects
+    weights is a dictionary of weights for each model
+    max_len is the maximum order length for the set of markov chains
+    pitch_min and pitch_max are the lowest and highest grid pitches
+
+    Outputs: dictionary ready to be written as JSON
+    """
+
+    span = pitch_max - pitch_min
+    models = []
+
+    for (before, after), mark in sorted(melody_marks.items()):
+        if weights[(before, after)] == 0:
+            continue
+
+        recentered = marks.is_recentered(mark)
+
+        if recentered:
+            fits = lambda x: -span <= x <= span
+        else:
+            fits = lambda x: pitch_min <= x <= pitch_max
+
+        keys, offsets, pitches, probs = [], [0], [], []
+
+        for key, dist in sorted(mark.state_dict.items()):
+            flat = ci.flatten_key(key, mark.mode)
+            kept = [(int(pitch), val) for pitch, val in sorted(dist.items())
+                    if fits(pitch)]
+            if not all([fits(x) for x in flat]) or len(kept) == 0:
+                continue
+            keys += [int(x) for x in flat]
+            pitches += [pitch for pitch, val in kept]
+            probs += [int(round(val * 65535)) for pitch, val in kept]
+            offsets.append(len(pitches))
+
+        models.append({'before': before,
+                       'after': after,
+                       'weight': weights[(before, after)],
+                       'recentered': recentered,
+                       'keys': keys,
+                       'offsets': offsets,
+                       'pitches': pitches,
+                       'probs': probs})
+
+    return {'version': 1,
+            'max_len': max_len,
+            'pitch_min': pitch_min,
+            'pitch_max': pitch_max,
+            'models': models}
+
+
+def dumps(export):
+    """
+    Serializes an export without any whitespace.
+    """
+
+    return json.dumps(export, separators = (',', ':'), sort_keys = True)
+
+
+def main(*args):
+    try:
+        pickle_dir, out_file = args[1], args[2]
+    except IndexError:
+        pickle_dir, out_file = '../pickles/', '../d3_model/static/model.json'
+
+    melody_marks, _, melody_weights, _ = markf.load_chains(pickle_dir)
+
+    with open(out_file, 'w') as f:
+        f.write(dumps(export_melody_models(melody_marks, melody_weights)))
+
+    print ("\nMelody models exported to " + out_file + ".")
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
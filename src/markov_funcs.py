@@ -12,6 +12,7 @@ import midi_funcs as midf
 import markov_sequences as marks
 import itertools
 import pickle
+import json
 import random
 from math import modf
 from bisect import bisect
@@ -106,12 +107,13 @@ def iterate_melody(mel, mark):
     
     before, after = mark.before, mark.after
     full_length = before + after + 1
+    recentered = marks.is_recentered(mark)
     for i in range(len(mel) - full_length):
         for seq in itertools.product(*mel[i:i + full_length]):
             before_seq = seq[:before]
             after_seq = seq[-after:]
             val = seq[before]
-            if full_length > 3:
+            if recentered:
                 before_seq, after_seq, val = recenter(before_seq, 
                                                       after_seq, 
                                                       val)
@@ -186,19 +188,17 @@ def recenter(before, after, val):
             round(val - to_subtract, 4))
 
 
-def make_melody_chains(mels, max_order = 2):
+def get_orders(max_order = 2):
     """
-    Create pickled Markov Chain melody models with a 
-    limit on the order.
+    Lists every (before, after, mode) combination of Markov chain
+    up to the given combined order.
 
-    Inputs: 
-    mels is the list of melody lists
-    max_order is the largest 'previous state' to allow
+    Inputs: max_order is the largest 'previous state' to allow
 
-    Outputs:
-    None (pickles files)
+    Outputs: list of 3-tuples of integers
     """
 
+    orders = []
     for before in range(max_order + 1):
         for after in range(max_order + 1):
             if before + after > max_order:
@@ -211,16 +211,113 @@ def make_melody_chains(mels, max_order = 2):
                 mode = 0
             else:
                 mode = 2
-            mark = marks.Markov(before, after, mode)
-            for k in range(len(mels)):
-                iterate_melody(mels[k], mark)
-            mark.normalize()
-            with open("../pickles/markov_melody_" + str(before) + str(after) 
-                      + str(mode) + ".pkl", "w") as f:
-                pickle.dump(mark, f)
+            orders.append((before, after, mode))
+
+    return orders
+
+
+def train_chain(seqs, before, after, mode, iterate, buffer_limit = None,
+                spill_dir = None, relative = False):
+    """
+    Trains and normalizes one Markov chain.
+
+    Inputs:
+    seqs is the list of melody or rhythm lists
+    before, after and mode are as in markov_sequences.Markov
+    iterate is iterate_melody or iterate_rhythm
+    buffer_limit is None to count in memory, or the most distinct
+    (state, next state) pairs to hold in memory before spilling
+    them to disk (see markov_sequences.ExternalMarkov)
+    spill_dir is where to spill to, or None for the system's
+    temporary directory
+    relative is True to recenter every melodic context, whatever
+    its order (see markov_sequences.is_recentered)
+
+    Outputs: markov_sequences.Markov object
+    """
+
+    if buffer_limit is None:
+        mark = marks.Markov(before, after, mode, relative)
+    else:
+        mark = marks.ExternalMarkov(before, after, mode, buffer_limit,
+                                    spill_dir, relative)
+    try:
+        for k in range(len(seqs)):
+            iterate(seqs[k], mark)
+        mark.normalize()
+    finally:
+        # don't leave spilled runs behind if counting fails
+        if buffer_limit is not None:
+            mark.discard_runs()
+
+    if buffer_limit is not None:
+        mark = mark.to_markov()
+
+    return mark
+
+
+def chain_filename(kind, before, after, mode):
+    """
+    Names the pickle of one Markov chain as load_chains expects,
+    e.g. markov_melody_112.pkl.
+
+    Inputs:
+    kind is 'melody' or 'rhythm'
+    before, after and mode are as for markov_sequences.Markov
+
+    Outputs: string file name (without a directory)
+    """
+
+    return ("markov_" + kind + "_" + str(before) + str(after) + str(mode) +
+            ".pkl")
+
+
+def save_chain(mark, kind, pickle_dir = '../pickles/'):
+    """
+    Pickles one Markov chain under the name load_chains expects,
+    e.g. markov_melody_112.pkl.
+
+    Inputs:
+    mark is a markov_sequences.Markov object
+    kind is 'melody' or 'rhythm'
+    pickle_dir is a string path name
+
+    Outputs: None (pickles file)
+    """
+
+    if pickle_dir[-1] != '/':
+        pickle_dir += '/'
 
+    with open(pickle_dir + chain_filename(kind, mark.before, mark.after,
+                                         mark.mode), "w") as f:
+        pickle.dump(mark, f)
 
-def make_rhythm_chains(rhys, max_order = 2):
+
+def make_melody_chains(mels, max_order = 2, pickle_dir = '../pickles/',
+                       buffer_limit = None, spill_dir = None,
+                       relative = False):
+    """
+    Create pickled Markov Chain melody models with a 
+    limit on the order.
+
+    Inputs: 
+    mels is the list of melody lists
+    max_order is the largest 'previous state' to allow
+    pickle_dir is where to write the pickles
+    buffer_limit, spill_dir and relative are as in train_chain
+
+    Outputs:
+    None (pickles files)
+    """
+
+    for before, after, mode in get_orders(max_order):
+        save_chain(train_chain(mels, before, after, mode, iterate_melody,
+                               buffer_limit, spill_dir, relative),
+                   'melody', pickle_dir)
+
+
+def make_rhythm_chains(rhys, max_order = 2, pickle_dir = '../pickles/',
+                       buffer_limit = None, spill_dir = None):
     """
     Create pickled Markov Chain rhythm models with a 
     limit on the order.
@@ -228,53 +325,107 @@ def make_rhythm_chains(rhys, max_order = 2):
     Inputs: 
     rhys is the list of rhythm lists
     max_order is the largest 'previous state' to allow
+    pickle_dir is where to write the pickles
+    buffer_limit and spill_dir are as in train_chain
 
     Outputs:
     None (pickles files)
     """
     
-    for before in range(max_order + 1):
-        for after in range(max_order + 1):
-            if before + after > max_order:
-                continue
-            if before == 0:
-                if after == 0:
-                    continue
-                mode = 1
-            elif after == 0:
-                mode = 0
-            else:
-                mode = 2
-            mark = marks.Markov(before, after, mode)
-            for k in range(len(rhys)):
-                iterate_rhythm(rhys[k], mark)
-            mark.normalize()
-            with open("../pickles/markov_rhythm_" + str(before) + str(after)
-                      + str(mode) + ".pkl", "w") as f:
-                pickle.dump(mark, f)
+    for before, after, mode in get_orders(max_order):
+        save_chain(train_chain(rhys, before, after, mode, iterate_rhythm,
+                               buffer_limit, spill_dir),
+                   'rhythm', pickle_dir)
 
 
-def make_all_chains(midi_path = '../midi/'):
+def make_all_chains(midi_path = '../midi/', pickle_dir = '../pickles/',
+                    buffer_limit = None, spill_dir = None, separate = None,
+                    max_voices = 4, relative = False):
     """
     Calls up midi files from the given path and converts the
     streams into Markov Chains.
 
-    Inputs: midi_path is a string path name
+    Inputs: 
+    midi_path is a string path name
+    pickle_dir is where to write the pickles
+    buffer_limit and spill_dir are as in train_chain, for corpora
+    too large to count in memory
+    separate and max_voices are as in midi_funcs.get_sequences, to
+    train the melody chains on monophonic voices
+    relative is True to store every melody chain's contexts as
+    intervals (see train_chain), shrinking the low orders
 
     Outputs: None
     """
 
     midi_list = midf.get_midi_list(midi_path)
-    melodies, rhythms = midf.extract_all_sequences(midi_list)
+    melodies, rhythms = midf.extract_all_sequences(midi_list, separate,
+                                                   max_voices)
     
-    make_melody_chains(melodies)
-    print "\nMelody Markov chains serialized to midi_levelUp/pickles."
+    make_melody_chains(melodies, pickle_dir = pickle_dir,
+                       buffer_limit = buffer_limit, spill_dir = spill_dir,
+                       relative = relative)
+    print "\nMelody Markov chains serialized to " + pickle_dir + "."
     
     rhythms = quantize(rhythms)
-    make_rhythm_chains(rhythms)
-    print "\nRhythm Markov chains serialized to midi_levelUp/pickles."
+    make_rhythm_chains(rhythms, pickle_dir = pickle_dir,
+                       buffer_limit = buffer_limit, spill_dir = spill_dir)
+    print "\nRhythm Markov chains serialized to " + pickle_dir + "."
     print
 
+def load_chains(pickle_dir = '../pickles/'):
+    """
+    Unpickles every Markov chain in the given directory, sorting
+    them into melody and rhythm models keyed by (before, after),
+    and initializes all of their weights to 1, or to the weights in
+    the directory's weights.json if it has one (see tune_weights.py).
+    A weight of 0 turns that model off.
+
+    Inputs: pickle_dir is a string path name
+
+    Outputs:
+    A 4-tuple of dictionaries: melody models, rhythm models, 
+    melody weights and rhythm weights.
+    """
+
+    if pickle_dir[-1] != '/':
+        pickle_dir += '/'
+
+    melody_marks, rhythm_marks = {}, {}
+    melody_weights, rhythm_weights = {}, {}
+
+    for f in os.listdir(pickle_dir):
+        # skip anything else kept alongside the chains, e.g. model
+        # bundle subdirectories (see d3_model/model_loader.py)
+        if not f.endswith('.pkl'):
+            continue
+        with open(pickle_dir + f, 'r') as g:
+            try:
+                mark = pickle.load(g)
+                key = tuple([mark.before, mark.after])
+                if f.startswith('markov_melody'):
+                    melody_marks[key] = mark
+                    melody_weights[key] = 1.0
+                elif f.startswith('markov_rhythm'):
+                    rhythm_marks[key] = mark
+                    rhythm_weights[key] = 1.0
+            except KeyError:
+                print ("There may have been a problem opening the " + 
+                       "pickled file " + f + ".") 
+
+    if os.path.exists(pickle_dir + 'weights.json'):
+        with open(pickle_dir + 'weights.json', 'r') as f:
+            tuned = json.load(f)
+        for kind, weights in [('melody', melody_weights), 
+                              ('rhythm', rhythm_weights)]:
+            for order, weight in tuned.get(kind, {}).items():
+                key = tuple([int(x) for x in order.split(',')])
+                if key in weights:
+                    weights[key] = float(weight)
+
+    return melody_marks, rhythm_marks, melody_weights, rhythm_weights
+
+
 def print_example():
     """
     A demo method that will unpickle one melodic Markov chain
@@ -7,12 +7,18 @@
 ########################################################
 
 
+import os
+import heapq
+import pickle
+import tempfile
+
+
 class Markov(object):
     """
     A container for holding Markov chains of various orders.
     """
     
-    def __init__(self, before = 0, after = 0, mode = 0):
+    def __init__(self, before = 0, after = 0, mode = 0, relative = False):
         """
         Initialize a Markov object with `before` notes before 
         the space to be filled, `after` notes after the space 
@@ -25,6 +31,9 @@ class Markov(object):
         before - int - number of notes before next state
         after - int - number of notes after next state
         mode - int in range(3) - mode of the chain(see above)
+        relative - bool - True to store every context relative 
+                   to its first note, whatever the chain's order 
+                   (see is_recentered)
         
         Outputs - Markov object
         """
@@ -39,8 +48,31 @@ class Markov(object):
         self.before = before
         self.after = after
         self.mode = mode
+        self.relative = relative
         self.state_dict = {}
         
+    def check_seq(self, seq):
+        """
+        Asserts that seq is a 'current state' of the right shape
+        for this chain's mode (see add_data).
+
+        Inputs: seq is as in add_data
+
+        Outputs: None
+        """
+
+        if self.mode == 0:
+            assert isinstance(seq, tuple) and len(seq) == self.before
+        elif self.mode == 1:
+            assert isinstance(seq, tuple) and len(seq) == self.after
+        else:
+            assert (isinstance(seq, tuple) and 
+                    len(seq) == 2 and
+                    isinstance(seq[0], tuple) and 
+                    len(seq[0]) == self.before and
+                    isinstance(seq[1], tuple) and 
+                    len(seq[1]) == self.after)
+
     def add_data(self, seq, result):
         """
         Add one (current state -> next state) instance to the 
@@ -59,17 +91,7 @@ class Markov(object):
         Outputs: None
         """
         
-        if self.mode == 0:
-            assert isinstance(seq, tuple) and len(seq) == self.before
-        elif self.mode == 1:
-            assert isinstance(seq, tuple) and len(seq) == self.after
-        else:
-            assert (isinstance(seq, tuple) and 
-                    len(seq) == 2 and
-                    isinstance(seq[0], tuple) and 
-                    len(seq[0]) == self.before and
-                    isinstance(seq[1], tuple) and 
-                    len(seq[1]) == self.after)
+        self.check_seq(seq)
             
         if seq not in self.state_dict:
             self.state_dict[seq] = {result: 1}
@@ -89,10 +111,253 @@ class Markov(object):
         """
         
         for seq in self.state_dict:
-            sum = 0
-            for result in self.state_dict[seq]:
-                sum += self.state_dict[seq][result]
-            for result in self.state_dict[seq]:
-                self.state_dict[seq][result] = round(self.state_dict[seq]
-                                                     [result] / float(sum),
-                                                     4)
+            normalize_counts(self.state_dict[seq])
+
+
+def is_recentered(mark):
+    """
+    Tells whether a melodic chain's contexts are stored relative to
+    their first note (see markov_funcs.recenter), so that transposed
+    copies of a pattern share one entry. Chains of combined order 3
+    or more always are; lower orders only if built with relative 
+    set. Chains pickled before the option existed have no relative 
+    attribute and count as False.
+
+    Inputs: mark is a Markov object
+
+    Outputs: boolean
+    """
+
+    return getattr(mark, 'relative', False) or mark.before + mark.after >= 3
+
+
+def normalize_counts(counts):
+    """
+    Converts one dictionary of tallies of next states into
+    probabilities, in place, each rounded to 4 decimal places.
+
+    Inputs: counts is a dictionary of next state -> tally
+
+    Outputs: None
+    """
+
+    sum = 0
+    for result in counts:
+        sum += counts[result]
+    for result in counts:
+        counts[result] = round(counts[result] / float(sum), 4)
+
+
+def read_run(filename):
+    """
+    Reads back the (key, tally) records of one sorted run written
+    by ExternalMarkov.spill, one at a time.
+
+    Inputs: filename is a string path name
+
+    Outputs: generator of 2-tuples
+    """
+
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class ExternalMarkov(Markov):
+    """
+    A Markov object that counts out of core, for corpora whose
+    count tables don't fit in memory. Tallies of (current state,
+    next state) pairs are buffered in memory up to buffer_limit
+    distinct pairs, then spilled to disk as a run sorted by pair.
+    normalize merges the runs (a k-way merge, reading each run
+    front to back once) into the usual state_dict, so the memory
+    used while counting stays capped however large the corpus.
+    Whenever merge_width runs of the same size pile up they are
+    merged into one run of the next level up, so that no more than
+    merge_width files are ever open at once and each tally is only
+    rewritten a logarithmic number of times.
+
+    Inherits from Markov.
+    """
+
+    merge_width = 64
+
+    def __init__(self, before = 0, after = 0, mode = 0, 
+                 buffer_limit = 1000000, spill_dir = None, relative = False):
+        """
+        Initialize as Markov, with an empty buffer and no runs.
+
+        Inputs:
+        before, after, mode and relative are as in Markov
+        buffer_limit - int - most distinct pairs to buffer before 
+                       spilling a run
+        spill_dir - string - directory to write runs in, or None 
+                    for the system's temporary directory
+
+        Outputs - ExternalMarkov object
+        """
+
+        super(ExternalMarkov, self).__init__(before, after, mode, relative)
+        self.buffer_limit = buffer_limit
+        self.spill_dir = spill_dir
+        self.buffer = {}
+        self.runs = []
+        self.levels = []
+
+    def add_data(self, seq, result):
+        """
+        Add one (current state -> next state) instance to the 
+        buffer, spilling it to disk if it is full.
+
+        Inputs: seq and result are as in Markov.add_data
+
+        Outputs: None
+        """
+
+        self.check_seq(seq)
+
+        key = (seq, result)
+        self.buffer[key] = self.buffer.get(key, 0) + 1
+
+        if len(self.buffer) >= self.buffer_limit:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the buffer to a new run file, sorted by key, and 
+        empty it.
+
+        Inputs: None
+
+        Outputs: None
+        """
+
+        if len(self.buffer) == 0:
+            return
+
+        self.write_run(sorted(self.buffer.items()), 0)
+        self.buffer = {}
+
+        width = self.merge_width
+        while (len(self.runs) >= width and 
+               len(set(self.levels[-width:])) == 1):
+            runs, level = self.runs[-width:], self.levels[-1]
+            # the merged runs stay listed until the new one is
+            # written, so that discard_runs finds them on failure
+            self.write_run(self.merge_runs(runs), level + 1)
+            del self.runs[-width - 1:-1]
+            del self.levels[-width - 1:-1]
+            for filename in runs:
+                os.remove(filename)
+
+    def write_run(self, records, level):
+        """
+        Write sorted (key, tally) records to a new run file.
+
+        Inputs: 
+        records - iterable of 2-tuples, in key order
+        level - int - number of merges the records have been through
+
+        Outputs: None
+        """
+
+        # not .pkl, so that a run left in a pickles directory is
+        # never mistaken for a chain by markov_funcs.load_chains
+        fd, filename = tempfile.mkstemp(prefix = 'levelup_run_', 
+                                        suffix = '.run', 
+                                        dir = self.spill_dir)
+        self.runs.append(filename)
+        self.levels.append(level)
+
+        with os.fdopen(fd, 'wb') as f:
+            for record in records:
+                pickle.dump(record, f, 2)
+
+    def merge_runs(self, runs, buffered = ()):
+        """
+        Merge runs (and any buffered records) into sorted 
+        (key, tally) records, adding up the tallies of equal keys.
+
+        Inputs: 
+        runs - list of run file names
+        buffered - sorted list of (key, tally) records
+
+        Outputs: generator of 2-tuples, in key order
+        """
+
+        streams = [read_run(filename) for filename in runs]
+        streams.append(iter(buffered))
+
+        key, tally = None, 0
+        for next_key, next_tally in heapq.merge(*streams):
+            if next_key == key:
+                tally += next_tally
+                continue
+            if tally > 0:
+                yield key, tally
+            key, tally = next_key, next_tally
+        if tally > 0:
+            yield key, tally
+
+    def normalize(self):
+        """
+        Merge the runs into state_dict, converting each state's 
+        tallies to probabilities as soon as they are all read 
+        (the merge brings them together), then delete the runs.
+
+        Inputs: None
+
+        Outputs: None
+        """
+
+        try:
+            seq, counts = None, None
+            for (next_seq, result), tally in self.merge_runs(
+                    self.runs, sorted(self.buffer.items())):
+                if counts is None or next_seq != seq:
+                    if counts is not None:
+                        normalize_counts(counts)
+                    seq, counts = next_seq, {}
+                    self.state_dict[seq] = counts
+                counts[result] = tally
+            if counts is not None:
+                normalize_counts(counts)
+        finally:
+            self.discard_runs()
+
+    def discard_runs(self):
+        """
+        Delete every run file and empty the buffer, e.g. after
+        normalizing, or when counting fails partway.
+
+        Inputs: None
+
+        Outputs: None
+        """
+
+        for filename in self.runs:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.runs = []
+        self.levels = []
+        self.buffer = {}
+
+    def to_markov(self):
+        """
+        Copy the chain into a plain Markov object, e.g. for 
+        pickling.
+
+        Inputs: None
+
+        Outputs: Markov object sharing this one's state_dict
+        """
+
+        mark = Markov(self.before, self.after, self.mode, self.relative)
+        mark.state_dict = self.state_dict
+
+        return mark
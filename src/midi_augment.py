@@ -0,0 +1,360 @@
+####################################################
+### midi_augment.py -- augments whole MIDI files ###
+### by finding gaps in each melodic channel and  ###
+### filling them with onsets from the rhythm     ###
+### chains and pitches from the melody chains.   ###
+### Can be run on whole directories at once.     ###
+####################################################
+
+import os
+import sys
+import argparse
+import zlib
+import multiprocessing
+import midi
+import midi_funcs as midf
+import midi_sequences as ms
+import markov_funcs as markf
+import note_interpolater as notei
+import rhythm_interpolater as rhyi
+import context_index as ci
+
+
+def find_gaps(onsets, min_gap = 1.0):
+    """
+    Finds the places in a quantized onset sequence where a new note
+    could be added, i.e. consecutive onsets at least min_gap apart.
+
+    Inputs:
+    onsets is a sorted list of quantized onset times in beats
+    min_gap is the smallest gap (in beats) worth filling
+
+    Outputs: list of indices i such that a new onset belongs
+    between onsets[i] and onsets[i + 1]
+    """
+
+    return [i for i in range(len(onsets) - 1)
+            if onsets[i + 1] - onsets[i] >= min_gap]
+
+
+def fill_onsets(rhythm_tables, onsets, gaps, weights, max_len, rng,
+                level = 1):
+    """
+    Picks one new onset inside each gap using the rhythm chains,
+    falling back to the quantized midpoint of the gap when no chain
+    suggests an onset that fits.
+
+    Inputs:
+    rhythm_tables is as returned by rhythm_interpolater.build_rhythm_tables
+    onsets is a sorted list of quantized onset times in beats
+    gaps is a list of indices as returned by find_gaps
+    weights is a dictionary of weights for each model
+    max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object
+    level is the quantization level (see markov_funcs.myround)
+
+    Outputs: list of new onsets in beats, one per gap
+    """
+
+    windows = [onsets[max(0, i + 1 - max_len):i + 1] + ['x'] +
+               onsets[i + 1:i + 1 + max_len] for i in gaps]
+    bounds = [(onsets[i], onsets[i + 1]) for i in gaps]
+
+    new_onsets = rhyi.sample_onsets(rhythm_tables, windows, weights,
+                                    max_len, rng, bounds)
+
+    for j, i in enumerate(gaps):
+        if new_onsets[j] is None:
+            new_onsets[j] = markf.myround((onsets[i] + onsets[i + 1]) / 2.0,
+                                          level)
+
+    return new_onsets
+
+
+def fill_pitches(melody_marks, chords, gaps, weights, max_len, rng,
+                 indexes = None):
+    """
+    Picks one new pitch for each gap in a channel's chord sequence
+    using the melody chains, all in one batched call.
+
+    Inputs:
+    melody_marks is a dictionary of melody Markov objects
+    chords is a list of lists of concurrent pitches
+    gaps is a list of indices as returned by find_gaps
+    weights is a dictionary of weights for each model
+    max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object
+    indexes is a dictionary of context_index.ContextIndex objects
+
+    Outputs: list of new pitches (or None), one per gap
+    """
+
+    stacks = []
+
+    for i in gaps:
+        before = chords[max(0, i + 1 - max_len):i + 1]
+        after = chords[i + 1:i + 1 + max_len]
+        stacks.append(list(enumerate(before + [['x']] + after)))
+
+    return notei.get_notes_to_append(melody_marks, stacks, weights,
+                                     max_len, rng, indexes)
+
+
+def is_melodic(instruments, channel):
+    """
+    Returns true iff a channel carries only melodic instruments,
+    using the same rule as midi_funcs.get_sequences.
+
+    Inputs:
+    instruments is a set of instruments, or None
+    channel is an integer channel number
+
+    Outputs: boolean True or False
+    """
+
+    return (instruments is not None and channel != 9 and
+            all([x in midf.melody_instruments for x in instruments]))
+
+
+def augment_pattern(mfile, models, max_len, rng, rhythm_tables = None,
+                    melody_indexes = None, min_gap = 1.0, level = 1,
+                    velocity = 80):
+    """
+    Adds new notes to every melodic channel of a MIDI pattern.
+
+    Inputs:
+    mfile is a midi.containers.Pattern object of any format
+    models is the 4-tuple returned by markov_funcs.load_chains
+    max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object
+    rhythm_tables is as returned by rhythm_interpolater.build_rhythm_tables
+    (built from models if None)
+    melody_indexes is as returned by context_index.build_indexes
+    (built from models if None)
+    min_gap is the smallest gap (in beats) worth filling
+    level is the quantization level (see markov_funcs.myround)
+    velocity is the velocity of the added notes
+
+    Outputs:
+    A 2-tuple of a new single-track midi.containers.Pattern object
+    and the number of notes added.
+    """
+
+    melody_marks, rhythm_marks, melody_weights, rhythm_weights = models
+
+    if rhythm_tables is None:
+        rhythm_tables = rhyi.build_rhythm_tables(rhythm_marks)
+    if melody_indexes is None:
+        melody_indexes = ci.build_indexes(melody_marks)
+
+    flat_file = midf.make_one_track(mfile)
+    mapping = midf.get_channel_mapping(flat_file)
+    res = flat_file.resolution
+
+    events = [event for event in flat_file[0]
+              if not isinstance(event, midi.EndOfTrackEvent)]
+    added = 0
+
+    for channel in mapping:
+        if not is_melodic(mapping[channel], channel):
+            continue
+
+        melody = ms.MelodySequence(resolution = res)
+        notes = midf.get_melody_sequence(melody, flat_file, channel).notes
+
+        if len(notes) < 2:
+            continue
+
+        chords = [chord for chord, tick in notes]
+        onsets = [markf.myround(float(tick) / res, level)
+                  for chord, tick in notes]
+
+        gaps = find_gaps(onsets, min_gap)
+
+        if len(gaps) == 0:
+            continue
+
+        new_onsets = fill_onsets(rhythm_tables, onsets, gaps,
+                                 rhythm_weights, max_len, rng, level)
+        new_pitches = fill_pitches(melody_marks, chords, gaps,
+                                   melody_weights, max_len, rng,
+                                   melody_indexes)
+
+        for i, onset, pitch in zip(gaps, new_onsets, new_pitches):
+            if pitch is None:
+                continue
+
+            on_tick = int(round(onset * res))
+            off_tick = max(on_tick + 1,
+                           min(on_tick + res, notes[i + 1][1]) - 1)
+
+            events.append(midi.NoteOnEvent(tick = on_tick,
+                                           channel = channel,
+                                           data = [pitch, velocity]))
+            events.append(midi.NoteOffEvent(tick = off_tick,
+                                            channel = channel,
+                                            data = [pitch, 0]))
+            added += 1
+
+    events = sorted(events, key = lambda x: x.tick)
+    end_tick = events[-1].tick if len(events) > 0 else 0
+    events.append(midi.EndOfTrackEvent(tick = end_tick))
+
+    track = midi.containers.Track(events = events, tick_relative = False)
+    pattern = midi.containers.Pattern(tracks = [track], resolution = res,
+                                      format = 0, tick_relative = False)
+    pattern.make_ticks_rel()
+
+    return pattern, added
+
+
+def augment_file(in_file, out_file, models, max_len, rng, **kwargs):
+    """
+    Reads one MIDI file, augments it, and writes the result.
+
+    Inputs:
+    in_file and out_file are file names with full path specified
+    models is the 4-tuple returned by markov_funcs.load_chains
+    max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object
+    kwargs are passed on to augment_pattern
+
+    Outputs: number of notes added
+    """
+
+    mfile = midf.get_midi_file(in_file)
+    pattern, added = augment_pattern(mfile, models, max_len, rng, **kwargs)
+    midi.write_midifile(out_file, pattern)
+
+    return added
+
+
+# models and settings for each worker process, loaded once
+# per process by init_worker
+_worker_state = {}
+
+
+def init_worker(pickle_dir, max_len, seed, kwargs):
+    """
+    Pool initializer: loads the Markov chains (and precomputes the
+    rhythm tables and melody indexes) once per worker.
+    """
+
+    models = markf.load_chains(pickle_dir)
+
+    _worker_state['models'] = models
+    _worker_state['kwargs'] = dict(kwargs, rhythm_tables = 
+                                   rhyi.build_rhythm_tables(models[1]),
+                                   melody_indexes = 
+                                   ci.build_indexes(models[0]))
+    _worker_state['max_len'] = max_len
+    _worker_state['seed'] = seed
+
+
+def augment_worker(paths):
+    """
+    Pool task: augments one file. The random seed is derived from
+    the file name, so results don't depend on which worker runs it.
+
+    Inputs: paths is a 2-tuple of input and output file names
+
+    Outputs: 3-tuple of input file name, notes added (or None on
+    failure) and an error message (or None)
+    """
+
+    in_file, out_file = paths
+    seed = (_worker_state['seed'] +
+            zlib.crc32(os.path.basename(in_file))) & 0xffffffff
+
+    try:
+        added = augment_file(in_file, out_file, _worker_state['models'],
+                             _worker_state['max_len'],
+                             notei.make_rng(seed),
+                             **_worker_state['kwargs'])
+        return in_file, added, None
+    except Exception as e:
+        return in_file, None, repr(e)
+
+
+def augment_directory(in_dir, out_dir, pickle_dir = '../pickles/',
+                      workers = None, max_len = 2, seed = 0,
+                      overwrite = False, **kwargs):
+    """
+    Augments every MIDI file in a directory with a pool of worker
+    processes. Files are handed out one at a time and results are
+    reported as they finish, so memory use doesn't grow with the
+    size of the library.
+
+    Inputs:
+    in_dir and out_dir are directory path names
+    pickle_dir is the directory of pickled Markov chains
+    workers is the number of processes (defaults to the CPU count)
+    max_len is the max order length of the set of Markov chains
+    seed is the base random seed
+    overwrite is False to skip files already in out_dir
+    kwargs are passed on to augment_pattern
+
+    Outputs: 2-tuple of the number of files augmented and failed
+    """
+
+    if out_dir[-1] != '/':
+        out_dir += '/'
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    jobs = []
+    for in_file in midf.get_midi_list(in_dir) or []:
+        out_file = out_dir + os.path.basename(in_file)
+        if overwrite or not os.path.exists(out_file):
+            jobs.append((in_file, out_file))
+
+    pool = multiprocessing.Pool(workers, init_worker,
+                                (pickle_dir, max_len, seed, kwargs))
+    done, failed = 0, 0
+
+    try:
+        for in_file, added, error in pool.imap_unordered(augment_worker,
+                                                         jobs):
+            if error is None:
+                done += 1
+                print ("Added " + str(added) + " notes to " + in_file)
+            else:
+                failed += 1
+                print ("Skipped " + in_file + ": " + error)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return done, failed
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Augment every MIDI file in a directory.')
+    parser.add_argument('in_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--pickles', default = '../pickles/')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--max-len', type = int, default = 2)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--min-gap', type = float, default = 1.0)
+    parser.add_argument('--level', type = int, default = 1)
+    parser.add_argument('--overwrite', action = 'store_true')
+    opts = parser.parse_args(args[1:])
+
+    done, failed = augment_directory(opts.in_dir, opts.out_dir,
+                                     opts.pickles, opts.workers,
+                                     opts.max_len, opts.seed,
+                                     opts.overwrite,
+                                     min_gap = opts.min_gap,
+                                     level = opts.level)
+
+    print ("\nAugmented " + str(done) + " files (" + str(failed) +
+           " skipped).")
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -14,6 +14,13 @@ import midi_sequences as ms
 # global list of which instruments actually play melodies
 melody_instruments = range(88) + range(104, 112)
 
+# widest interval (in semitones) a voice may leap in 'leading' voice
+# separation while there is still room to start a new voice instead
+voice_leap = 12
+
+# the ways separate_voices can split a channel into voices
+separations = ['top', 'bottom', 'skyline', 'leading']
+
 
 def is_midi(file_string):
     """
@@ -139,7 +146,6 @@ def get_melody_sequence(melody, mfile, channel):
             event.channel == channel and 
             event.data[1] != 0):
             melody.add_note((event.data[0], event.tick))
-    melody.notes = sorted(melody.notes, key = lambda x: x[1])
 
     return melody
     
@@ -165,13 +171,158 @@ def get_rhythm_sequence(rhythm, mfile, channel):
             event.channel == channel and 
             event.data[1] != 0):
             rhythm.add_tick(event.tick)
-    rhythm.ticks = sorted(rhythm.ticks)
     rhythm.ticks_to_beats()
 
     return rhythm
 
 
-def get_sequences(mfile, mapping):
+def get_note_spans(mfile, channel):
+    """
+    Lists every note played on the given channel in mfile, with
+    the ticks it starts and stops at. A note-off (or note-on with
+    velocity 0) ends the earliest sounding note of its pitch; a
+    note that never ends stops where it starts.
+
+    Inputs: 
+    mfile is a midi.containers.Pattern object with format 0
+    channel is an integer channel number
+
+    Outputs: list of 3-tuples of (onset tick, pitch, offset tick),
+    in order of onset
+    """
+
+    mfile.make_ticks_abs()
+    spans, sounding = [], {}
+
+    for event in mfile[0]:
+        if not (isinstance(event, (midi.events.NoteOnEvent,
+                                   midi.events.NoteOffEvent)) and
+                event.channel == channel):
+            continue
+        pitch = event.data[0]
+        if isinstance(event, midi.events.NoteOnEvent) and event.data[1] != 0:
+            sounding.setdefault(pitch, []).append(len(spans))
+            spans.append([event.tick, pitch, None])
+        elif len(sounding.get(pitch, [])) > 0:
+            spans[sounding[pitch].pop(0)][2] = event.tick
+
+    return [(onset, pitch, onset if offset is None else offset)
+            for onset, pitch, offset in spans]
+
+
+def group_chords(spans):
+    """
+    Groups note spans into chords by the rule of 
+    midi_sequences.MelodySequence.add_note, i.e. a note within 5 
+    or less ticks of the start of the last chord joins it.
+
+    Inputs: spans is an output of get_note_spans
+
+    Outputs: list of 2-tuples of (tick, dictionary of pitch -> 
+    offset tick)
+    """
+
+    chords = []
+
+    for onset, pitch, offset in spans:
+        if len(chords) > 0 and onset - chords[-1][0] <= 5:
+            notes = chords[-1][1]
+            notes[pitch] = max(offset, notes.get(pitch, offset))
+        else:
+            chords.append((onset, {pitch: offset}))
+
+    return chords
+
+
+def separate_voices(chords, method = 'skyline', max_voices = 4):
+    """
+    Splits a channel's chords into monophonic voices, so that no
+    melody has more than one note at a time.
+
+    The methods are:
+    'top' keeps the highest note of every chord
+    'bottom' keeps the lowest note of every chord
+    'skyline' keeps the highest note of every chord, unless a 
+    higher note kept earlier is still sounding over it
+    'leading' follows up to max_voices voices at once, giving each
+    note of a chord to the free voice nearest it in pitch, and 
+    starting a new voice rather than leaping more than voice_leap 
+    semitones while there is room for one; notes left over once 
+    there are max_voices voices are dropped
+
+    Inputs:
+    chords is an output of group_chords
+    method is one of separations (see above)
+    max_voices is the most voices 'leading' may follow
+
+    Outputs: list of voices, each a melody list of single-note 
+    chords, e.g. [[[60], [62], [64]], [[48], [43]]]
+    """
+
+    if method == 'top':
+        return [[[max(notes)] for tick, notes in chords]]
+
+    if method == 'bottom':
+        return [[[min(notes)] for tick, notes in chords]]
+
+    if method == 'skyline':
+        voice, last = [], None
+        for tick, notes in chords:
+            pitch = max(notes)
+            if (last is not None and pitch < last[0] and 
+                last[1] - tick > 5):
+                continue
+            voice.append([pitch])
+            last = (pitch, notes[pitch])
+        return [voice]
+
+    if method != 'leading':
+        raise ValueError("Unknown voice separation " + repr(method) + ".")
+
+    voices = []
+
+    for tick, notes in chords:
+        pitches = sorted(notes, reverse = True)
+        pairs = sorted([(abs(pitch - voices[v][-1][0]), v, pitch)
+                        for v in range(len(voices)) for pitch in pitches])
+        room = max_voices - len(voices)
+        used_voices, placed = set(), set()
+
+        for leap, v, pitch in pairs:
+            if v in used_voices or pitch in placed:
+                continue
+            if leap > voice_leap and room > len(pitches) - len(placed) - 1:
+                continue
+            voices[v].append([pitch])
+            used_voices.add(v)
+            placed.add(pitch)
+
+        for pitch in pitches:
+            if pitch not in placed and len(voices) < max_voices:
+                voices.append([[pitch]])
+                placed.add(pitch)
+
+    return voices
+
+
+def get_voices(mfile, channel, method = 'skyline', max_voices = 4):
+    """
+    Extracts the monophonic voices of the given channel in mfile
+    (see separate_voices).
+
+    Inputs:
+    mfile is a midi.containers.Pattern object with format 0
+    channel is an integer channel number
+    method and max_voices are as in separate_voices
+
+    Outputs: list of melody lists
+    """
+
+    return separate_voices(group_chords(get_note_spans(mfile, channel)),
+                           method, max_voices)
+
+
+def get_sequences(mfile, mapping, separate = None, max_voices = 4):
     """
     Extracts a list of melodic and rhythmic sequences from mfile, 
     pulling melodic information only from channels with strictly 
@@ -181,10 +332,16 @@ def get_sequences(mfile, mapping):
     Inputs: 
     mfile is a midi.containers.Pattern object with format 0
     mapping is a dictionary of channels -> sets of instruments
+    separate is None to keep every channel's chords whole, or one
+    of separations to split each melodic channel into monophonic
+    voices first (see separate_voices), which keeps the cost of 
+    training on wide chords down
+    max_voices is as in separate_voices
 
     Outputs:
     A 2-tuple of lists such that
-    first is a list of melodic events from all melodic channels,
+    first is a list of melodic events from all melodic channels
+    (one list per voice, if separate is given),
     
     second is a list of rhythmic events (in units of beats)
     from all channels
@@ -198,12 +355,12 @@ def get_sequences(mfile, mapping):
             continue
         if (all([x in melody_instruments for x in instruments]) and
             channel != 9):
-            melody = ms.MelodySequence(resolution = mfile.resolution)
-            melody_seq = get_melody_sequence(melody, mfile, channel).notes
-            if len(melody_seq) > 0:
-                melodies.append(list(zip(*melody_seq)[0]))
+            if separate is not None:
+                melodies += get_voices(mfile, channel, separate, max_voices)
             else:
-                melodies.append([])
+                melody = ms.MelodySequence(resolution = mfile.resolution)
+                melodies.append(get_melody_sequence(melody, mfile,
+                                                    channel).get_chords())
         else:
             melodies.append([])
         rhythm = ms.RhythmSequence(resolution = mfile.resolution)
@@ -213,13 +370,14 @@ def get_sequences(mfile, mapping):
     return melodies, rhythms
 
 
-def extract_all_sequences(filenames):
+def extract_all_sequences(filenames, separate = None, max_voices = 4):
     """
     Compiles all melodic and rhythmic sequences from a list 
     of filenames.
     
     Inputs: 
     filenames is a list of strings
+    separate and max_voices are as in get_sequences
 
     Outputs: 
     A 2-tuple of lists such that:
@@ -234,7 +392,8 @@ def extract_all_sequences(filenames):
             mfile = get_midi_file(filename)
             flat_file = make_one_track(mfile)
             mapping = get_channel_mapping(flat_file)
-            melodies, rhythms = get_sequences(flat_file, mapping)
+            melodies, rhythms = get_sequences(flat_file, mapping, separate,
+                                              max_voices)
             all_melodies += melodies
             all_rhythms += rhythms
         except:
@@ -6,14 +6,22 @@
 ######################################################
 
 
+from array import array
+
+
 class EventSequence(object):
     """
     A container for a sequence of events.
 
     Abstract class, to be implemented via MelodySequence
     or RhythmSequence.
+
+    Uses __slots__, so that the many sequences made while extracting
+    a large corpus carry no per-instance dictionary.
     """
 
+    __slots__ = ('num_events', 'resolution')
+
 
     def __init__(self, num_events = 0, resolution = 240):
         """
@@ -43,34 +51,102 @@ class EventSequence(object):
         self.num_events += 1
 
 
+def chord_to_mask(pitches):
+    """
+    Packs a list of pitches into a bitmask, with bit p set for
+    pitch p (so any MIDI pitch fits in 128 bits).
+
+    Inputs: pitches is a list of integers from 0 to 127
+
+    Outputs: integer bitmask
+    """
+
+    mask = 0
+    for pitch in pitches:
+        mask |= 1 << pitch
+
+    return mask
+
+
+def mask_to_chord(mask):
+    """
+    Unpacks a bitmask made by chord_to_mask.
+
+    Inputs: mask is an integer bitmask
+
+    Outputs: list of pitches, in ascending order
+    """
+
+    chord = []
+    while mask:
+        low = mask & -mask
+        chord.append(low.bit_length() - 1)
+        mask ^= low
+
+    return chord
+
+
 class MelodySequence(EventSequence):
     """
     A container for a melodic sequence, with each note event
-    stored as a list of concurrent notes and their collective
-    temporal tick value. 
+    stored as the set of concurrent notes (packed into a pitch
+    bitmask) and their collective temporal tick value.
+
+    The tick values are kept in an array('i') and the chords in a
+    parallel list of bitmasks, so adding a note to a chord is a
+    single bitwise or. The notes property unpacks them into the
+    list of (list of pitches, tick) tuples consumers expect.
 
     Inherits from EventSequence.
     """
 
+    __slots__ = ('ticks', 'chords')
+
 
     def __init__(self, num_events = 0, resolution = 240):
         """
-        Calls parent init function and initializes a (default empty)
-        list of notes.
+        Calls parent init function and initializes (default empty)
+        arrays of tick values and chord bitmasks.
 
         Inputs: 
         num_events is an integral number of events
         resolution is an integral number of ticks per beat
-        
-        notes is a list of tuples with first element being
-        the list of concurrent notes and the second element 
-        being the time stamp in ticks.
+
+        ticks is an array of each chord's time stamp in ticks
+        chords is the matching list of pitch bitmasks
 
         Outputs: None
         """
 
         super(MelodySequence, self).__init__(num_events, resolution)
-        self.notes = []
+        self.ticks = array('i')
+        self.chords = []
+
+
+    def __len__(self):
+        return len(self.ticks)
+
+
+    def __iter__(self):
+        for mask, tick in zip(self.chords, self.ticks):
+            yield (mask_to_chord(mask), tick)
+
+
+    @property
+    def notes(self):
+        """
+        The sequence as a list of tuples with first element being
+        the list of concurrent notes (in ascending order) and the
+        second element being the time stamp in ticks.
+        """
+
+        return list(self)
+
+
+    @notes.setter
+    def notes(self, notes):
+        self.ticks = array('i', [tick for chord, tick in notes])
+        self.chords = [chord_to_mask(chord) for chord, tick in notes]
 
 
     def add_note(self, note):
@@ -78,11 +154,14 @@ class MelodySequence(EventSequence):
         Adds a note to the sequence. 
 
         If the note is concurrent with (i.e. within 5 or less 
-        ticks of) the previous note added, append it to the chord 
-        list at the previous position of the sequence list. 
+        ticks of) the previous note added, add it to the chord 
+        at the previous position of the sequence. 
 
         If the note is played at a new tick interval then append 
-        it to the list as a singleton.
+        it to the sequence as a singleton.
+
+        A note earlier than the previous one also counts as
+        concurrent, so the ticks are always in ascending order.
 
         Inputs: 
         note is a 2-tuple of integers, with the first entry for the
@@ -91,19 +170,19 @@ class MelodySequence(EventSequence):
         Outputs: None
         """
         
-        if (len(self.notes) > 0 and 
-            note[1] - self.notes[-1][1] <= 5):
+        if (len(self.ticks) > 0 and 
+            note[1] - self.ticks[-1] <= 5):
             self.add_note_to_chord(note[0])
         else:
             super(MelodySequence, self).add_event()
-            self.notes.append(([note[0]], note[1]))
+            self.ticks.append(note[1])
+            self.chords.append(1 << note[0])
 
 
     def add_note_to_chord(self, note_val):
         """
-        Append a note value to the list of notes in the chord
-        at the previous tick value. If it's a duplicate it gets
-        nixed.
+        Add a note value to the chord at the previous tick value.
+        If it's a duplicate it gets nixed.
 
         Inputs:
         note_val is an integer value representing pitch
@@ -111,36 +190,84 @@ class MelodySequence(EventSequence):
         Outputs: None
         """
 
-        self.notes[-1] = (list(set(self.notes[-1][0] + [note_val])),
-                          self.notes[-1][1])
+        self.chords[-1] |= 1 << note_val
+
+
+    def get_chords(self):
+        """
+        Returns just the chords, as lists of pitches in ascending
+        order.
+
+        Inputs: None
+
+        Outputs: list of lists of integers
+        """
+
+        return [mask_to_chord(mask) for mask in self.chords]
 
 
 class RhythmSequence(EventSequence):
     """
     A container for a rhythmic sequence, with each rhythmic event 
-    stored by default as an integral tick value, with an option to 
-    switch between ticks and beats as units.
+    stored as an integral tick value in an array('i'), with an
+    option to switch between ticks and beats as the units the
+    ticks property reports them in.
     """
 
+    __slots__ = ('tick_array', 'tick_units')
+
 
     def __init__(self, num_events = 0, resolution = 240):
         """
         Calls parent init function and initializes a (default empty)
-        list of time stamps in units of ticks.
+        array of time stamps in units of ticks.
 
         Inputs: 
         num_events is an integral number of events
         resolution is an integral number of ticks per beat
-        ticks is a list of integral tick values
+
+        tick_array is an array of integral tick values
+        tick_units is False once ticks_to_beats has been called
 
         Outputs: None
         """
 
         super(RhythmSequence, self).__init__(num_events, resolution)
-        self.ticks = []
+        self.tick_array = array('i')
         self.tick_units = True
 
 
+    def __len__(self):
+        return len(self.tick_array)
+
+
+    def __iter__(self):
+        if self.tick_units:
+            return iter(self.tick_array)
+
+        res = float(self.resolution)
+        return (tick / res for tick in self.tick_array)
+
+
+    @property
+    def ticks(self):
+        """
+        The time stamps as a list, in ticks or (after ticks_to_beats)
+        in floating point beats.
+        """
+
+        return list(self)
+
+
+    @ticks.setter
+    def ticks(self, ticks):
+        if self.tick_units:
+            self.tick_array = array('i', [int(tick) for tick in ticks])
+        else:
+            self.tick_array = array('i', [int(round(beat * self.resolution))
+                                          for beat in ticks])
+
+
     def add_tick(self, tick):
         """
         Adds a tick to the sequence. If the tick is concurrent with
@@ -151,27 +278,24 @@ class RhythmSequence(EventSequence):
         Outputs: None
         """
         
-        if (len(self.ticks) > 0 and
-            tick - self.ticks[-1] < 5):
+        if (len(self.tick_array) > 0 and
+            tick - self.tick_array[-1] < 5):
             pass
         else:
             super(RhythmSequence, self).add_event()
-            self.ticks.append(tick)
+            self.tick_array.append(tick)
 
 
     def ticks_to_beats(self):
         """
-        Change units of time from ticks to beats.
+        Change units of time from ticks to beats. The ticks are
+        stored as they are and only divided out when read.
         
         Inputs: None
         
         Outputs: None
         """
         
-        if not self.tick_units:
-            pass
-        
-        self.ticks = map(lambda x: float(x) / self.resolution, self.ticks)
         self.tick_units = False
 
 
@@ -184,8 +308,4 @@ class RhythmSequence(EventSequence):
         Outputs: None
         """
         
-        if self.tick_units:
-            pass
-        
-        self.ticks = map(lambda x: round(x * self.resolution), self.ticks)
         self.tick_units = True
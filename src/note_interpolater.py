@@ -1,9 +1,71 @@
 from collections import defaultdict
 from itertools import product
+import os
+import struct
 import numpy as np
+import markov_sequences as marks
 
 
-def make_note_stack(note_string):
+def make_seed():
+    """
+    Draws a fresh seed from the operating system, suitable for 
+    passing to make_rng and for handing back to the client so 
+    that an augmentation can be replayed exactly.
+
+    Inputs: None
+
+    Outputs: integer seed in range(2 ** 32)
+    """
+
+    return struct.unpack('<I', os.urandom(4))[0]
+
+
+def make_rng(seed = None):
+    """
+    Builds a private random number generator for one augmentation 
+    request. Each request gets its own generator, so that requests 
+    served from different threads never share random state, and a 
+    given seed always reproduces the same notes.
+
+    Inputs: seed is an integer in range(2 ** 32), or None to seed 
+    from the operating system
+
+    Outputs: numpy.random.RandomState object
+    """
+
+    if seed is None:
+        seed = make_seed()
+
+    return np.random.RandomState(int(seed))
+
+
+def parse_number(text):
+    """
+    Reads one value of a note string. Whole numbers (the usual case)
+    come back as integers; anything else is rounded to 2 decimal 
+    places, as the web app always has.
+
+    Inputs: text is a string
+
+    Outputs: integer or float, raises ValueError if text isn't a
+    finite number
+    """
+
+    try:
+        return int(text)
+    except ValueError:
+        value = round(float(text), 2)
+
+    if np.isnan(value) or np.isinf(value):
+        raise ValueError("not a finite number: " + repr(text))
+
+    if value == int(value):
+        return int(value)
+
+    return value
+
+
+def make_note_stack(note_string, length = 16, pitch_offset = 72):
     """
     Pulls in raw JSON object from JQuery, and turns it into a list
     of tuples representing the notes. The structure of this "stack" 
@@ -11,39 +73,41 @@ def make_note_stack(note_string):
     and the outer list of tuples is sorted in chronological order
     (i.e. sorted with key as the 0th index).
 
+    The notes are grouped by step in a single pass over the string,
+    so parsing takes time linear in the string and grid lengths.
+    Notes at steps outside the grid, or between steps, are dropped.
+
     Inputs: note_string is a raw unsorted string in the form
-    'timestamp_k,pitch_k,timestamp_j,pitch_j,...'
+    'timestamp_k,row_k,timestamp_j,row_j,...'
+    length is the number of steps in the grid
+    pitch_offset is the pitch of row 0, the top row of the grid
+    (row r has pitch pitch_offset - r)
 
     Outputs: stacked_data is a tuple as described above, and to_fill 
-    describes which timestamps need notes in the augmentation stage
+    describes which timestamps need notes in the augmentation stage;
+    raises ValueError if a value isn't a finite number
     """
 
     note_dict = defaultdict(list)
 
-    flat_data = map(lambda x: round(float(x), 2),
-                    note_string.split(','))
+    flat_data = note_string.split(',')
 
-    paired_data = [(flat_data[2 * i],
-                     72 - flat_data[2 * i + 1])
-                    for i in range(len(flat_data) / 2)]
+    for k in range(0, len(flat_data) - 1, 2):
+        step = parse_number(flat_data[k])
+        if isinstance(step, int) and 0 <= step < length:
+            note_dict[step].append(pitch_offset - 
+                                   parse_number(flat_data[k + 1]))
 
-    stacked_data = []
+    stacked_data, to_fill = [], []
 
-    for i in range(16):
-        i_notes = []
-        for pair in paired_data:
-            if pair[0] == i:
-                i_notes.append(pair[1])
-        if len(i_notes) > 0:
-            stacked_data.append((i, i_notes))
+    for i in range(length):
+        if i in note_dict:
+            stacked_data.append((i, note_dict[i]))
+        else:
+            stacked_data.append((i, ['x']))
+            to_fill.append(i)
 
-    to_fill = set(range(16)) - set(zip(*stacked_data)[0])
-
-    for i in to_fill:
-        stacked_data.append((i, ['x']))
-
-    return sorted(stacked_data, 
-                  key = lambda x: x[0]), sorted(list(to_fill))
+    return stacked_data, to_fill
 
 
 def unstack_sequences(stacked_seq):
@@ -82,25 +146,42 @@ def unstack_sequences(stacked_seq):
     return list(product(*zip(*new_seq)[1]))
 
 
-def get_mel_probs(melody_marks, notes, weights, max_len):
+def get_relative_orders(melody_marks):
+    """
+    Lists the orders of a set of melodic chains that were built 
+    relative (see markov_sequences.is_recentered), to pass on to 
+    get_contexts.
+
+    Inputs: melody_marks is a dictionary of Markov objects
+
+    Outputs: set of (before, after) tuples
     """
-    Main worker function for interpolating notes. Given a sequence
-    of pitch values with exactly one 'x' value included, finds the
-    relevant Markov Chain dictionaries that fit this pattern, and 
-    builds up a weighted average of probability distributions on 
-    the value of 'x'. 
+
+    return set([order for order, mark in melody_marks.items()
+                if marks.is_recentered(mark)])
+
+
+def get_contexts(notes, max_len, relative = ()):
+    """
+    Lists every Markov Chain context that applies to a note sequence
+    with exactly one 'x' value included. Contexts of combined order 3 
+    or more, and of any order in relative, are recentered the same 
+    way markov_funcs.iterate_melody recenters them in training, so 
+    their keys are relative pitches.
 
     Inputs:
-    melody_marks is a dictionary of Markov objects
     notes is a tuple representing a note sequence
-    weights is a dictionary of weights for each model
-    (initialized to even weighting)
     max_len is the maximum order length for the set of markov chains
+    relative is a collection of (before, after) orders to recenter
+    whatever their combined order (see get_relative_orders)
 
-    Outputs: List of 2-tuples of (pitch, probability), sorted by pitch.
+    Outputs: List of 3-tuples of ((before, after), key, to_subtract),
+    where key is the state_dict key for the (before, after) model 
+    and to_subtract is the pitch to add back onto its results 
+    (0 if the context was not recentered).
     """
-    
-    mel_probs = {i: 0 for i in range(128)}
+
+    contexts = []
 
     to_fill = notes.index('x')
 
@@ -114,11 +195,9 @@ def get_mel_probs(melody_marks, notes, weights, max_len):
             if (before > to_fill) or (after >= notes_len - to_fill):
                 continue
 
-            flag = False
-
-            if (before + after >= 3):
-                flag = True
+            to_subtract = 0
 
+            if before + after >= 3 or (before, after) in relative:
                 if before:
                     to_subtract = notes[to_fill - before]
 
@@ -126,52 +205,204 @@ def get_mel_probs(melody_marks, notes, weights, max_len):
                     to_subtract = notes[to_fill + 1]
 
                 notes_to_parse = map(lambda x: x - to_subtract
-                                     if isinstance(x, int) else x,
+                                     if x != 'x' else x,
                                      notes)
 
             else:
                 notes_to_parse = notes
 
-            d = melody_marks[(before, after)].state_dict
-
-            if before:
-                bef_notes = tuple(notes_to_parse[to_fill - before:to_fill])
-                if after:
-                    aft_notes = tuple(notes_to_parse[to_fill + 1:
-                                                     to_fill + after + 1])
-                    if (bef_notes, aft_notes) in d:
-                        for key, val in d[(bef_notes, aft_notes)].items():
-                            if flag:
-                                key += to_subtract
-
-                            if key in range(128):
-                                mel_probs[key] += (val *
-                                                   weights[(before, after)])
-                else:
-                    if bef_notes in d:
-                        for key, val in d[bef_notes].items():
-                            if flag:
-                                key += to_subtract
-
-                            if key in range(128):
-                                mel_probs[key] += (val *
-                                                   weights[(before, after)])
+            bef_notes = tuple(notes_to_parse[to_fill - before:to_fill])
+            aft_notes = tuple(notes_to_parse[to_fill + 1:
+                                             to_fill + after + 1])
 
+            if before and after:
+                key = (bef_notes, aft_notes)
+            elif before:
+                key = bef_notes
             else:
-                aft_notes = tuple(notes_to_parse[to_fill + 1:
-                                                 to_fill + after + 1])
-                if aft_notes in d:
-                    for key, val in d[aft_notes].items():
-                        if flag:
-                            key += to_subtract
+                key = aft_notes
+
+            contexts.append(((before, after), key, to_subtract))
+
+    return contexts
+
+
+def lookup_wide(mark, key, index = None, fallback_weight = 0.5):
+    """
+    Looks up one context in a Markov object, as lookup_probs does, 
+    but before the anchor pitch of a recentered context is added 
+    back on. The distribution is spread over 256 slots, where slot 
+    128 + p holds (relative) pitch p, so that it covers every 
+    interval; slicing out the 128 slots starting at 128 minus the 
+    anchor gives the distribution over MIDI pitches. Transposed 
+    copies of one recentered context share the same key, and so 
+    can share one wide lookup.
+
+    Inputs:
+    mark, key, index and fallback_weight are as in lookup_probs
+
+    Outputs: numpy array of length 256 of probabilities by pitch
+    """
+
+    probs = np.zeros(256)
+
+    if key in mark.state_dict:
+        found = [(key, 0, 1.0)]
+    elif index is not None:
+        neighbours = index.neighbours(key)
+        found = [(stored, shift, fallback_weight / len(neighbours))
+                 for stored, shift in neighbours]
+    else:
+        found = []
 
-                        if key in range(128):
-                            mel_probs[key] += (val *
-                                               weights[(before, after)])
+    for stored, shift, scale in found:
+        for pitch, val in mark.state_dict[stored].items():
+            pitch += shift + 128
 
-    return sorted(mel_probs.items(), key = lambda x: x[0])
+            if 0 <= pitch < 256:
+                probs[int(pitch)] += val * scale
 
-def get_note_to_append(marks, stack, weights, max_len):
+    return probs
+
+
+def lookup_probs(mark, key, to_subtract, index = None,
+                 fallback_weight = 0.5):
+    """
+    Looks up one context in a Markov object and spreads its 
+    distribution over the 128 MIDI pitches. If the context has
+    never been seen and a neighbour index is given, the average 
+    distribution of its nearest stored contexts is used instead,
+    scaled down by fallback_weight.
+
+    Inputs:
+    mark is a markov_sequences.Markov object
+    key is a state_dict key for mark (see get_contexts)
+    to_subtract is the pitch to add back onto recentered results
+    index is a context_index.ContextIndex object for mark, or None
+    fallback_weight is the total weight given to neighbouring contexts
+
+    Outputs: numpy array of length 128 of probabilities by pitch,
+    all zero if neither the context nor any neighbour has been seen.
+    """
+
+    return shift_wide(lookup_wide(mark, key, index, fallback_weight),
+                      to_subtract)
+
+
+def shift_wide(wide, to_subtract):
+    """
+    Slices the distribution over MIDI pitches out of an output of 
+    lookup_wide, adding the anchor pitch to_subtract back on.
+
+    Outputs: numpy array of length 128
+    """
+
+    start = 128 - int(to_subtract)
+
+    if 0 <= start <= 128:
+        return wide[start:start + 128]
+
+    return np.zeros(128)
+
+
+def get_mel_prob_array(melody_marks, notes, weights, max_len, cache = None,
+                       indexes = None, stats = None):
+    """
+    Array version of get_mel_probs. If a cache dictionary is given,
+    each distinct (model, context) lookup is resolved only once and
+    shared by every sequence passed in with the same cache. Cached
+    lookups are kept before their anchor pitch is added back on (see
+    lookup_wide), so recentered contexts that are transpositions of
+    each other share one entry.
+
+    Inputs:
+    melody_marks is a dictionary of Markov objects
+    notes is a tuple representing a note sequence
+    weights is a dictionary of weights for each model
+    max_len is the maximum order length for the set of markov chains
+    cache is a dictionary, or None for no caching
+    indexes is a dictionary of context_index.ContextIndex objects
+    to fall back on for unseen contexts, or None
+    stats is a dictionary to count each model's lookups in, keyed
+    by ('hit' or 'miss', (before, after)), or None
+
+    Outputs: numpy array of length 128 of (unnormalized) weighted
+    probabilities by pitch.
+    """
+
+    if indexes is None:
+        indexes = {}
+
+    mel_probs = np.zeros(128)
+    relative = get_relative_orders(melody_marks)
+
+    for order, key, to_subtract in get_contexts(notes, max_len, relative):
+        # orders weighted 0 have been turned off (see tune_weights.py)
+        if weights[order] == 0:
+            continue
+
+        if stats is not None:
+            result = 'hit' if key in melody_marks[order].state_dict else 'miss'
+            stats[(result, order)] = stats.get((result, order), 0) + 1
+
+        if cache is None:
+            probs = lookup_probs(melody_marks[order], key, to_subtract,
+                                 indexes.get(order))
+        else:
+            cache_key = (order, key)
+            if cache_key not in cache:
+                cache[cache_key] = lookup_wide(melody_marks[order], key,
+                                               indexes.get(order))
+            probs = shift_wide(cache[cache_key], to_subtract)
+
+        mel_probs += probs * weights[order]
+
+    return mel_probs
+
+
+def get_mel_probs(melody_marks, notes, weights, max_len, indexes = None):
+    """
+    Main worker function for interpolating notes. Given a sequence
+    of pitch values with exactly one 'x' value included, finds the
+    relevant Markov Chain dictionaries that fit this pattern, and 
+    builds up a weighted average of probability distributions on 
+    the value of 'x'. 
+
+    Inputs:
+    melody_marks is a dictionary of Markov objects
+    notes is a tuple representing a note sequence
+    weights is a dictionary of weights for each model
+    (initialized to even weighting)
+    max_len is the maximum order length for the set of markov chains
+    indexes is a dictionary of context_index.ContextIndex objects
+    to fall back on for unseen contexts, or None
+
+    Outputs: List of 2-tuples of (pitch, probability), sorted by pitch.
+    """
+    
+    mel_probs = get_mel_prob_array(melody_marks, notes, weights, max_len,
+                                   indexes = indexes)
+
+    return list(enumerate(mel_probs))
+
+
+def get_stack_pitches(stack):
+    """
+    Lists the distinct pitches already present in a stack. These are
+    the last resort for filling a gap when no model (nor any of the
+    fallback neighbours) has seen any of the gap's contexts.
+
+    Inputs: stack is a stacked sequence of notes
+
+    Outputs: sorted list of integer pitches
+    """
+
+    return sorted(set([int(pitch) for timestamp, pitches in stack 
+                       for pitch in pitches if pitch != 'x']))
+
+
+def get_note_to_append(marks, stack, weights, max_len, rng = None,
+                       indexes = None):
     """
     The main function called by flask, this function gathers a list 
     of possible notes to insert by calling the get_mel_probs method
@@ -184,21 +415,193 @@ def get_note_to_append(marks, stack, weights, max_len):
     weights is a dictionary of weights for each model
     (initialized to even weighting)
     max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object (see make_rng); a
+    freshly seeded one is used if None
+    indexes is a dictionary of context_index.ContextIndex objects
+    to fall back on for unseen contexts, or None
 
     Output: The pitch to be inserted, as a MIDI integer value.
     """
     
+    if rng is None:
+        rng = make_rng()
+
     possible_notes = []
     
     note_sequences = unstack_sequences(stack)
 
     for notes in note_sequences:
-        prob_list = get_mel_probs(marks, list(notes), weights, max_len)
+        prob_list = get_mel_probs(marks, list(notes), weights, max_len,
+                                  indexes)
         full_sum = np.sum(zip(*prob_list)[1])
+        if full_sum == 0:
+            continue
         for i in range(len(prob_list)):
             prob_list[i] = (i, prob_list[i][1] / full_sum)
-        outcomes = np.random.multinomial(20, zip(*prob_list)[1])
+        outcomes = rng.multinomial(20, zip(*prob_list)[1])
         note_hits = filter(lambda x: x[1] > 0, list(enumerate(outcomes)))
-        possible_notes.append(prob_list[np.random.choice(zip(*note_hits)[0])])
+        possible_notes.append(prob_list[rng.choice(zip(*note_hits)[0])])
+
+    if len(possible_notes) == 0:
+        return rng.choice(get_stack_pitches(stack))
+
+    return rng.choice(zip(*possible_notes)[0])
+
+
+def sample_pitches(probs, uniforms):
+    """
+    Vectorized form of the sampling step in get_note_to_append. For
+    each row of probs, takes 20 draws from the distribution and 
+    picks uniformly among the pitches that were hit at least once.
+
+    Inputs:
+    probs is a numpy array of shape (n, 128) of normalized probabilities
+    uniforms is a numpy array of shape (n, 20 + 128) of uniform 
+    random values in [0, 1)
+
+    Outputs: numpy array of n sampled pitches
+    """
+
+    cdf = np.cumsum(probs, axis = 1)
+
+    draws = (uniforms[:, :20, None] >= cdf[:, None, :]).sum(axis = 2)
+    draws = np.minimum(draws, 127)
+
+    hits = np.zeros(probs.shape, dtype = bool)
+    hits[np.arange(len(probs))[:, None], draws] = True
+
+    return np.where(hits, uniforms[:, 20:], -1.0).argmax(axis = 1)
+
+
+def get_notes_to_append(marks, stacks, weights, max_len, rngs = None,
+                        indexes = None, stats = None):
+    """
+    Batch version of get_note_to_append for many stacks at once. 
+    Identical unstacked melodies are scored once, and every distinct 
+    (model, context) lookup is resolved once for the whole batch, 
+    so that grids sharing material share the work. All sampling 
+    is then done together in array form.
+
+    Inputs: 
+    marks is a dictionary of Markov objects
+    stacks is a list of stacked sequences of notes
+    weights is a dictionary of weights for each model
+    max_len is the max order length of the set of Markov chains
+    rngs is a list with one numpy.random.RandomState object per
+    stack, a single RandomState shared by the whole batch, or None
+    indexes is a dictionary of context_index.ContextIndex objects
+    to fall back on for unseen contexts, or None
+    stats is a dictionary to count lookups in (see get_mel_prob_array)
+    and unstacked sequences (under 'unstacked'), or None
+
+    Output: List with the pitch to be inserted for each stack, as 
+    a MIDI integer value. Where no model has seen any of a stack's
+    contexts, one of the stack's own pitches is repeated, and None
+    is returned only if the stack has no pitches at all.
+    """
+
+    if len(stacks) == 0:
+        return []
+
+    if rngs is None:
+        rngs = make_rng()
+    if not isinstance(rngs, list):
+        rngs = [rngs] * len(stacks)
+
+    cache = {}
+    seq_rows = {}
+    seq_probs = []
+    stack_rows = []
+
+    for stack in stacks:
+        rows = []
+        for notes in unstack_sequences(stack):
+            if notes not in seq_rows:
+                seq_rows[notes] = len(seq_probs)
+                seq_probs.append(get_mel_prob_array(marks, notes, weights,
+                                                    max_len, cache, 
+                                                    indexes, stats))
+            rows.append(seq_rows[notes])
+        stack_rows.append(rows)
+        if stats is not None:
+            stats['unstacked'] = stats.get('unstacked', 0) + len(rows)
+
+    seq_probs = np.array(seq_probs)
+    full_sums = seq_probs.sum(axis = 1)
+    seen = full_sums > 0
+    seq_probs[seen] /= full_sums[seen][:, None]
+
+    all_rows = np.array([row for rows in stack_rows for row in rows])
+    uniforms = np.vstack([rng.random_sample((len(rows), 20 + 128))
+                          for rng, rows in zip(rngs, stack_rows)])
+    pitches = sample_pitches(seq_probs[all_rows], uniforms)
+
+    new_notes = []
+    start = 0
+
+    for j, (rng, rows) in enumerate(zip(rngs, stack_rows)):
+        stop = start + len(rows)
+        candidates = pitches[start:stop][seen[all_rows[start:stop]]]
+        if len(candidates) == 0:
+            candidates = get_stack_pitches(stacks[j])
+        if len(candidates) > 0:
+            new_notes.append(int(rng.choice(candidates)))
+        else:
+            new_notes.append(None)
+        start = stop
+
+    return new_notes
+
+
+def augment_stacks(marks, stacks, to_fills, weights, max_len, rngs = None,
+                   indexes = None, stats = None):
+    """
+    Fills in every missing step of many stacks at once, in the same
+    left-to-right order the web app uses for a single grid. At each
+    round, the next gap of every grid is filled by one batched call
+    to get_notes_to_append, looking at max_len steps on either side.
+    Steps that are empty and not being filled are treated as rests
+    and skipped over.
+
+    Inputs:
+    marks is a dictionary of Markov objects
+    stacks is a list of stacked sequences (output from make_note_stack)
+    to_fills is a list of the matching lists of steps to fill
+    weights is a dictionary of weights for each model
+    max_len is the max order length of the set of Markov chains
+    rngs, indexes and stats are as in get_notes_to_append
+
+    Outputs: List with, for each stack, a list of (step, pitch) 
+    tuples for the notes that were added.
+    """
+
+    if rngs is None:
+        rngs = make_rng()
+    if not isinstance(rngs, list):
+        rngs = [rngs] * len(stacks)
+
+    stacks = [list(stack) for stack in stacks]
+    added = [[] for stack in stacks]
+
+    for k in range(max([len(to_fill) for to_fill in to_fills] + [0])):
+        active = [j for j in range(len(stacks)) if k < len(to_fills[j])]
+        windows = []
+
+        for j in active:
+            i = to_fills[j][k]
+            windows.append([entry for entry in
+                            stacks[j][max(0, i - max_len):i + max_len + 1]
+                            if entry[1] != ['x'] or entry[0] == i])
+
+        new_notes = get_notes_to_append(marks, windows, weights, max_len,
+                                        [rngs[j] for j in active], indexes,
+                                        stats)
+
+        for j, new_note in zip(active, new_notes):
+            if new_note is None:
+                continue
+            i = to_fills[j][k]
+            stacks[j][i] = (i, [new_note])
+            added[j].append((i, new_note))
 
-    return np.random.choice(zip(*possible_notes)[0])
+    return added
@@ -0,0 +1,548 @@
+#######################################################
+### pipeline.py -- trains the Markov chains in five ###
+### resumable stages (ingest, quantize, train,      ###
+### prune, export), each checkpointed as a versioned ###
+### artifact with a manifest, and deploys a bundle  ###
+### the web app's model loader picks up. Stages     ###
+### whose inputs haven't changed are skipped, so it ###
+### can run from cron as often as new MIDI arrives. ###
+#######################################################
+
+import os
+import sys
+import json
+import time
+import fcntl
+import pickle
+import shutil
+import hashlib
+import argparse
+import midi_funcs as midf
+import markov_funcs as markf
+import markov_sequences as marks
+
+stages = ['ingest', 'quantize', 'train', 'prune', 'export']
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def file_digest(filename, block = 1 << 20):
+    """
+    Returns the SHA-1 hex digest of a file's contents.
+    """
+
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def stage_key(stage, inputs):
+    """
+    Names one version of a stage's artifact after everything it
+    was made from, so the same inputs always give the same name.
+
+    Inputs:
+    stage is one of stages
+    inputs is a JSON-able dictionary of the stage's settings and
+    the keys of the artifacts it reads
+
+    Outputs: 16 character hex string
+    """
+
+    text = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys = True)
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def read_manifest(artifact_dir):
+    """
+    Reads an artifact's manifest.json.
+
+    Outputs: dictionary, or None if the artifact isn't complete
+    """
+
+    path = os.path.join(artifact_dir, 'manifest.json')
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(filename, data):
+    """
+    Writes JSON to a temporary file and renames it into place, so
+    a reader never sees half a file.
+    """
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f, indent = 2, sort_keys = True)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def dump(filename, data):
+    """
+    Pickles data to a temporary file and renames it into place.
+    """
+
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(data, f, 2)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def run_stage(work_dir, stage, inputs, build, force = False):
+    """
+    Builds one stage's artifact, unless one made from the same
+    inputs already exists. The artifact is built in a .partial
+    directory, which is kept if the build fails so that build can
+    pick up where it left off, and renamed into place once its
+    manifest is written.
+
+    Inputs:
+    work_dir is the pipeline's working directory
+    stage is one of stages
+    inputs is as for stage_key
+    build is a function of the directory to write into, returning
+    a dictionary of anything to record in the manifest
+    force is True to rebuild even if the artifact exists
+
+    Outputs: 2-tuple of the artifact's key and directory
+    """
+
+    key = stage_key(stage, inputs)
+    final = os.path.join(work_dir, stage, key)
+
+    if not force and read_manifest(final) is not None:
+        print (stage + ": up to date (" + key + "), skipped.")
+        return key, final
+
+    partial = final + '.partial'
+    if force and os.path.isdir(partial):
+        shutil.rmtree(partial)
+    if not os.path.isdir(partial):
+        os.makedirs(partial)
+
+    print (stage + ": building " + key + "...")
+    start = time.time()
+    details = build(partial)
+
+    write_json(os.path.join(partial, 'manifest.json'),
+               {'stage': stage,
+                'key': key,
+                'inputs': inputs,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                         time.gmtime()),
+                'seconds': round(time.time() - start, 3),
+                'outputs': sorted([f for f in os.listdir(partial)
+                                   if f != 'manifest.json']),
+                'details': details})
+
+    if os.path.isdir(final):
+        shutil.rmtree(final)
+    os.rename(partial, final)
+    print (stage + ": done in %.1f seconds." % (time.time() - start))
+
+    return key, final
+
+
+def ingest_file(filename, cache_dir, digest, separate, max_voices):
+    """
+    Extracts one MIDI file's sequences, or reads them back from the
+    cache if a file with the same contents was extracted before
+    with the same settings.
+
+    Outputs: 2-tuple of lists, (melodies, rhythms)
+    """
+
+    cached = os.path.join(cache_dir, stage_key('file', [digest, separate,
+                                                        max_voices]) + '.pkl')
+
+    if os.path.exists(cached):
+        return load(cached)
+
+    sequences = midf.extract_all_sequences([filename], separate, max_voices)
+    dump(cached, sequences)
+
+    return sequences
+
+
+def make_ingest(files, digests, cache_dir, separate, max_voices):
+    """
+    Builds the ingest artifact: every melody and rhythm sequence of
+    the corpus, in sequences.pkl.
+    """
+
+    def build(out_dir):
+        melodies, rhythms = [], []
+        for filename in files:
+            mels, rhys = ingest_file(filename, cache_dir, digests[filename],
+                                     separate, max_voices)
+            melodies += mels
+            rhythms += rhys
+        dump(os.path.join(out_dir, 'sequences.pkl'), (melodies, rhythms))
+        return {'files': len(files),
+                'melodies': len(melodies),
+                'rhythms': len(rhythms)}
+
+    return build
+
+
+def make_quantize(ingest_dir, level):
+    """
+    Builds the quantize artifact: the rhythms rounded to the given
+    level (see markov_funcs.myround), in rhythms.pkl.
+    """
+
+    def build(out_dir):
+        melodies, rhythms = load(os.path.join(ingest_dir, 'sequences.pkl'))
+        dump(os.path.join(out_dir, 'rhythms.pkl'),
+             markf.quantize(rhythms, level))
+        return {'rhythms': len(rhythms)}
+
+    return build
+
+
+def make_train(ingest_dir, quantize_dir, max_order, relative, buffer_limit,
+               spill_dir):
+    """
+    Builds the train artifact: one pickle per chain, as
+    markov_funcs.make_all_chains writes them. Each chain is renamed
+    into place once trained, and chains already in the directory
+    are not trained again, so a failed run resumes with the chain
+    it was on.
+    """
+
+    def build(out_dir):
+        melodies, _ = load(os.path.join(ingest_dir, 'sequences.pkl'))
+        rhythms = load(os.path.join(quantize_dir, 'rhythms.pkl'))
+        trained = resumed = 0
+        for kind, seqs, iterate in [('melody', melodies, markf.iterate_melody),
+                                    ('rhythm', rhythms, markf.iterate_rhythm)]:
+            for before, after, mode in markf.get_orders(max_order):
+                name = markf.chain_filename(kind, before, after, mode)
+                if os.path.exists(os.path.join(out_dir, name)):
+                    resumed += 1
+                    continue
+                mark = markf.train_chain(seqs, before, after, mode, iterate,
+                                         buffer_limit, spill_dir,
+                                         relative and kind == 'melody')
+                with open(os.path.join(out_dir, name + '.tmp'), 'w') as f:
+                    pickle.dump(mark, f)
+                os.rename(os.path.join(out_dir, name + '.tmp'),
+                          os.path.join(out_dir, name))
+                trained += 1
+                print ("  " + name)
+        return {'trained': trained, 'resumed': resumed}
+
+    return build
+
+
+def prune_chain(mark, min_prob):
+    """
+    Drops the outcomes of every context with probability below
+    min_prob, renormalizes the rest, and drops contexts left with
+    nothing, in place.
+
+    Inputs:
+    mark is a markov_sequences.Markov object
+    min_prob is a probability
+
+    Outputs: 2-tuple of the number of outcomes and of contexts dropped
+    """
+
+    outcomes = contexts = 0
+
+    for key in list(mark.state_dict):
+        dist = mark.state_dict[key]
+        kept = dict([(v, p) for v, p in dist.items() if p >= min_prob])
+        outcomes += len(dist) - len(kept)
+        if len(kept) == 0:
+            del mark.state_dict[key]
+            contexts += 1
+            continue
+        if len(kept) < len(dist):
+            marks.normalize_counts(kept)
+            mark.state_dict[key] = kept
+
+    return outcomes, contexts
+
+
+def make_prune(train_dir, min_prob):
+    """
+    Builds the prune artifact: the trained chains with rare
+    outcomes dropped (see prune_chain), or copied as they are if
+    min_prob is 0.
+    """
+
+    def build(out_dir):
+        outcomes = contexts = 0
+        for name in sorted(os.listdir(train_dir)):
+            if not name.endswith('.pkl'):
+                continue
+            if min_prob <= 0:
+                shutil.copy(os.path.join(train_dir, name), out_dir)
+                continue
+            with open(os.path.join(train_dir, name), 'r') as f:
+                mark = pickle.load(f)
+            dropped = prune_chain(mark, min_prob)
+            outcomes += dropped[0]
+            contexts += dropped[1]
+            with open(os.path.join(out_dir, name), 'w') as f:
+                pickle.dump(mark, f)
+        return {'outcomes_dropped': outcomes, 'contexts_dropped': contexts}
+
+    return build
+
+
+def find_export(models_dir, key):
+    """
+    Tells whether the bundle the app is serving, the newest complete
+    one (see find_bundles in d3_model/model_loader.py), was exported
+    from the same inputs. An older bundle from the same inputs
+    doesn't count, since the app would never go back to it.
+
+    Outputs: the newest bundle's name, or None
+    """
+
+    if not os.path.isdir(models_dir):
+        return None
+
+    bundles = sorted([name for name in os.listdir(models_dir)
+                      if os.path.exists(os.path.join(models_dir, name,
+                                                     'bundle.json'))])
+    if len(bundles) == 0:
+        return None
+
+    with open(os.path.join(models_dir, bundles[-1], 'bundle.json'), 'r') as f:
+        if json.load(f).get('pipeline') == key:
+            return bundles[-1]
+
+    return None
+
+
+def export(prune_dir, models_dir, key, max_order, weights = None,
+           version = None):
+    """
+    Deploys the pruned chains as a new bundle of models_dir (see
+    d3_model/model_loader.py): the pickles, weights.json if given,
+    and bundle.json, which is written last so that the app never
+    loads a bundle still being copied.
+
+    Inputs:
+    prune_dir is the prune artifact's directory
+    models_dir is the web app's models directory
+    key is the export stage's key, recorded in bundle.json
+    max_order is the largest combined order of the chains
+    weights is a weights.json file (see tune_weights.py), or None
+    version is the bundle's name, or None for a UTC timestamp
+
+    Outputs: the bundle's name
+    """
+
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+
+    bundle_dir = os.path.join(models_dir, version)
+    if os.path.exists(bundle_dir):
+        raise ValueError("bundle " + bundle_dir + " already exists")
+    os.makedirs(bundle_dir)
+
+    for name in os.listdir(prune_dir):
+        if name.endswith('.pkl'):
+            shutil.copy(os.path.join(prune_dir, name), bundle_dir)
+
+    if weights is not None:
+        shutil.copy(weights, os.path.join(bundle_dir, 'weights.json'))
+
+    write_json(os.path.join(bundle_dir, 'bundle.json'),
+               {'max_len': max_order, 'pipeline': key})
+
+    return version
+
+
+def run_pipeline(midi_dir, work_dir, models_dir, max_order = 2, level = 1,
+                 separate = None, max_voices = 4, relative = False,
+                 buffer_limit = None, spill_dir = None, min_prob = 0.0,
+                 weights = None, until = 'export', force = None):
+    """
+    Runs every stage up to until, skipping those whose artifacts
+    are up to date.
+
+    Inputs:
+    midi_dir is the directory of MIDI files to train on
+    work_dir is where to keep the artifacts
+    models_dir is where to export bundles to
+    max_order is the largest combined order of chain to train
+    level is the rhythm quantization level (see markov_funcs.myround)
+    separate and max_voices are as in midi_funcs.get_sequences
+    relative is as in markov_funcs.train_chain (melody chains only)
+    buffer_limit and spill_dir are as in markov_funcs.train_chain
+    min_prob is as in prune_chain, or 0 not to prune
+    weights is a weights.json file to deploy with the chains, or None
+    until is the last stage to run
+    force is a stage to rebuild (along with every later one), or None
+
+    Outputs: dictionary of stage -> artifact key, plus 'bundle', the
+    name of the exported bundle (None if the stage didn't run)
+    """
+
+    last = stages.index(until)
+    forced = stages[stages.index(force):] if force is not None else []
+    result = {'bundle': None}
+
+    files = sorted(midf.get_midi_list(midi_dir) or [])
+    if len(files) == 0:
+        raise ValueError("no MIDI files in " + midi_dir)
+
+    digests = dict([(f, file_digest(f)) for f in files])
+    cache_dir = os.path.join(work_dir, 'ingest', 'files')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    inputs = {'files': [[os.path.basename(f), digests[f]] for f in files],
+              'separate': separate,
+              'max_voices': max_voices}
+    key, ingest_dir = run_stage(work_dir, 'ingest', inputs,
+                                make_ingest(files, digests, cache_dir,
+                                            separate, max_voices),
+                                'ingest' in forced)
+    result['ingest'] = key
+    if last < 1:
+        return result
+
+    inputs = {'ingest': key, 'level': level}
+    key, quantize_dir = run_stage(work_dir, 'quantize', inputs,
+                                  make_quantize(ingest_dir, level),
+                                  'quantize' in forced)
+    result['quantize'] = key
+    if last < 2:
+        return result
+
+    inputs = {'ingest': result['ingest'], 'quantize': key,
+              'max_order': max_order, 'relative': relative}
+    key, train_dir = run_stage(work_dir, 'train', inputs,
+                               make_train(ingest_dir, quantize_dir, max_order,
+                                          relative, buffer_limit, spill_dir),
+                               'train' in forced)
+    result['train'] = key
+    if last < 3:
+        return result
+
+    inputs = {'train': key, 'min_prob': min_prob}
+    key, prune_dir = run_stage(work_dir, 'prune', inputs,
+                               make_prune(train_dir, min_prob),
+                               'prune' in forced)
+    result['prune'] = key
+    if last < 4:
+        return result
+
+    inputs = {'prune': key, 'max_order': max_order,
+              'weights': file_digest(weights) if weights else None}
+    key = stage_key('export', inputs)
+    result['export'] = key
+
+    bundle = find_export(models_dir, key)
+    if bundle is not None and 'export' not in forced:
+        print ("export: up to date (bundle " + bundle + "), skipped.")
+        return result
+
+    if not os.path.isdir(models_dir):
+        os.makedirs(models_dir)
+    result['bundle'] = export(prune_dir, models_dir, key, max_order, weights)
+    print ("export: bundle " + result['bundle'] + " written to " +
+           models_dir + ".")
+
+    return result
+
+
+def lock(work_dir):
+    """
+    Takes an exclusive lock on the working directory, so that a
+    cron run that starts while the last one is still going exits
+    instead of building the same artifacts.
+
+    Outputs: the open (locked) file object, which must be kept
+    """
+
+    f = open(os.path.join(work_dir, 'pipeline.lock'), 'a')
+
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print ("Another pipeline run holds " + work_dir + ", exiting.")
+        sys.exit(1)
+
+    return f
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Trains and deploys the Markov chains in resumable '
+        'stages.')
+    parser.add_argument('--midi-dir', default = os.path.join(repo_dir, 'midi'))
+    parser.add_argument('--work-dir',
+                        default = os.path.join(repo_dir, 'pipeline'),
+                        help = 'where to keep each stage\'s artifacts')
+    parser.add_argument('--models-dir',
+                        default = os.path.join(repo_dir, 'pickles'),
+                        help = 'where to export bundles (the app\'s '
+                        'LEVELUP_MODELS_DIR)')
+    parser.add_argument('--max-order', type = int, default = 2)
+    parser.add_argument('--level', type = int, default = 1)
+    parser.add_argument('--separate', default = None,
+                        choices = midf.separations,
+                        help = 'split melodies into monophonic voices')
+    parser.add_argument('--max-voices', type = int, default = 4)
+    parser.add_argument('--relative', action = 'store_true',
+                        help = 'train every melody order on intervals')
+    parser.add_argument('--buffer-limit', type = int, default = None,
+                        help = 'count on disk, spilling every this many '
+                        'distinct windows')
+    parser.add_argument('--spill-dir', default = None)
+    parser.add_argument('--min-prob', type = float, default = 0.0,
+                        help = 'drop outcomes less likely than this')
+    parser.add_argument('--weights', default = None,
+                        help = 'weights.json to deploy with the chains')
+    parser.add_argument('--until', default = 'export', choices = stages,
+                        help = 'last stage to run')
+    parser.add_argument('--force', default = None, choices = stages,
+                        help = 'rebuild this stage and every later one')
+    opts = parser.parse_args(args[1:])
+
+    if not os.path.isdir(opts.work_dir):
+        os.makedirs(opts.work_dir)
+    held = lock(opts.work_dir)
+
+    try:
+        result = run_pipeline(opts.midi_dir, opts.work_dir, opts.models_dir,
+                              opts.max_order, opts.level, opts.separate,
+                              opts.max_voices, opts.relative,
+                              opts.buffer_limit, opts.spill_dir,
+                              opts.min_prob, opts.weights, opts.until,
+                              opts.force)
+    except ValueError as e:
+        print ("Error: " + str(e))
+        sys.exit(1)
+    finally:
+        held.close()
+
+    write_json(os.path.join(opts.work_dir, 'last_run.json'), result)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
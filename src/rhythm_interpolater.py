@@ -0,0 +1,224 @@
+###########################################################
+### rhythm_interpolater.py -- rhythmic counterpart to   ###
+### note_interpolater.py. Uses the rhythm Markov chains ###
+### to suggest new onsets (in beats) between existing   ###
+### onsets of a quantized rhythm sequence.              ###
+###########################################################
+
+import numpy as np
+
+
+def get_rhythm_contexts(onsets, max_len):
+    """
+    Lists every rhythm Markov Chain context that applies to an onset
+    sequence with exactly one 'x' value included. Rhythm chains are
+    always trained recentered (see markov_funcs.iterate_rhythm), so
+    every context is shifted so that its first onset is 0.
+
+    Inputs:
+    onsets is a list of onset times in beats, with one 'x'
+    max_len is the maximum order length for the set of markov chains
+
+    Outputs: List of 3-tuples of ((before, after), key, to_subtract),
+    where key is the state_dict key for the (before, after) model
+    and to_subtract is the onset to add back onto its results.
+    """
+
+    contexts = []
+
+    to_fill = onsets.index('x')
+
+    onsets_len = len(onsets)
+
+    for before in range(max_len + 1):
+        for after in range(max_len + 1):
+            if (before + after == 0) or (before + after > max_len):
+                continue
+
+            if (before > to_fill) or (after >= onsets_len - to_fill):
+                continue
+
+            bef_onsets = onsets[to_fill - before:to_fill]
+            aft_onsets = onsets[to_fill + 1:to_fill + after + 1]
+
+            if before:
+                to_subtract = bef_onsets[0]
+            else:
+                to_subtract = aft_onsets[0]
+
+            bef_onsets = tuple(map(lambda x: round(x - to_subtract, 4),
+                                   bef_onsets))
+            aft_onsets = tuple(map(lambda x: round(x - to_subtract, 4),
+                                   aft_onsets))
+
+            if before and after:
+                key = (bef_onsets, aft_onsets)
+            elif before:
+                key = bef_onsets
+            else:
+                key = aft_onsets
+
+            contexts.append(((before, after), key, to_subtract))
+
+    return contexts
+
+
+def build_rhythm_tables(rhythm_marks):
+    """
+    Precomputes the candidate-onset distribution of every context in
+    every rhythm chain as a pair of numpy arrays, so that lookups at
+    request time don't have to walk the state dictionaries.
+
+    Inputs: rhythm_marks is a dictionary of Markov objects
+
+    Outputs: dictionary of (before, after) -> dictionary of
+    state_dict key -> 2-tuple of (relative onsets, probabilities)
+    """
+
+    tables = {}
+
+    for order, mark in rhythm_marks.items():
+        table = {}
+        for key, dist in mark.state_dict.items():
+            values = sorted(dist)
+            table[key] = (np.array(values, dtype = float),
+                          np.array([dist[v] for v in values], dtype = float))
+        tables[order] = table
+
+    return tables
+
+
+def get_candidate_onsets(tables, onsets, weights, max_len,
+                         lower = None, upper = None, grid = None):
+    """
+    Given a sequence of onsets with exactly one 'x' value included,
+    builds up the rhythm chains' weighted distributions on the value
+    of 'x', in the same way note_interpolater.get_mel_probs does for
+    pitches, working from the tables built by build_rhythm_tables.
+    Candidates from different chains are not merged, which doesn't
+    change the distribution they describe.
+
+    Inputs:
+    tables is a dictionary as returned by build_rhythm_tables
+    onsets is a list of onset times in beats, with one 'x'
+    weights is a dictionary of weights for each model
+    max_len is the maximum order length for the set of markov chains
+    lower and upper bound the allowed onsets (exclusive), or None
+    grid is a step (in beats) that onsets must fall on, or None
+
+    Outputs: 2-tuple of numpy arrays of absolute onsets and their
+    (unnormalized) weighted probabilities.
+    """
+
+    values, probs = [], []
+
+    for order, key, to_subtract in get_rhythm_contexts(onsets, max_len):
+        if key in tables[order] and weights[order] != 0:
+            order_values, order_probs = tables[order][key]
+            values.append(np.round(order_values + to_subtract, 4))
+            probs.append(order_probs * weights[order])
+
+    if len(values) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    values = np.concatenate(values)
+    probs = np.concatenate(probs)
+
+    keep = np.ones(len(values), dtype = bool)
+    if lower is not None:
+        keep &= values > lower
+    if upper is not None:
+        keep &= values < upper
+    if grid is not None:
+        keep &= np.abs(values / grid - np.round(values / grid)) < 1e-3
+
+    return values[keep], probs[keep]
+
+
+def sample_onsets(tables, windows, weights, max_len, rng,
+                  bounds = None, grid = None):
+    """
+    Samples one new onset for each of many onset windows at once.
+    Windows that look the same once recentered (the common case in 
+    real music) share one candidate lookup, and the sampling itself
+    is done for every window in a single array operation.
+
+    Inputs:
+    tables is a dictionary as returned by build_rhythm_tables
+    windows is a list of onset lists, each with exactly one 'x'
+    weights is a dictionary of weights for each model
+    max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object
+    bounds is a list of (lower, upper) tuples, one per window, or None
+    grid is a step (in beats) that onsets must fall on, or None
+
+    Outputs: List of new onsets in beats, with None where no model 
+    suggests an onset in the allowed interval.
+    """
+
+    if bounds is None:
+        bounds = [(None, None)] * len(windows)
+
+    cache = {}
+    candidates = []
+
+    for window, (lower, upper) in zip(windows, bounds):
+        anchor = [x for x in window if x != 'x'][0]
+        shift = lambda x: x if x in ('x', None) else round(x - anchor, 4)
+
+        cache_key = (tuple(map(shift, window)), shift(lower), shift(upper))
+        if cache_key not in cache:
+            cache[cache_key] = get_candidate_onsets(tables,
+                                                    list(cache_key[0]),
+                                                    weights, max_len,
+                                                    cache_key[1],
+                                                    cache_key[2], grid)
+        values, probs = cache[cache_key]
+        candidates.append((values + anchor, probs))
+
+    width = max([len(values) for values, probs in candidates] + [1])
+    all_values = np.zeros((len(windows), width))
+    all_probs = np.zeros((len(windows), width))
+
+    for j, (values, probs) in enumerate(candidates):
+        all_values[j, :len(values)] = values
+        all_probs[j, :len(probs)] = probs
+
+    cdf = np.cumsum(all_probs, axis = 1)
+    totals = cdf[:, -1]
+    picks = (cdf <= (rng.random_sample(len(windows)) * 
+                     totals)[:, None]).sum(axis = 1)
+    picks = np.minimum(picks, width - 1)
+
+    return [round(all_values[j, picks[j]], 4) if totals[j] > 0 else None
+            for j in range(len(windows))]
+
+
+def choose_grid_steps(tables, steps, weights, max_len, rng):
+    """
+    Rhythmic augmentation for the web app's step grid, where one step
+    is one beat. For every gap between occupied steps, the rhythm 
+    chains pick (at most) one empty step to receive a new note.
+
+    Inputs:
+    tables is a dictionary as returned by build_rhythm_tables
+    steps is a list of the occupied step numbers
+    weights is a dictionary of weights for each model
+    max_len is the max order length of the set of Markov chains
+    rng is a numpy.random.RandomState object
+
+    Outputs: sorted list of the steps to fill
+    """
+
+    onsets = sorted(set(map(float, steps)))
+    gaps = [i for i in range(len(onsets) - 1) 
+            if onsets[i + 1] - onsets[i] > 1]
+
+    windows = [onsets[max(0, i + 1 - max_len):i + 1] + ['x'] +
+               onsets[i + 1:i + 1 + max_len] for i in gaps]
+    bounds = [(onsets[i], onsets[i + 1]) for i in gaps]
+
+    new_onsets = sample_onsets(tables, windows, weights, max_len, rng,
+                               bounds, grid = 1.0)
+
+    return sorted([int(onset) for onset in new_onsets if onset is not None])
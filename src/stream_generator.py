@@ -0,0 +1,445 @@
+#######################################################
+### stream_generator.py -- generates new melodies   ###
+### and rhythms of any length from the before-only  ###
+### (mode 0) Markov chains, one note at a time, for ###
+### background content. Each context's distribution ###
+### is turned into an alias table the first time it ###
+### is used, so every later step costs O(1).        ###
+#######################################################
+
+import sys
+import json
+import math
+import argparse
+import itertools
+import numpy as np
+import midi
+import markov_funcs as markf
+import markov_sequences as marks
+
+# uniform random numbers drawn at once per stream (three per step)
+block_size = 256
+
+
+class AliasSampler(object):
+    """
+    Walker's alias table for one discrete distribution, so that a
+    sample takes two uniform random numbers and one comparison,
+    however many outcomes there are.
+    """
+
+    __slots__ = ('values', 'probs', 'aliases')
+
+    def __init__(self, dist):
+        """
+        Builds the table with Vose's method.
+
+        Inputs: dist is a dictionary of outcome -> probability (as in
+        a Markov state_dict); it needn't sum to exactly 1
+
+        Outputs: AliasSampler object
+        """
+
+        self.values = sorted(dist)
+        n = len(self.values)
+        total = float(sum([dist[v] for v in self.values]))
+        scaled = [dist[v] * n / total for v in self.values]
+
+        self.probs = [1.0] * n
+        self.aliases = list(range(n))
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+
+        while len(small) > 0 and len(large) > 0:
+            s, l = small.pop(), large.pop()
+            self.probs[s] = scaled[s]
+            self.aliases[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, u, v):
+        """
+        Draws one outcome.
+
+        Inputs: u and v are uniform random numbers in [0, 1)
+
+        Outputs: an outcome of the distribution
+        """
+
+        i = int(u * len(self.values))
+
+        if v < self.probs[i]:
+            return self.values[i]
+
+        return self.values[self.aliases[i]]
+
+
+class ChainTable(object):
+    """
+    The samplers of one mode 0 Markov chain, built lazily: each
+    context's alias table is made the first time a stream reaches
+    that context, and kept for every later visit.
+    """
+
+    def __init__(self, mark, recentered):
+        """
+        Inputs:
+        mark is a mode 0 markov_sequences.Markov object
+        recentered is True if its contexts are stored relative to
+        their first value
+
+        Outputs: ChainTable object
+        """
+
+        self.mark = mark
+        self.order = mark.before
+        self.recentered = recentered
+        self.samplers = {}
+        self.keys = None
+
+    def get(self, key):
+        """
+        Finds the sampler for a context.
+
+        Inputs: key is a state_dict key
+
+        Outputs: AliasSampler object, or None if the chain has never
+        seen the context
+        """
+
+        if key not in self.samplers:
+            dist = self.mark.state_dict.get(key)
+            self.samplers[key] = AliasSampler(dist) if dist else None
+
+        return self.samplers[key]
+
+    def draw_key(self, u):
+        """
+        Picks one of the chain's stored contexts uniformly at random.
+
+        Inputs: u is a uniform random number in [0, 1)
+
+        Outputs: state_dict key
+        """
+
+        if self.keys is None:
+            self.keys = sorted(self.mark.state_dict)
+
+        return self.keys[int(u * len(self.keys))]
+
+
+class StreamGenerator(object):
+    """
+    Generates streams of values (pitches or onsets) from the mode 0
+    chains of a set of Markov chains. At each step the longest chain
+    that has seen the stream's last few values is used (backing off
+    to shorter ones), rather than mixing every chain's distribution
+    as note_interpolater does, which is what lets each context keep
+    one precomputed sampler. If no chain has seen the context, the
+    stream restarts from a stored context of the longest chain,
+    placed at its last value.
+    """
+
+    def __init__(self, chains, weights, recentered, finish, anchor = 0):
+        """
+        Inputs:
+        chains is a dictionary of (before, after) -> Markov objects;
+        only the mode 0 ones (after == 0) are used
+        weights is the matching dictionary of weights; chains with
+        weight 0 are left out, the rest are used alike
+        recentered is a function telling whether a chain's contexts
+        are stored relative to their first value
+        finish is a function applied to each new value, e.g. to round
+        it, given the value and the one before it (or None)
+        anchor is where to place a recentered start context
+
+        Outputs: StreamGenerator object
+        """
+
+        self.tables = [ChainTable(mark, recentered(mark))
+                       for (before, after), mark in sorted(chains.items(),
+                                                           reverse = True)
+                       if after == 0 and weights[(before, after)] != 0]
+
+        if len(self.tables) == 0:
+            raise ValueError("No before-only chains to generate from.")
+
+        self.max_order = self.tables[0].order
+        self.finish = finish
+        self.anchor = anchor
+
+    def place(self, table, key, anchor):
+        """
+        Turns a stored context of table into absolute values.
+        """
+
+        if table.recentered:
+            return [x + anchor for x in key]
+
+        return list(key)
+
+    def next_value(self, history, u):
+        """
+        Draws the value to follow history, using the longest chain
+        that knows its context.
+
+        Inputs:
+        history is a list of the stream's values so far (at least
+        the last max_order of them)
+        u is a sequence of three uniform random numbers in [0, 1)
+
+        Outputs: 2-tuple of the new value and the history to carry
+        on from (history itself, unless the stream had to restart)
+        """
+
+        for table in self.tables:
+            if len(history) < table.order:
+                continue
+            context = history[len(history) - table.order:]
+            anchor = context[0] if table.recentered else 0
+            if table.recentered:
+                key = tuple([round(x - anchor, 4) for x in context])
+            else:
+                key = tuple(context)
+            sampler = table.get(key)
+            if sampler is not None:
+                return (self.finish(sampler.sample(u[1], u[2]) + anchor,
+                                    history[-1]), history)
+
+        top = self.tables[0]
+        key = top.draw_key(u[0])
+        history = self.place(top, key, history[-1] - key[0]
+                             if top.recentered else 0)
+
+        return (self.finish(top.get(key).sample(u[1], u[2]) +
+                            (history[0] if top.recentered else 0),
+                            history[-1]), history)
+
+    def stream(self, rng = None, start = None):
+        """
+        Generates one stream lazily, for as long as it is iterated
+        (e.g. with itertools.islice).
+
+        Inputs:
+        rng is a numpy.random.RandomState object (see
+        note_interpolater.make_rng), or None for a fresh one
+        start is a list of values to carry on from, or None to draw
+        a stored context of the longest chain; a drawn start's values
+        are yielded first, so the stream is a complete sequence
+
+        Outputs: generator of values
+        """
+
+        if rng is None:
+            rng = np.random.RandomState()
+
+        if start is None:
+            top = self.tables[0]
+            key = top.draw_key(rng.random_sample())
+            start = self.place(top, key, self.anchor - key[0]
+                               if top.recentered else 0)
+            for value in start:
+                yield self.finish(value, None)
+
+        history = list(start)[-self.max_order:]
+
+        while True:
+            for u in rng.random_sample((block_size, 3)):
+                value, history = self.next_value(history, u)
+                history = (history + [value])[-self.max_order:]
+                yield value
+
+    def streams(self, rngs, starts = None):
+        """
+        Generates many independent streams in lockstep, sharing one
+        set of samplers. Each stream gives the same values it would
+        on its own with the same RandomState.
+
+        Inputs:
+        rngs is a list of numpy.random.RandomState objects, one per
+        stream
+        starts is a matching list of starts (see stream), or None
+
+        Outputs: generator of lists with one value per stream
+        """
+
+        if starts is None:
+            starts = [None] * len(rngs)
+
+        streams = [self.stream(rng, start) for rng, start in zip(rngs, starts)]
+
+        while True:
+            yield [next(stream) for stream in streams]
+
+
+def fold_pitch(pitch, previous = None, lowest = 0, highest = 127):
+    """
+    Rounds a generated pitch to an integer, moving it by octaves
+    into [lowest, highest] if a relative chain wandered outside.
+    """
+
+    pitch = int(round(pitch))
+
+    while pitch > highest:
+        pitch -= 12
+    while pitch < lowest:
+        pitch += 12
+
+    return pitch
+
+
+def round_onset(onset, previous = None, level = 1):
+    """
+    Snaps a generated onset (in beats) to the quantization grid the
+    rhythm chains were trained on (see markov_funcs.myround), so
+    that rounding errors never build up along a stream.
+    """
+
+    whole = math.floor(onset)
+
+    return round(whole + markf.myround(onset - whole, level), 4)
+
+
+def melody_generator(melody_marks, melody_weights, anchor = 60):
+    """
+    Builds a StreamGenerator of pitches from melody chains.
+
+    Inputs:
+    melody_marks and melody_weights are as from
+    markov_funcs.load_chains
+    anchor is the pitch a recentered start context begins on
+
+    Outputs: StreamGenerator object
+    """
+
+    return StreamGenerator(melody_marks, melody_weights, marks.is_recentered,
+                           fold_pitch, anchor)
+
+
+def rhythm_generator(rhythm_marks, rhythm_weights, level = 1):
+    """
+    Builds a StreamGenerator of onsets (in beats, starting near 0)
+    from rhythm chains, which are always recentered.
+
+    Inputs:
+    rhythm_marks and rhythm_weights are as from
+    markov_funcs.load_chains
+    level is the quantization level the chains were trained at
+    (see markov_funcs.myround)
+
+    Outputs: StreamGenerator object
+    """
+
+    return StreamGenerator(rhythm_marks, rhythm_weights, lambda mark: True,
+                           lambda onset, previous: round_onset(onset,
+                                                               previous,
+                                                               level),
+                           0.0)
+
+
+def generate(melody_gen, rhythm_gen, length, rngs):
+    """
+    Generates one melody per RandomState, pairing a pitch stream with
+    an onset stream. Each RandomState only seeds a private one for
+    each of the two streams, so neither stream's draws depend on how
+    far the other has got.
+
+    Inputs:
+    melody_gen and rhythm_gen are StreamGenerator objects
+    length is the number of notes in each melody
+    rngs is a list of numpy.random.RandomState objects
+
+    Outputs: list of lists of (onset, pitch) tuples
+    """
+
+    seeds = [rng.randint(2 ** 31, size = 2) for rng in rngs]
+    pitches = itertools.islice(melody_gen.streams(
+        [np.random.RandomState(seed[0]) for seed in seeds]), length)
+    onsets = itertools.islice(rhythm_gen.streams(
+        [np.random.RandomState(seed[1]) for seed in seeds]), length)
+    melodies = [[] for rng in rngs]
+
+    for pitch_step, onset_step in zip(pitches, onsets):
+        for melody, onset, pitch in zip(melodies, onset_step, pitch_step):
+            melody.append((onset, pitch))
+
+    return melodies
+
+
+def write_midi(filename, melody, program = 0, resolution = 480,
+               velocity = 100):
+    """
+    Writes one generated melody as a MIDI file, each note lasting
+    until the next one starts (or one beat, for the last).
+
+    Inputs:
+    filename is a string path name
+    melody is a list of (onset in beats, pitch) tuples
+    program is the General MIDI program number
+    resolution is the number of ticks per beat
+    velocity is the MIDI velocity of every note
+    """
+
+    events = [midi.ProgramChangeEvent(tick = 0, channel = 0,
+                                      data = [program])]
+    ticks = [int(round(onset * resolution)) for onset, pitch in melody]
+
+    for k, (onset, pitch) in enumerate(melody):
+        stop = ticks[k + 1] if k + 1 < len(ticks) else ticks[k] + resolution
+        events.append(midi.NoteOnEvent(tick = ticks[k], channel = 0,
+                                       data = [pitch, velocity]))
+        events.append(midi.NoteOffEvent(tick = max(stop, ticks[k] + 1),
+                                        channel = 0, data = [pitch, 0]))
+
+    events = sorted(events, key = lambda x: x.tick)
+    events.append(midi.EndOfTrackEvent(tick = events[-1].tick))
+
+    track = midi.containers.Track(events = events, tick_relative = False)
+    pattern = midi.containers.Pattern(tracks = [track],
+                                      resolution = resolution,
+                                      format = 0, tick_relative = False)
+    pattern.make_ticks_rel()
+    midi.write_midifile(filename, pattern)
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Generates new melodies from the Markov chains.')
+    parser.add_argument('pickle_dir', nargs = '?', default = '../pickles/')
+    parser.add_argument('--streams', type = int, default = 4)
+    parser.add_argument('--length', type = int, default = 64,
+                        help = 'notes per melody')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--anchor', type = int, default = 60,
+                        help = 'starting pitch for relative chains')
+    parser.add_argument('--level', type = int, default = 1,
+                        help = 'rhythm quantization level the chains '
+                        'were trained at')
+    parser.add_argument('--midi-dir', default = None,
+                        help = 'also write each melody here as a .mid')
+    opts = parser.parse_args(args[1:])
+
+    melody_marks, rhythm_marks, melody_weights, rhythm_weights = \
+        markf.load_chains(opts.pickle_dir)
+
+    rngs = [np.random.RandomState(opts.seed * 1009 + j)
+            for j in range(opts.streams)]
+    melodies = generate(melody_generator(melody_marks, melody_weights,
+                                         opts.anchor),
+                        rhythm_generator(rhythm_marks, rhythm_weights,
+                                         opts.level),
+                        opts.length, rngs)
+
+    for j, melody in enumerate(melodies):
+        print (json.dumps(melody))
+        if opts.midi_dir is not None:
+            write_midi(opts.midi_dir.rstrip('/') + '/generated_%04d.mid' % j,
+                       melody)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
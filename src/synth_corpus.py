@@ -0,0 +1,213 @@
+######################################################
+### synth_corpus.py -- writes a repeatable corpus  ###
+### of random Standard MIDI Files, for timing the  ###
+### training pipeline (see benchmark.py) without   ###
+### needing a scraped collection in midi/.         ###
+######################################################
+
+import os
+import sys
+import random
+import struct
+import argparse
+
+# note lengths to choose between, in beats
+durations = [1/4.0, 1/3.0, 1/2.0, 2/3.0, 3/4.0, 1.0, 3/2.0, 2.0]
+
+
+def vlq(n):
+    """
+    Encodes a non-negative integer as a MIDI variable-length quantity.
+
+    Inputs: n is an integer
+
+    Outputs: bytearray
+    """
+
+    out = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        out.insert(0, (n & 0x7f) | 0x80)
+        n >>= 7
+
+    return out
+
+
+def track_chunk(events):
+    """
+    Builds one MTrk chunk.
+
+    Inputs: events is a list of (absolute tick, bytes) pairs
+
+    Outputs: bytearray
+    """
+
+    data = bytearray()
+    last = 0
+
+    for tick, event in sorted(events, key = lambda x: x[0]):
+        data += vlq(tick - last) + event
+        last = tick
+
+    data += vlq(0) + bytearray([0xff, 0x2f, 0x00])
+
+    return bytearray(b'MTrk') + struct.pack('>I', len(data)) + data
+
+
+def make_track(rng, channels, notes, polyphony, resolution):
+    """
+    Makes the events of one track: a program change on each of its
+    channels, then a random walk of chords, each of 1 to polyphony
+    notes, on one channel at a time.
+
+    Inputs:
+    rng is a random.Random object
+    channels is a list of the track's channel numbers
+    notes is the number of chords to play
+    polyphony is the largest number of notes in a chord
+    resolution is the number of ticks per beat
+
+    Outputs: 2-tuple of the list of (tick, bytes) events and the
+    number of note-on events among them
+    """
+
+    events = []
+    for channel in channels:
+        program = rng.randrange(88) if channel != 9 else 0
+        events.append((0, bytearray([0xc0 | channel, program])))
+
+    tick, pitch, note_ons = 0, rng.randint(55, 72), 0
+
+    for i in range(notes):
+        channel = rng.choice(channels)
+        length = int(rng.choice(durations) * resolution)
+        pitch = min(max(pitch + rng.randint(-5, 5), 36), 96)
+        chord = set([pitch])
+        size = min(rng.randint(1, polyphony), 9)
+        for interval in rng.sample([3, 4, 7, 10, 12, 15, 16, 19], size - 1):
+            chord.add(min(pitch + interval, 108))
+
+        for p in sorted(chord):
+            velocity = rng.randint(40, 110)
+            events.append((tick, bytearray([0x90 | channel, p, velocity])))
+            events.append((tick + max(length - 1, 1),
+                           bytearray([0x80 | channel, p, 0])))
+            note_ons += 1
+
+        tick += length
+
+    return events, note_ons
+
+
+def make_midi(seed, tracks = 2, channels = 2, notes = 200, polyphony = 3,
+              tempo = 120, resolution = 480):
+    """
+    Makes one format 1 MIDI file. The channels are spread across the
+    tracks round-robin, and the first track also sets the tempo.
+
+    Inputs:
+    seed is an integer; the same seed always gives the same file
+    tracks is the number of tracks
+    channels is the number of channels (at most 16, and channel 9
+    is percussion, as in General MIDI)
+    notes is the number of chords per track
+    polyphony is the largest number of notes in a chord
+    tempo is in beats per minute
+    resolution is the number of ticks per beat
+
+    Outputs: 2-tuple of the file contents (bytes) and the number of
+    note-on events in it
+    """
+
+    rng = random.Random(seed)
+    chunks = bytearray()
+    note_ons = 0
+
+    for t in range(tracks):
+        track_channels = [c for c in range(channels) if c % tracks == t]
+        if len(track_channels) == 0:
+            track_channels = [t % channels]
+        events, count = make_track(rng, track_channels, notes, polyphony,
+                                   resolution)
+        if t == 0:
+            events.append((0, bytearray([0xff, 0x51, 0x03]) +
+                           struct.pack('>I', int(6e7 / tempo))[1:]))
+        chunks += track_chunk(events)
+        note_ons += count
+
+    header = bytearray(b'MThd') + struct.pack('>IHHH', 6, 1, tracks,
+                                              resolution)
+
+    return bytes(header + chunks), note_ons
+
+
+def make_corpus(path, files = 50, seed = 0, **kwargs):
+    """
+    Writes a corpus of MIDI files named synth_0000.mid and so on.
+
+    Inputs:
+    path is the directory to write to (made if need be)
+    files is the number of files
+    seed is an integer; the same seed always gives the same corpus
+    any other arguments are passed on to make_midi
+
+    Outputs: total number of note-on events written
+    """
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    total = 0
+
+    for i in range(files):
+        data, count = make_midi(seed * 100003 + i, **kwargs)
+        with open(os.path.join(path, 'synth_%04d.mid' % i), 'wb') as f:
+            f.write(data)
+        total += count
+
+    return total
+
+
+def add_corpus_args(parser):
+    """
+    Adds make_corpus's options to an argparse parser (shared with
+    benchmark.py).
+    """
+
+    parser.add_argument('--files', type = int, default = 50)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--tracks', type = int, default = 2)
+    parser.add_argument('--channels', type = int, default = 2)
+    parser.add_argument('--notes', type = int, default = 200,
+                        help = 'chords per track')
+    parser.add_argument('--polyphony', type = int, default = 3)
+    parser.add_argument('--tempo', type = int, default = 120)
+    parser.add_argument('--resolution', type = int, default = 480)
+
+
+def corpus_kwargs(opts):
+    """
+    Picks make_corpus's options back out of parsed arguments.
+    """
+
+    return dict(files = opts.files, seed = opts.seed, tracks = opts.tracks,
+                channels = opts.channels, notes = opts.notes,
+                polyphony = opts.polyphony, tempo = opts.tempo,
+                resolution = opts.resolution)
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Writes a corpus of random MIDI files.')
+    parser.add_argument('out_dir')
+    add_corpus_args(parser)
+    opts = parser.parse_args(args[1:])
+
+    total = make_corpus(opts.out_dir, **corpus_kwargs(opts))
+
+    print ("\nWrote " + str(opts.files) + " MIDI files with " + str(total) +
+           " notes to " + opts.out_dir + ".")
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,352 @@
+######################################################
+### tune_weights.py -- scores the melodic Markov   ###
+### chains on notes masked out of held-out MIDI    ###
+### sequences, then searches for the per-order     ###
+### weights (dropping whole orders if need be)     ###
+### that predict them best within a time budget.   ###
+### Writes weights.json for load_chains to read.   ###
+######################################################
+
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+import midi_funcs as midf
+import markov_funcs as markf
+import note_interpolater as notei
+import context_index as ci
+
+# share of probability given to every pitch evenly, so that notes
+# no model predicts still get a finite log-likelihood
+smoothing = 1e-3
+
+
+def split_sequences(seqs, held_out = .2, seed = 0):
+    """
+    Splits sequences into training and held-out sets at random.
+
+    Inputs:
+    seqs is a list of melody lists
+    held_out is the fraction to hold out
+    seed is an integer
+
+    Outputs: 2-tuple of lists, (training, held out)
+    """
+
+    order = list(range(len(seqs)))
+    random.Random(seed).shuffle(order)
+    cut = int(round(len(seqs) * held_out))
+
+    return [seqs[i] for i in order[cut:]], [seqs[i] for i in order[:cut]]
+
+
+def mask_examples(mels, max_len, per_seq = 20, seed = 0):
+    """
+    Masks notes out of melodies. Each example is the window of
+    max_len chords on either side of the masked one, with one note
+    of every other chord picked at random (as unstack_sequences
+    would), and the masked chord's pitches as the answer.
+
+    Inputs:
+    mels is a list of melody lists (lists of chords)
+    max_len is the max order length of the set of Markov chains
+    per_seq is the most examples to take from one melody
+    seed is an integer
+
+    Outputs: list of 2-tuples of (note tuple with one 'x', set of
+    the masked pitches)
+    """
+
+    rng = random.Random(seed)
+    examples = []
+
+    for mel in mels:
+        if len(mel) < 2:
+            continue
+        positions = list(range(len(mel)))
+        for i in rng.sample(positions, min(per_seq, len(positions))):
+            window = mel[max(0, i - max_len):i + max_len + 1]
+            notes = tuple([rng.choice(chord) if k != min(i, max_len) else 'x'
+                           for k, chord in enumerate(window)])
+            examples.append((notes, set(mel[i])))
+
+    return examples
+
+
+def get_order_probs(melody_marks, examples, max_len, indexes = None):
+    """
+    Looks up every example in every order of model separately, as
+    note_interpolater.get_mel_prob_array does before weighting and
+    summing them, and times each order's lookups.
+
+    Inputs:
+    melody_marks is a dictionary of Markov objects
+    examples is a list of outputs of mask_examples
+    max_len is the max order length of the set of Markov chains
+    indexes is as in get_mel_prob_array
+
+    Outputs: 3-tuple of the sorted list of orders, a numpy array of
+    shape (orders, examples, 128) of each order's probabilities, and
+    a numpy array of the mean seconds per lookup of each order
+    """
+
+    if indexes is None:
+        indexes = {}
+
+    orders = sorted(melody_marks)
+    rows = dict([(order, j) for j, order in enumerate(orders)])
+    relative = notei.get_relative_orders(melody_marks)
+    probs = np.zeros((len(orders), len(examples), 128))
+    seconds = np.zeros(len(orders))
+    lookups = np.zeros(len(orders))
+
+    for e, (notes, answer) in enumerate(examples):
+        for order, key, to_subtract in notei.get_contexts(notes, max_len,
+                                                          relative):
+            j = rows[order]
+            start = time.time()
+            probs[j, e] = notei.lookup_probs(melody_marks[order], key,
+                                             to_subtract, indexes.get(order))
+            seconds[j] += time.time() - start
+            lookups[j] += 1
+
+    return orders, probs, seconds / np.maximum(lookups, 1)
+
+
+def make_answers(examples):
+    """
+    Marks each example's masked pitches.
+
+    Outputs: boolean numpy array of shape (examples, 128)
+    """
+
+    answers = np.zeros((len(examples), 128), dtype = bool)
+
+    for e, (notes, answer) in enumerate(examples):
+        for pitch in answer:
+            if 0 <= pitch < 128:
+                answers[e, int(pitch)] = True
+
+    return answers
+
+
+def evaluate(probs, weights, answers, ks = (1, 3, 5)):
+    """
+    Scores one choice of weights on the masked examples.
+
+    Inputs:
+    probs is the array from get_order_probs
+    weights is a numpy array with one weight per order
+    answers is the array from make_answers
+    ks is the list of k to measure top-k accuracy for
+
+    Outputs: dictionary of 'loglik' (the mean log probability of
+    the masked chord's pitches), 'coverage' (the share of examples
+    any model had an answer for) and 'top<k>' accuracies
+    """
+
+    mixed = np.tensordot(weights, probs, axes = 1)
+    totals = mixed.sum(axis = 1)
+    seen = totals > 0
+    mixed[seen] /= totals[seen][:, None]
+    mixed[~seen] = 1 / 128.0
+    mixed = (1 - smoothing) * mixed + smoothing / 128.0
+
+    loglik = np.log((mixed * answers).sum(axis = 1))
+    scores = {'loglik': float(np.mean(loglik)),
+              'coverage': float(np.mean(seen))}
+
+    ranked = np.argsort(-mixed, axis = 1)
+    for k in ks:
+        hits = answers[np.arange(len(answers))[:, None], ranked[:, :k]]
+        scores['top' + str(k)] = float(np.mean(hits.any(axis = 1) & seen))
+
+    return scores
+
+
+def search_weights(probs, answers, seconds, budget = None,
+                   objective = 'loglik', grid = (0, .25, .5, 1, 2, 4),
+                   rounds = 3):
+    """
+    Searches for the weights that score best on objective, one order
+    at a time over the grid of candidate weights, for a few rounds.
+    A weight of 0 drops that order, saving its lookup time. With a
+    budget, orders are first dropped, worst trade first, until the
+    rest fit in it, and no later change may break it. If even one
+    order doesn't fit, that last order is kept (with a warning)
+    rather than turning every model off.
+
+    Inputs:
+    probs, answers are as for evaluate
+    seconds is the array of mean lookup times from get_order_probs
+    budget is the most lookup time to spend per masked note, in
+    seconds, or None for no limit
+    objective is 'loglik' or 'top<k>' for a k evaluate measures
+    grid is the list of candidate weights
+    rounds is the number of passes over the orders
+
+    Outputs: numpy array of weights, one per order
+    """
+
+    weights = np.ones(probs.shape[0])
+    cost = lambda w: float(np.sum(seconds[w > 0]))
+    score = lambda w: evaluate(probs, w, answers)[objective]
+
+    while budget is not None and cost(weights) > budget:
+        # dropping every order would turn all the melody models off
+        if np.count_nonzero(weights) <= 1:
+            print ("Warning: no order fits the budget of %g us; keeping "
+                   "the last one (%.1f us per note)." %
+                   (1e6 * budget, 1e6 * cost(weights)))
+            break
+        best = None
+        for j in np.nonzero(weights)[0]:
+            trial = weights.copy()
+            trial[j] = 0
+            loss = (score(weights) - score(trial)) / max(seconds[j], 1e-12)
+            if best is None or loss < best[0]:
+                best = (loss, j)
+        if best is None:
+            break
+        weights[best[1]] = 0
+
+    for r in range(rounds):
+        changed = False
+        for j in range(len(weights)):
+            for value in grid:
+                trial = weights.copy()
+                trial[j] = value
+                if not trial.any():
+                    continue
+                if budget is not None and cost(trial) > budget:
+                    continue
+                if score(trial) > score(weights) + 1e-9:
+                    weights = trial
+                    changed = True
+        if not changed:
+            break
+
+    return weights
+
+
+def write_weights(filename, orders, weights, rhythm_weights = None):
+    """
+    Writes a weights file in the form load_chains reads:
+    {"melody": {"1,0": 1.0, ...}, "rhythm": {...}}.
+
+    Inputs:
+    filename is where to write
+    orders is the list of (before, after) melody orders
+    weights is the matching list of melody weights
+    rhythm_weights is a dictionary of rhythm weights, or None
+    """
+
+    out = {'melody': dict([(str(b) + ',' + str(a), float(w))
+                           for (b, a), w in zip(orders, weights)])}
+
+    if rhythm_weights is not None:
+        out['rhythm'] = dict([(str(b) + ',' + str(a), float(w))
+                              for (b, a), w in rhythm_weights.items()])
+
+    with open(filename, 'w') as f:
+        json.dump(out, f, indent = 2, sort_keys = True)
+
+
+def print_scores(title, orders, weights, scores, seconds):
+    print ("\n" + title)
+    print ("  weights: " + ', '.join(['%d%d=%g' % (b, a, w) for (b, a), w
+                                      in zip(orders, weights)]))
+    print ("  " + ', '.join(['%s %.4f' % (k, v)
+                             for k, v in sorted(scores.items())]))
+    print ("  lookup time per note: %.1f us" %
+           (1e6 * np.sum(seconds[np.array(weights) > 0])))
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description = 'Tunes the melody weights on held-out notes.')
+    parser.add_argument('midi_dir', nargs = '?', default = None,
+                        help = 'MIDI files to split into training and '
+                        'held-out sequences')
+    parser.add_argument('--pickles', default = None,
+                        help = 'score these chains instead of training '
+                        'on a split of midi_dir (needs --test-dir)')
+    parser.add_argument('--test-dir', default = None,
+                        help = 'held-out MIDI files the --pickles chains '
+                        'were not trained on, to score them on')
+    parser.add_argument('--held-out', type = float, default = .2)
+    parser.add_argument('--max-order', type = int, default = 2)
+    parser.add_argument('--per-seq', type = int, default = 20)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--relative', action = 'store_true',
+                        help = 'train every order on intervals (see '
+                        'markov_funcs.make_all_chains)')
+    parser.add_argument('--objective', default = 'loglik',
+                        help = 'loglik, top1, top3 or top5')
+    parser.add_argument('--budget-us', type = float, default = None,
+                        help = 'most lookup time per note, in microseconds')
+    parser.add_argument('--no-fallback', action = 'store_true',
+                        help = "don't fall back on neighbouring contexts "
+                        "(the web app does)")
+    parser.add_argument('--out', default = None,
+                        help = 'weights file to write, e.g. '
+                        '../pickles/weights.json')
+    opts = parser.parse_args(args[1:])
+
+    # scoring chains on the sequences they were trained on would
+    # reward the higher orders for memorizing them
+    if opts.pickles is not None:
+        if opts.test_dir is None:
+            parser.error('--pickles needs --test-dir, a directory of MIDI '
+                         'files the chains were not trained on')
+        melody_marks, _, _, rhythm_weights = markf.load_chains(opts.pickles)
+        max_len = max([b + a for b, a in melody_marks])
+        test, _ = midf.extract_all_sequences(
+            midf.get_midi_list(opts.test_dir))
+    else:
+        if opts.midi_dir is None:
+            parser.error('give midi_dir, or --pickles and --test-dir')
+        mels, _ = midf.extract_all_sequences(
+            midf.get_midi_list(opts.midi_dir))
+        max_len = opts.max_order
+        train, test = split_sequences(mels, opts.held_out, opts.seed)
+        melody_marks = dict([((b, a), markf.train_chain(
+            train, b, a, mode, markf.iterate_melody,
+            relative = opts.relative))
+            for b, a, mode in markf.get_orders(max_len)])
+        rhythm_weights = None
+
+    indexes = None if opts.no_fallback else ci.build_indexes(melody_marks)
+
+    examples = mask_examples(test, max_len, opts.per_seq, opts.seed)
+    print ("\n" + str(len(examples)) + " notes masked in " + str(len(test)) +
+           " held-out sequences.")
+
+    orders, probs, seconds = get_order_probs(melody_marks, examples, max_len,
+                                             indexes)
+    answers = make_answers(examples)
+
+    for order, s in zip(orders, seconds):
+        print ("  order %s: %.1f us per lookup, top1 alone %.4f" %
+               (order, 1e6 * s,
+                evaluate(probs, np.array([float(o == order) for o in orders]),
+                         answers)['top1']))
+
+    uniform = np.ones(len(orders))
+    print_scores('All weights 1:', orders, uniform,
+                 evaluate(probs, uniform, answers), seconds)
+
+    budget = opts.budget_us / 1e6 if opts.budget_us is not None else None
+    weights = search_weights(probs, answers, seconds, budget, opts.objective)
+    print_scores('Tuned:', orders, weights,
+                 evaluate(probs, weights, answers), seconds)
+
+    if opts.out is not None:
+        write_weights(opts.out, orders, weights, rhythm_weights)
+        print ("\nWeights written to " + opts.out + ".")
+
+
+if __name__ == '__main__':
+    main(*sys.argv)